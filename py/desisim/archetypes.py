@@ -14,9 +14,101 @@ import numpy as np
 from desiutil.log import get_logger
 log = get_logger()
 
-def compute_chi2(flux, ferr=None):
+#- SetCoverPy copies the adjacency matrix into a dense [nspec, nspec] array
+#- (plus sparse copies of it), so refuse to hand it more spectra than this
+max_setcover_nspec = 20000
+
+def _chi2_block(flux, ferr, i0, i1, j0, j1, maxsize=2**20):
+    """Returns the (chi2, amp) [i1-i0, j1-j0] block of the chi2 matrix of the
+    normalized spectra flux and errors ferr, where amp is not yet rescaled.
+
+    Without errors the block is a matrix product.  With errors this is a
+    vectorized version of SetCoverPy.mathutils.quick_amplitude with niter=1
+    for every spectrum i against every spectrum j, computed on
+    [ni, nj, npix] tiles of at most maxsize elements; the weighted sums are
+    accumulated over tiles of pixels if a single pair of spectra exceeds it.
+    """
+    npix = flux.shape[1]
+    if ferr is None:
+        amp = np.dot(flux[i0:i1], flux[j0:j1].T) / npix
+        chi2 = npix*(1.-amp**2)
+        return chi2, amp
+
+    chi2 = np.zeros((i1-i0, j1-j0))
+    amp = np.zeros((i1-i0, j1-j0))
+    pstep = max(1, min(npix, maxsize))
+    jstep = max(1, min(j1-j0, maxsize // pstep))
+    istep = max(1, maxsize // (jstep*pstep))
+    for k0 in range(i0, i1, istep):
+        k1 = min(k0+istep, i1)
+        for l0 in range(j0, j1, jstep):
+            l1 = min(l0+jstep, j1)
+            sxy = np.zeros((k1-k0, l1-l0))
+            sxypos = np.zeros((k1-k0, l1-l0))
+            sxx = np.zeros((k1-k0, l1-l0))
+            syy = np.zeros((k1-k0, l1-l0))
+            for p0 in range(0, npix, pstep):
+                p1 = min(p0+pstep, npix)
+                xx = flux[k0:k1, p0:p1]
+                yy = flux[l0:l1, p0:p1]
+                weight = ferr[k0:k1, None, p0:p1]**2 + ferr[None, l0:l1, p0:p1]**2
+                np.reciprocal(weight, out=weight)
+                xy = xx[:, None, :]*yy[None, :, :]
+                sxy += np.einsum('ijk,ijk->ij', xy, weight)
+                # we need x and y to have the same sign
+                xy[xy < 0] = 1E-10
+                sxypos += np.einsum('ijk,ijk->ij', xy, weight)
+                sxx += np.einsum('ik,ijk->ij', xx**2, weight)
+                syy += np.einsum('jk,ijk->ij', yy**2, weight)
+            amp1 = sxypos / sxx
+            #- sum(weight*(amp1*x - y)**2) expanded into weighted sums
+            chi2[k0-i0:k1-i0, l0-j0:l1-j0] = amp1**2*sxx - 2*amp1*sxy + syy
+            amp[k0-i0:k1-i0, l0-j0:l1-j0] = amp1
+
+    return chi2, amp
+
+def _normalize(flux, ferr=None):
+    """Returns (flux, ferr, rescale) normalized to sum(flux**2) = npix."""
+    npix = flux.shape[1]
+    flux = flux.astype('f8')
+    rescale = np.sqrt(npix/np.sum(flux**2,axis=1))
+    flux *= rescale[:,None]
+    if ferr is not None:
+        ferr = ferr.astype('f8')
+        ferr *= rescale[:,None]
+
+    return flux, ferr, rescale
+
+def _blocks(nspec, blocksize, symmetric):
+    """Returns list of (i0, i1, j0, j1) blocks, upper triangle only if symmetric."""
+    starts = list(range(0, nspec, blocksize))
+    blocks = list()
+    for i0 in starts:
+        for j0 in starts:
+            if j0 >= i0 or not symmetric:
+                blocks.append((i0, min(i0+blocksize, nspec), j0, min(j0+blocksize, nspec)))
+    return blocks
+
+def _map_blocks(func, blocks, nthreads=None):
+    """Calls func on every block in a pool of nthreads threads."""
+    from concurrent.futures import ThreadPoolExecutor
+    if nthreads is None:
+        nthreads = min(8, len(blocks))
+
+    if nthreads > 1:
+        with ThreadPoolExecutor(nthreads) as pool:
+            return list(pool.map(func, blocks))
+    else:
+        return [func(block) for block in blocks]
+
+def compute_chi2(flux, ferr=None, blocksize=1000, outdir=None, nthreads=None):
     """Compute the chi2 distance matrix.
 
+    The matrix is computed in [blocksize, blocksize] blocks in parallel
+    threads.  Without errors each block is a matrix product of the normalized
+    spectra and only the upper triangle is computed; the weighted case is
+    vectorized over tiles of each block.
+
     Parameters
     ----------
     flux : numpy.ndarray
@@ -24,6 +116,14 @@ def compute_chi2(flux, ferr=None):
         spectra and Npix is the number of pixels.
     ferr : numpy.ndarray
         Uncertainty spectra ccorresponding to flux (default None).
+    blocksize : int
+        Number of spectra per block of the chi2 matrix (default 1000).
+    outdir : str
+        If not None, write chi2 and amp to memory-mapped chi2.npy and amp.npy
+        files in this directory instead of holding them in memory, e.g. for
+        Nspec > 50000 (default None).
+    nthreads : int
+        Number of threads computing blocks (default min(8, number of blocks)).
 
     Returns
     -------
@@ -34,55 +134,173 @@ def compute_chi2(flux, ferr=None):
             Amplitude matrix [Nspec, Nspec] between all combinations of spectra.
 
     """
-
     nspec, npix = flux.shape
-    chi2 = np.zeros((nspec, nspec), dtype='f4')
-    amp = np.zeros((nspec, nspec), dtype='f4')
+    if outdir is None:
+        chi2 = np.zeros((nspec, nspec), dtype='f4')
+        amp = np.zeros((nspec, nspec), dtype='f4')
+    else:
+        os.makedirs(outdir, exist_ok=True)
+        chi2 = np.lib.format.open_memmap(os.path.join(outdir, 'chi2.npy'),
+                                         mode='w+', dtype='f4', shape=(nspec, nspec))
+        amp = np.lib.format.open_memmap(os.path.join(outdir, 'amp.npy'),
+                                        mode='w+', dtype='f4', shape=(nspec, nspec))
 
-    flux = flux.copy()
-    rescale = np.sqrt(npix/np.sum(flux**2,axis=1))
-    flux *= rescale[:,None]
+    flux, ferr, rescale = _normalize(flux, ferr)
+
+    def _compute(block):
+        i0, i1, j0, j1 = block
+        if j0 == i0:
+            log.info('Computing chi2 matrix for spectra {}-{} out of {}.'.format(
+                i0, i1-1, nspec))
+        chi2blk, ampblk = _chi2_block(flux, ferr, i0, i1, j0, j1)
+        chi2[i0:i1, j0:j1] = chi2blk
+        amp[i0:i1, j0:j1] = ampblk * (rescale[i0:i1, None] / rescale[None, j0:j1])
+        #- without errors the matrix is symmetric; fill in the lower triangle
+        if ferr is None and j0 != i0:
+            chi2[j0:j1, i0:i1] = chi2blk.T
+            amp[j0:j1, i0:i1] = ampblk.T * (rescale[j0:j1, None] / rescale[None, i0:i1])
+
+    _map_blocks(_compute, _blocks(nspec, blocksize, ferr is None), nthreads)
 
-    if ferr is None:
-        for ii in range(nspec):
-            if ii % 500 == 0:
-                log.info('Computing chi2 matrix for spectra {}-{} out of {}.'.format(
-                    int(ii/500) * 500, np.min(((ii+1) * int(ii/500), nspec-1)), nspec))
-            amp1 = np.sum(flux[ii]*flux,axis=1)/npix
-            chi2[ii,:] = npix*(1.-amp1**2)
-            amp[ii,:] = amp1
-    else:
-        from SetCoverPy import mathutils
-        ferr = ferr.copy()
-        ferr *= rescale[:,None]
-        for ii in range(nspec):
-            if ii % 500 == 0 or ii == 0:
-                log.info('Computing chi2 matrix for spectra {}-{} out of {}.'.format(
-                    int(ii/500) * 500, np.min(((ii+1) * int(ii/500), nspec-1)), nspec))
-            xx = flux[ii, :].reshape(1, npix)
-            xxerr = ferr[ii, :].reshape(1, npix)
-            amp[ii,:], chi2[ii,:] = mathutils.quick_amplitude(xx, flux, xxerr, ferr, niter=1)
-
-    amp *= rescale[:,None]/rescale[None,:]
     np.fill_diagonal(chi2,0.)
     np.fill_diagonal(amp,1.)
+    if outdir is not None:
+        chi2.flush()
+        amp.flush()
 
     return chi2, amp
 
+def compute_adjacency(flux, ferr=None, chi2_thresh=0.1, blocksize=1000, nthreads=None):
+    """Compute the sparse thresholded adjacency matrix chi2 <= chi2_thresh.
+
+    The chi2 matrix is computed block by block as in compute_chi2() and only
+    the pairs below threshold are kept, so the dense [Nspec, Nspec] chi2 matrix
+    is never held in memory.
+
+    Parameters
+    ----------
+    flux : numpy.ndarray
+        Array [Nspec, Npix] of spectra or templates.
+    ferr : numpy.ndarray
+        Uncertainty spectra ccorresponding to flux (default None).
+    chi2_thresh : float
+        Threshold chi2 value to differentiate "different" templates.
+    blocksize : int
+        Number of spectra per block of the chi2 matrix (default 1000).
+    nthreads : int
+        Number of threads computing blocks (default min(8, number of blocks)).
+
+    Returns
+    -------
+    a_matrix : scipy.sparse.csc_matrix
+        Boolean [Nspec, Nspec] matrix, True where chi2 <= chi2_thresh.
+
+    """
+    from scipy import sparse
+
+    nspec, npix = flux.shape
+    flux, ferr, rescale = _normalize(flux, ferr)
+
+    def _compute(block):
+        i0, i1, j0, j1 = block
+        if j0 == i0:
+            log.info('Computing chi2 adjacency for spectra {}-{} out of {}.'.format(
+                i0, i1-1, nspec))
+        chi2blk = _chi2_block(flux, ferr, i0, i1, j0, j1)[0].astype('f4')
+        if j0 == i0:
+            np.fill_diagonal(chi2blk, 0.)
+        ii, jj = np.nonzero(chi2blk <= chi2_thresh)
+        ii += i0
+        jj += j0
+        #- without errors the matrix is symmetric; add the lower triangle
+        if ferr is None and j0 != i0:
+            ii, jj = np.concatenate([ii, jj]), np.concatenate([jj, ii])
+        return ii, jj
+
+    results = _map_blocks(_compute, _blocks(nspec, blocksize, ferr is None), nthreads)
+    ii = np.concatenate([x[0] for x in results])
+    jj = np.concatenate([x[1] for x in results])
+    a_matrix = sparse.csc_matrix((np.ones(len(ii), dtype=bool), (ii, jj)),
+                                 shape=(nspec, nspec))
+
+    return a_matrix
+
+def _greedy_set_cover(a_matrix):
+    """Greedy uniform-cost set cover of the rows of sparse a_matrix by its columns."""
+    a_csc = a_matrix.tocsc()
+    a_csr = a_matrix.tocsr()
+    uncovered = np.ones(a_matrix.shape[0], dtype=bool)
+    ncover = np.diff(a_csc.indptr)   # uncovered rows covered by each column
+    iarch = list()
+    while np.any(uncovered):
+        this = np.argmax(ncover)
+        if ncover[this] == 0:
+            raise ValueError('{} rows are not covered by any column, e.g. '
+                             'rows {}'.format(np.count_nonzero(uncovered),
+                                              np.where(uncovered)[0][:5]))
+        rows = a_csc.indices[a_csc.indptr[this]:a_csc.indptr[this+1]]
+        rows = rows[uncovered[rows]]
+        uncovered[rows] = False
+        iarch.append(this)
+        np.subtract.at(ncover, a_csr[rows].indices, 1)
+
+    return np.sort(iarch)
+
 class ArcheTypes(object):
     """Object for generating archetypes and determining their responsibility.
 
     Parameters
     ----------
     chi2 : numpy.ndarray
-        Chi^2 matrix computed by desisim.archetypes.compute_chi2().
+        Chi^2 matrix computed by desisim.archetypes.compute_chi2(); may be
+        memory-mapped since it is thresholded in blocks of rows.
+    adjacency : scipy.sparse matrix
+        Precomputed thresholded adjacency matrix from
+        desisim.archetypes.compute_adjacency(), used instead of chi2.
     
     """
-    def __init__(self, chi2):
+    def __init__(self, chi2=None, adjacency=None):
+
+        if chi2 is None and adjacency is None:
+            raise ValueError('Must provide either chi2 or adjacency')
 
         self.chi2 = chi2
+        self.adjacency = adjacency
+
+    def get_adjacency(self, chi2_thresh=0.1, blocksize=1000):
+        """Return the sparse thresholded adjacency matrix chi2 <= chi2_thresh.
+
+        Parameters
+        ----------
+        chi2_thresh : float
+            Threshold chi2 value; ignored if initialized with an adjacency matrix.
+        blocksize : int
+            Number of rows of the chi2 matrix to threshold at a time.
 
-    def get_archetypes(self, chi2_thresh=0.1, responsibility=False):
+        Returns
+        -------
+        a_matrix : scipy.sparse.csc_matrix
+            Boolean [Nspec, Nspec] matrix, True where chi2 <= chi2_thresh.
+
+        """
+        from scipy import sparse
+
+        if self.adjacency is not None:
+            return sparse.csc_matrix(self.adjacency, dtype=bool)
+
+        nspec = self.chi2.shape[0]
+        rows, cols = list(), list()
+        for i0 in range(0, nspec, blocksize):
+            ii, jj = np.nonzero(np.asarray(self.chi2[i0:i0+blocksize]) <= chi2_thresh)
+            rows.append(ii + i0)
+            cols.append(jj)
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+
+        return sparse.csc_matrix((np.ones(len(rows), dtype=bool), (rows, cols)),
+                                 shape=self.chi2.shape)
+
+    def get_archetypes(self, chi2_thresh=0.1, responsibility=False, solver='setcover'):
         """Solve the SCP problem to get the final set of archetypes and, optionally,
         their responsibility.
 
@@ -91,12 +309,15 @@ class ArcheTypes(object):
 
         Parameters
         ----------
-        chi2 : numpy.ndarray
-            Chi^2 matrix computed by archetypes.compute_chi2().
         chi2_thresh : float
             Threshold chi2 value to differentiate "different" templates.
         responsibility : bool
             If True, then compute and return the responsibility of each archetype. 
+        solver : str
+            'setcover' (default) to use SetCoverPy, which densifies the
+            [nspec, nspec] adjacency matrix and raises ValueError if nspec >
+            max_setcover_nspec, or 'greedy' for a greedy solution using only
+            the sparse adjacency matrix, for larger samples.
 
         Returns
         -------
@@ -111,16 +332,25 @@ class ArcheTypes(object):
         If responsibility==False then only iarch is returned.
 
         """
-        from SetCoverPy import setcover
+        a_matrix = self.get_adjacency(chi2_thresh)
+
+        if solver == 'setcover':
+            nspec = a_matrix.shape[1]
+            if nspec > max_setcover_nspec:
+                raise ValueError("solver='setcover' needs a dense {0}x{0} adjacency "
+                                 "matrix; use solver='greedy' for more than "
+                                 "max_setcover_nspec={1} spectra".format(
+                                     nspec, max_setcover_nspec))
+            from SetCoverPy import setcover
+            cost = np.ones(nspec) # uniform cost
+            gg = setcover.SetCover(a_matrix.toarray(), cost)
+            sol, time = gg.SolveSCP()
+            iarch = np.nonzero(gg.s)[0]
+        elif solver == 'greedy':
+            iarch = _greedy_set_cover(a_matrix)
+        else:
+            raise ValueError('Unknown solver {}'.format(solver))
 
-        nspec = self.chi2[0].shape
-        cost = np.ones(nspec) # uniform cost
-        
-        a_matrix = (self.chi2 <= chi2_thresh) * 1
-        gg = setcover.SetCover(a_matrix, cost)
-        sol, time = gg.SolveSCP()
-        
-        iarch = np.nonzero(gg.s)[0]
         if responsibility:
             resp, respindx = self.responsibility(iarch, a_matrix)
             return iarch, resp, respindx
@@ -136,7 +366,7 @@ class ArcheTypes(object):
         Parameters
         ----------
             iarch : indices of the archetypes
-            a_matrix : distance matrix
+            a_matrix : adjacency matrix, dense or scipy.sparse
         
         Returns
         -------
@@ -144,14 +374,22 @@ class ArcheTypes(object):
           respindx : list containing the indices of the parent objects represented by each archetype
     
         """
+        from scipy import sparse
+
         narch = len(iarch)
         resp = np.zeros(narch).astype('int16')
         respindx = []
 
-        for ii, this in enumerate(iarch):
-            respindx.append(np.where(a_matrix[:, this] == 1)[0])
-            resp[ii] = np.count_nonzero(a_matrix[:, this])
+        if sparse.issparse(a_matrix):
+            a_csc = sparse.csc_matrix(a_matrix)
+            a_csc.eliminate_zeros()
+            a_csc.sort_indices()
+            for ii, this in enumerate(iarch):
+                respindx.append(a_csc.indices[a_csc.indptr[this]:a_csc.indptr[this+1]].copy())
+                resp[ii] = len(respindx[-1])
+        else:
+            for ii, this in enumerate(iarch):
+                respindx.append(np.where(a_matrix[:, this] == 1)[0])
+                resp[ii] = np.count_nonzero(a_matrix[:, this])
             
         return resp, respindx
-
-
@@ -18,3 +18,18 @@ except TypeError:
     # because the astropy.cosmology module is mocked up.
     #
     pass
+
+#- Cached cosmologies keyed by (H0, Om0)
+_cosmologies = dict()
+
+def get_lcdm(H0=70.0, Om0=0.3):
+    """
+    Returns a cached astropy FlatLambdaCDM cosmology
+
+    The default (H0=70, Om0=0.3) is the cosmology used for simulated sources,
+    e.g. BGS angular sizes in desisim.simexp and QSO templates.
+    """
+    key = (float(H0), float(Om0))
+    if key not in _cosmologies:
+        _cosmologies[key] = astropy.cosmology.FlatLambdaCDM(H0=H0, Om0=Om0)
+    return _cosmologies[key]
@@ -0,0 +1,327 @@
+'''
+desisim.fiberloss
+=================
+
+Interpolated fiber acceptance fractions for point, disk and bulge sources.
+
+A grid of fiber acceptance fractions is computed once with GalSim (see
+build_fiberloss_grid) over seeing FWHM, focal plane radius and wavelength,
+and for the disk and bulge profiles also over half light radius and
+minor/major axis ratio.  Since the acceptance of a source is linear in the
+flux fractions of its components, the acceptance of any disk+bulge+point
+mixture is then obtained by interpolating in these grids, at a cost
+comparable to the specsim ``fastsim`` fiberloss method.
+
+Use fiberloss_method='grid' in desisim.simexp.simulate_spectra, with
+$DESISIM_FIBERLOSS_GRID set to a grid written by build_fiberloss_grid.
+'''
+
+from __future__ import absolute_import, division, print_function
+
+import os
+
+import numpy as np
+import astropy.units as u
+
+from desiutil.log import get_logger
+
+#- Cached FiberlossGrid objects keyed by filename
+_grids = dict()
+
+#- Axes of the tabulated grids; DISK and BULGE have all axes, POINT has
+#- no HLR and AXISRATIO axes
+_axes = ('HLR', 'AXISRATIO', 'SEEING', 'RADIUS', 'WAVE')
+_profiles = ('POINT', 'DISK', 'BULGE')
+
+def default_grid_filename():
+    '''
+    Returns the filename of the fiberloss grid, $DESISIM_FIBERLOSS_GRID
+
+    No grid is shipped with desisim since it depends upon the instrument
+    model in $DESIMODEL; create one with build_fiberloss_grid.
+    '''
+    if 'DESISIM_FIBERLOSS_GRID' not in os.environ:
+        raise KeyError('$DESISIM_FIBERLOSS_GRID not set; create a fiberloss '
+                       'grid with desisim.fiberloss.build_fiberloss_grid')
+    return os.environ['DESISIM_FIBERLOSS_GRID']
+
+class FiberlossGrid(object):
+    '''
+    Interpolator of tabulated fiber acceptance fractions
+
+    Args:
+        axes: dict with 1D increasing arrays HLR (arcsec), AXISRATIO,
+            SEEING (FWHM arcsec at each wavelength), RADIUS (focal plane
+            radius, mm) and WAVE (Angstrom)
+        point: 3D[nseeing, nradius, nwave] acceptance of point sources
+        disk: 5D[nhlr, naxisratio, nseeing, nradius, nwave] acceptance of
+            exponential disk profiles
+        bulge: same as disk, for de Vaucouleurs bulge profiles
+
+    Inputs outside of the grid are clipped to its edges.
+    '''
+    def __init__(self, axes, point, disk, bulge):
+        from scipy.interpolate import RegularGridInterpolator
+
+        self.axes = dict()
+        for name in _axes:
+            self.axes[name] = np.asarray(axes[name], dtype=float)
+            if np.any(np.diff(self.axes[name]) <= 0):
+                raise ValueError('{} axis must be increasing'.format(name))
+
+        self.point = np.asarray(point)
+        self.disk = np.asarray(disk)
+        self.bulge = np.asarray(bulge)
+
+        shape = tuple([len(self.axes[name]) for name in _axes])
+        if self.point.shape != shape[2:]:
+            raise ValueError('POINT shape {} != {}'.format(
+                self.point.shape, shape[2:]))
+        for name, values in [('DISK', self.disk), ('BULGE', self.bulge)]:
+            if values.shape != shape:
+                raise ValueError('{} shape {} != {}'.format(
+                    name, values.shape, shape))
+
+        grid = tuple([self.axes[name] for name in _axes])
+        self._point = RegularGridInterpolator(grid[2:], self.point)
+        self._disk = RegularGridInterpolator(grid, self.disk)
+        self._bulge = RegularGridInterpolator(grid, self.bulge)
+
+    def _points(self, names, values):
+        '''
+        Stacks broadcast values along the last axis, clipped to the grid
+        '''
+        values = np.broadcast_arrays(*values)
+        points = np.empty(values[0].shape + (len(names),))
+        for i, (name, x) in enumerate(zip(names, values)):
+            axis = self.axes[name]
+            points[..., i] = np.clip(x, axis[0], axis[-1])
+        return points
+
+    def acceptance(self, seeing_fwhm, focal_r, wave, source_fraction=None,
+                   source_half_light_radius=None,
+                   source_minor_major_axis_ratio=None):
+        '''
+        Returns interpolated fiber acceptance fractions
+
+        Args:
+            seeing_fwhm: 1D[nwave] seeing FWHM in arcsec at each wavelength
+            focal_r: 1D[nfibers] focal plane radius in mm
+            wave: 1D[nwave] wavelengths in Angstrom
+
+        Options:
+            source_fraction: 2D[nfibers, 2] disk and bulge flux fractions;
+                the remainder is a point source.  Default all point sources.
+            source_half_light_radius: 2D[nfibers, 2] disk and bulge half
+                light radii in arcsec
+            source_minor_major_axis_ratio: 2D[nfibers, 2] disk and bulge
+                minor/major axis ratios; default 1
+
+        Returns 2D[nfibers, nwave] acceptance fractions
+        '''
+        seeing_fwhm = np.asarray(seeing_fwhm, dtype=float)
+        focal_r = np.atleast_1d(np.asarray(focal_r, dtype=float))
+        wave = np.asarray(wave, dtype=float)
+        nfibers, nwave = len(focal_r), len(wave)
+        if seeing_fwhm.shape != (nwave,):
+            raise ValueError('seeing_fwhm must have the same length as wave')
+
+        if source_fraction is None:
+            source_fraction = np.zeros((nfibers, 2))
+        if source_half_light_radius is None:
+            source_half_light_radius = np.zeros((nfibers, 2))
+        if source_minor_major_axis_ratio is None:
+            source_minor_major_axis_ratio = np.ones((nfibers, 2))
+        for x in (source_fraction, source_half_light_radius,
+                  source_minor_major_axis_ratio):
+            if np.shape(x) != (nfibers, 2):
+                raise ValueError('source parameters must have shape {}'.format(
+                    (nfibers, 2)))
+
+        r = focal_r[:, np.newaxis]
+        point = self._point(self._points(('SEEING', 'RADIUS', 'WAVE'),
+                                         (seeing_fwhm, r, wave)))
+        point_fraction = 1 - np.sum(source_fraction, axis=1)
+        acceptance = point_fraction[:, np.newaxis] * point
+
+        #- Only interpolate extended profiles for fibers that have them
+        for i, interpolator in enumerate([self._disk, self._bulge]):
+            ii = source_fraction[:, i] > 0
+            if not np.any(ii):
+                continue
+            hlr = source_half_light_radius[ii, i, np.newaxis]
+            q = source_minor_major_axis_ratio[ii, i, np.newaxis]
+            values = interpolator(self._points(_axes,
+                (hlr, q, seeing_fwhm, r[ii], wave)))
+            acceptance[ii] += source_fraction[ii, i, np.newaxis] * values
+
+        return acceptance
+
+    def write(self, filename, header=None):
+        '''
+        Writes the grid to a FITS file with an image HDU per profile and
+        per axis
+
+        Args:
+            filename: output FITS filename
+            header (dict-like, optional): keywords for the primary header
+        '''
+        from astropy.io import fits
+        hx = fits.HDUList()
+        hdr = fits.Header()
+        if header is not None:
+            for key, value in dict(header).items():
+                hdr[key] = value
+        hx.append(fits.PrimaryHDU(None, header=hdr))
+        for name, values in zip(_profiles, (self.point, self.disk, self.bulge)):
+            hx.append(fits.ImageHDU(values.astype(np.float32), name=name))
+        for name in _axes:
+            hx.append(fits.ImageHDU(self.axes[name], name=name))
+        hx.writeto(filename, overwrite=True)
+
+    @classmethod
+    def read(cls, filename):
+        '''
+        Returns FiberlossGrid read from a FITS file written by write()
+        '''
+        from astropy.io import fits
+        with fits.open(filename, memmap=False) as fx:
+            axes = dict([(name, fx[name].data.astype(float)) for name in _axes])
+            point, disk, bulge = [fx[name].data.astype(float)
+                                  for name in _profiles]
+        return cls(axes, point, disk, bulge)
+
+def get_fiberloss_grid(filename=None):
+    '''
+    Returns cached FiberlossGrid read from filename, default
+    default_grid_filename()
+    '''
+    if filename is None:
+        filename = default_grid_filename()
+
+    if filename not in _grids:
+        if not os.path.exists(filename):
+            raise IOError('Missing fiberloss grid {}; create it with '
+                          'desisim.fiberloss.build_fiberloss_grid'.format(filename))
+        get_logger().debug('Reading fiberloss grid {}'.format(filename))
+        _grids[filename] = FiberlossGrid.read(filename)
+
+    return _grids[filename]
+
+def calculate_fiber_acceptance_fraction(focal_x, focal_y, wavelength,
+        atmosphere, instrument, source_fraction=None,
+        source_half_light_radius=None, source_minor_major_axis_ratio=None,
+        filename=None):
+    '''
+    Interpolates fiber acceptance fractions for a specsim simulation
+
+    Args:
+        focal_x, focal_y: 1D[nfibers] Quantity focal plane positions
+        wavelength: 1D[nwave] Quantity simulation wavelength grid
+        atmosphere: specsim.atmosphere.Atmosphere object
+        instrument: specsim.instrument.Instrument object
+
+    Options:
+        source_fraction, source_half_light_radius,
+        source_minor_major_axis_ratio: see FiberlossGrid.acceptance
+        filename: fiberloss grid filename, see get_fiberloss_grid
+
+    Returns 2D[nfibers, nwave] acceptance fractions, like
+    specsim.fiberloss.calculate_fiber_acceptance_fraction.  As with the
+    specsim methods, the fractions are evaluated on a grid of
+    instrument.fiberloss_num_wlen wavelengths and linearly interpolated
+    to the simulation wavelengths.
+    '''
+    grid = get_fiberloss_grid(filename)
+
+    wave = wavelength.to(u.Angstrom).value
+    wlen_grid = np.linspace(wave[0], wave[-1], instrument.fiberloss_num_wlen)
+    seeing_fwhm = atmosphere.get_seeing_fwhm(wlen_grid * u.Angstrom)
+    focal_r = np.hypot(focal_x.to(u.mm).value, focal_y.to(u.mm).value)
+
+    acceptance = grid.acceptance(seeing_fwhm.to(u.arcsec).value, focal_r,
+        wlen_grid, source_fraction, source_half_light_radius,
+        source_minor_major_axis_ratio)
+
+    return np.array([np.interp(wave, wlen_grid, x) for x in acceptance])
+
+def build_fiberloss_grid(filename, config='desi', seeing=None, radius=None,
+                         wave=None, hlr=None, axis_ratio=None,
+                         oversampling=32):
+    '''
+    Computes a fiberloss grid with GalSim and writes it to filename
+
+    Args:
+        filename: output FITS filename
+
+    Options:
+        config: specsim configuration name
+        seeing: 1D seeing FWHM in arcsec
+        radius: 1D focal plane radii in mm
+        wave: 1D wavelengths in Angstrom
+        hlr: 1D half light radii in arcsec
+        axis_ratio: 1D minor/major axis ratios
+        oversampling: anti-aliasing oversampling of the fiber aperture
+
+    Returns the FiberlossGrid.  Defaults span the range of DESI seeing,
+    focal plane radii and wavelengths, and galaxy sizes up to BGS.
+    Sources are oriented with their major axis along the radial focal plane
+    direction; fiberloss is not tabulated as a function of position angle.
+    This requires galsim and takes a while, but only needs to be run once.
+    '''
+    import specsim.simulator
+    from specsim.fiberloss import GalsimFiberlossCalculator
+
+    log = get_logger()
+    if seeing is None:
+        seeing = np.linspace(0.5, 3.0, 11)
+    if radius is None:
+        radius = np.linspace(0, 420, 8)
+    if wave is None:
+        wave = np.linspace(3500, 10000, 14)
+    if hlr is None:
+        hlr = np.array([0.05, 0.2, 0.35, 0.5, 0.75, 1.0, 1.5, 2, 3, 5, 7.5])
+    if axis_ratio is None:
+        axis_ratio = np.array([0.2, 0.4, 0.6, 0.8, 1.0])
+    axes = dict(HLR=hlr, AXISRATIO=axis_ratio, SEEING=seeing, RADIUS=radius,
+                WAVE=wave)
+
+    qsim = specsim.simulator.Simulator(config, num_fibers=1)
+    instrument = qsim.instrument
+    radius = np.asarray(radius, dtype=float)
+    scale, blur, offset = instrument.get_focal_plane_optics(
+        radius * u.mm, np.zeros(len(radius)) * u.mm, wave * u.Angstrom)
+    scale = scale.to(u.um / u.arcsec).value
+    blur = blur.to(u.um).value
+    offset = offset.to(u.um).value
+
+    calc = GalsimFiberlossCalculator(
+        instrument.fiber_diameter.to(u.um).value, wave,
+        instrument.fiberloss_num_pixels, oversampling,
+        qsim.atmosphere.seeing_moffat_beta)
+
+    nr = len(radius)
+    def _calculate(fwhm, fraction, size, q):
+        return calc.calculate(np.full(len(wave), fwhm), scale, offset, blur,
+            np.tile(fraction, (nr, 1)), np.tile(size, (nr, 1)),
+            np.tile(q, (nr, 1)), np.zeros((nr, 2)))
+
+    shape = tuple([len(axes[name]) for name in _axes])
+    point = np.zeros(shape[2:])
+    disk = np.zeros(shape)
+    bulge = np.zeros(shape)
+    for k, fwhm in enumerate(seeing):
+        log.info('Computing fiberloss for seeing {:.2f} arcsec'.format(fwhm))
+        point[k] = _calculate(fwhm, [0., 0.], [1., 1.], [1., 1.])
+        for i, size in enumerate(hlr):
+            for j, q in enumerate(axis_ratio):
+                disk[i, j, k] = _calculate(fwhm, [1., 0.], [size, 1.], [q, 1.])
+                bulge[i, j, k] = _calculate(fwhm, [0., 1.], [1., size], [1., q])
+
+    grid = FiberlossGrid(axes, point, disk, bulge)
+    header = dict(CONFIG=config, MOFFATB=qsim.atmosphere.seeing_moffat_beta,
+                  OVERSAMP=oversampling)
+    grid.write(filename, header=header)
+    log.info('Wrote {}'.format(filename))
+
+    return grid
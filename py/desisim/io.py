@@ -95,7 +95,8 @@ def findfile(filetype, night, expid, camera=None, outdir=None, mkdir=True):
 #- simspec
 
 def write_simspec(sim, truth, fibermap, obs, expid, night, objmeta=None,
-                  outdir=None, filename=None, header=None, overwrite=False):
+                  outdir=None, filename=None, header=None, overwrite=False,
+                  phot='full', compress='RICE', qlevel=16):
     '''
     Write a simspec file
 
@@ -113,9 +114,23 @@ def write_simspec(sim, truth, fibermap, obs, expid, night, objmeta=None,
         filename (str, optional): if None, auto-derive from envvars, night, expid, and outdir
         header (dict-like): header to include in HDU0
         overwrite (bool, optional): overwrite pre-existing files
+        phot (str, optional): layout of the per-camera photon HDUs;
+            'full' writes PHOT_X and SKYPHOT_X images, 'compress' writes them
+            tile-compressed, and 'none' skips them in favor of a FIBERFLUX
+            image and 1D PHOTCAL_X calibration vectors from which
+            :func:`read_simspec` derives them
+        compress (str, optional): 'RICE' or 'GZIP' tile compression used
+            with phot='compress'
+        qlevel (float, optional): quantization level for phot='compress'
+
+    Returns:
+        output filename
 
     Notes:
         Calibration exposures can use ``truth=None`` and ``obs=None``.
+        phot='none' is only supported for simulations without camera_output
+        (psfconvolve=False) since otherwise the per-camera photons are
+        resolution convolved.
     '''
     import astropy.table
     import astropy.units as u
@@ -171,58 +186,99 @@ def write_simspec(sim, truth, fibermap, obs, expid, night, objmeta=None,
         if truth is None:
             raise ValueError('truth Table must be included for science exposures')
 
-    hx = fits.HDUList()
+    if phot not in ('full', 'compress', 'none'):
+        raise ValueError("phot must be 'full', 'compress', or 'none', not {}".format(phot))
+    if phot == 'none' and sim.camera_output:
+        #- with camera_output the per-camera photons are resolution convolved
+        raise ValueError("phot='none' requires a simulation without camera_output (psfconvolve=False)")
+
     header['EXTNAME'] = 'WAVE'
     header['BUNIT'] = 'Angstrom'
     header['AIRORVAC']  = ('vac', 'Vacuum wavelengths')
 
     wave = sim.simulated['wavelength'].to('Angstrom').value
-    hx.append(fits.PrimaryHDU(wave, header=header))
-
+    nwave = wave.shape[0]
     fluxunits = 1e-17 * u.erg / (u.s * u.cm**2 * u.Angstrom)
-    flux32 = sim.simulated['source_flux'].to(fluxunits).astype(np.float32).value.T
-    nspec = flux32.shape[0]
-    assert flux32.shape == (nspec, wave.shape[0])
-    hdu_flux = fits.ImageHDU(flux32, name='FLUX')
-    hdu_flux.header['BUNIT'] = str(fluxunits)
-    hx.append(hdu_flux)
-
-    #- sky_fiber_flux is not flux per fiber area, it is normal flux density
-    skyflux32 = sim.simulated['sky_fiber_flux'].to(fluxunits).astype(np.float32).value.T
-    assert skyflux32.shape == (nspec, wave.shape[0])
-    hdu_skyflux = fits.ImageHDU(skyflux32, name='SKYFLUX')
-    hdu_skyflux.header['BUNIT'] = str(fluxunits)
-    hx.append(hdu_skyflux)
-
-    #- DEPRECATE?  per-camera photons (derivable from flux and throughput)
-    for i, camera in enumerate(sim.camera_names):
-        wavemin = sim.instrument.cameras[i].wavelength_min.to('Angstrom').value
-        wavemax = sim.instrument.cameras[i].wavelength_max.to('Angstrom').value
-        ii = (wavemin <= wave) & (wave <= wavemax)
-        hx.append(fits.ImageHDU(wave[ii], name='WAVE_'+camera.upper()))
-
-        phot32 = sim.simulated['num_source_electrons_'+camera][ii].astype(np.float32).T
-
-        assert phot32.shape == (nspec, wave[ii].shape[0])
-        hdu_phot = fits.ImageHDU(phot32, name='PHOT_'+camera.upper())
-        hdu_phot.header['BUNIT'] = 'photon'
-        hx.append(hdu_phot)
+    nspec = len(sim.simulated['source_flux'][0])
+
+    if truth is not None:
+        assert len(truth) == nspec
+    assert len(fibermap) == nspec
 
-        skyphot32 = sim.simulated['num_sky_electrons_'+camera][ii].astype(np.float32).T
-        assert skyphot32.shape == (nspec, wave[ii].shape[0])
-        hdu_skyphot = fits.ImageHDU(skyphot32, name='SKYPHOT_'+camera.upper())
-        hdu_skyphot.header['BUNIT'] = 'photon'
-        hx.append(hdu_skyphot)
+    tmpfilename = filename + '.tmp'
+    if not overwrite and os.path.exists(filename):
+        raise IOError('{} already exists; use overwrite=True'.format(filename))
+
+    #- Image HDUs are streamed one at a time with fitsio, converting units
+    #- by a scalar factor directly into float32 arrays
+    with fitsio.FITS(tmpfilename, 'rw', clobber=True) as fx:
+        fx.write(wave, header=_fitsio_header(header))
+        fx[0].write_key('EXTNAME', 'WAVE')
+
+        flux32 = _to_float32(sim.simulated['source_flux'], fluxunits)
+        assert flux32.shape == (nspec, nwave)
+        fx.write(flux32, extname='FLUX', header=dict(BUNIT=str(fluxunits)))
+        del flux32
+
+        #- sky_fiber_flux is not flux per fiber area, it is normal flux density
+        skyflux32 = _to_float32(sim.simulated['sky_fiber_flux'], fluxunits)
+        assert skyflux32.shape == (nspec, nwave)
+        fx.write(skyflux32, extname='SKYFLUX', header=dict(BUNIT=str(fluxunits)))
+        del skyflux32
+
+        #- Flux through the fiber and atmosphere, from which read_simspec
+        #- derives the per-camera photons
+        if phot == 'none':
+            fiberflux32 = _to_float32(sim.simulated['source_fiber_flux'], fluxunits)
+            assert fiberflux32.shape == (nspec, nwave)
+            fx.write(fiberflux32, extname='FIBERFLUX',
+                     header=dict(BUNIT=str(fluxunits)))
+            del fiberflux32
+
+            exptime = sim.observation.exposure_time.to('s').value
+            photons_per_bin = sim.instrument.photons_per_bin
+            calscale = (fluxunits * photons_per_bin.unit * u.s).to(1) * exptime
+
+        #- per-camera photons (derivable from flux and throughput)
+        if phot == 'compress':
+            compress_kwargs = dict(compress=compress, qlevel=qlevel)
+        else:
+            compress_kwargs = dict()
+
+        for i, camera in enumerate(sim.camera_names):
+            wavemin = sim.instrument.cameras[i].wavelength_min.to('Angstrom').value
+            wavemax = sim.instrument.cameras[i].wavelength_max.to('Angstrom').value
+            ii = (wavemin <= wave) & (wave <= wavemax)
+            fx.write(wave[ii], extname='WAVE_'+camera.upper())
+
+            if phot == 'none':
+                #- fiberflux/skyflux [fluxunits] * PHOTCAL = photons per bin
+                throughput = sim.instrument.cameras[i].throughput[ii]
+                photcal = calscale * photons_per_bin.value[ii] * throughput
+                fx.write(photcal, extname='PHOTCAL_'+camera.upper())
+                continue
+
+            phot32 = _to_float32(sim.simulated['num_source_electrons_'+camera], rows=ii)
+            assert phot32.shape == (nspec, wave[ii].shape[0])
+            fx.write(phot32, extname='PHOT_'+camera.upper(),
+                     header=dict(BUNIT='photon'), **compress_kwargs)
+
+            skyphot32 = _to_float32(sim.simulated['num_sky_electrons_'+camera], rows=ii)
+            assert skyphot32.shape == (nspec, wave[ii].shape[0])
+            fx.write(skyphot32, extname='SKYPHOT_'+camera.upper(),
+                     header=dict(BUNIT='photon'), **compress_kwargs)
+
+    #- Table HDUs are small; append them with astropy to preserve units
+    #- and metadata
+    hx = list()
 
     #- TRUTH HDU: table with truth metadata
     if truth is not None:
-        assert len(truth) == nspec
         truthhdu = fits.table_to_hdu(Table(truth))
         truthhdu.header['EXTNAME'] = 'TRUTH'
         hx.append(truthhdu)
 
     #- FIBERMAP HDU
-    assert len(fibermap) == nspec
     fibermap_hdu = fits.table_to_hdu(Table(fibermap))
     fibermap_hdu.header['EXTNAME'] = 'FIBERMAP'
     hx.append(fibermap_hdu)
@@ -263,13 +319,44 @@ def write_simspec(sim, truth, fibermap, obs, expid, night, objmeta=None,
                     objhdu.header['EXTNAME'] = extname
                     hx.append(objhdu)
 
-    tmpfilename = filename + '.tmp'
-    if not overwrite and os.path.exists(filename):
-        os.rename(filename, tmpfilename)
+    with fits.open(tmpfilename, mode='append') as fx:
+        for hdu in hx:
+            fx.append(hdu)
 
-    hx.writeto(tmpfilename, overwrite=overwrite)
     os.rename(tmpfilename, filename)
     log.info(f'Wrote {filename}')
+    return filename
+
+def _to_float32(column, unit=None, rows=slice(None)):
+    '''
+    Returns [nspec, nwave] float32 transpose of a sim.simulated column
+
+    Args:
+        column: [nwave, nspec] astropy Column or Quantity
+        unit (optional): output unit; the conversion is applied as a
+            single scale factor rather than a full Quantity conversion
+        rows (optional): index or mask of wavelength rows to include
+    '''
+    data = np.asarray(column)[rows].T
+    out = np.empty(data.shape, dtype=np.float32)
+    if unit is None:
+        out[:] = data
+    else:
+        scale = column.unit.to(unit)
+        np.multiply(data, scale, out=out, casting='same_kind')
+
+    return out
+
+def _fitsio_header(header):
+    '''Converts an astropy Header into a list of fitsio header records'''
+    records = list()
+    for card in header.cards:
+        if card.keyword in ('COMMENT', 'HISTORY'):
+            records.append(dict(name=card.keyword, value=str(card.value)))
+        else:
+            records.append(dict(name=card.keyword, value=card.value,
+                                comment=card.comment))
+    return records
 
 def write_simspec_arc(filename, wave, phot, header, fibermap, overwrite=False):
     '''
@@ -447,6 +534,9 @@ def read_simspec(filename, cameras=None, comm=None, readflux=True, readphot=True
         comm: MPI communicator
         readflux: if True (default), include flux
         readphot: if True (default), include per-camera photons
+
+    Files written with ``write_simspec(..., phot='none')`` derive the
+    per-camera photons from the FIBERFLUX, SKYFLUX, and PHOTCAL_X HDUs.
     """
     if comm is not None:
         rank, size = comm.rank, comm.size
@@ -577,11 +667,22 @@ def read_simspec(filename, cameras=None, comm=None, readflux=True, readphot=True
             if camrank == 0:
                 with fits.open(filename, memmap=False) as fx:
                     wave = native_endian(fx['WAVE_'+channel].data.copy())
-                    phot = native_endian(fx['PHOT_'+channel].data[ii].astype('f8'))
-                    if 'SKYPHOT_'+channel in fx:
-                        skyphot = native_endian(fx['SKYPHOT_'+channel].data[ii].astype('f8'))
+                    if 'PHOT_'+channel in fx:
+                        #- full or tile-compressed per-camera photons
+                        phot = native_endian(fx['PHOT_'+channel].data[ii].astype('f8'))
+                        if 'SKYPHOT_'+channel in fx:
+                            skyphot = native_endian(fx['SKYPHOT_'+channel].data[ii].astype('f8'))
+                        else:
+                            skyphot = None
                     else:
-                        skyphot = None
+                        #- derive photons from fiber flux and calibration
+                        fullwave = fx['WAVE'].data
+                        jj = (wave[0] <= fullwave) & (fullwave <= wave[-1])
+                        photcal = native_endian(fx['PHOTCAL_'+channel].data)
+                        phot = fx['FIBERFLUX'].data[ii][:, jj] * photcal
+                        skyphot = fx['SKYFLUX'].data[ii][:, jj] * photcal
+                        phot = native_endian(phot.astype('f8'))
+                        skyphot = native_endian(skyphot.astype('f8'))
 
             if camcomm is not None:
                 wave = camcomm.bcast(wave, root=0)
@@ -626,6 +727,66 @@ def write_simpix(outfile, image, camera, meta):
     hdus.flush()
     hdus.close()
 
+def write_shared_resolution(outfile, resolution):
+    """Append one resolution matrix per band to a spectra file.
+
+    Args:
+        outfile : existing spectra file, written without resolution data
+        resolution : dict of 2D[ndiag, nwave] resolution data keyed by band,
+            shared by all spectra of that band
+
+    HDUs are named e.g. B-RESOLUTION, which desispec.io.read_spectra ignores;
+    use desisim.io.read_spectra to broadcast them to every spectrum.
+    """
+    hdus = fits.open(outfile, mode='append', memmap=False)
+    for band in sorted(resolution.keys()):
+        hdu = fits.ImageHDU(np.asarray(resolution[band], dtype=np.float32),
+                            name='{}-RESOLUTION'.format(band.upper()))
+        hdus.append(hdu)
+    hdus.flush()
+    hdus.close()
+
+def read_spectra(filename, **kwargs):
+    """Read a spectra file, including shared per-band resolution matrices.
+
+    Args:
+        filename : spectra file name
+        kwargs : passed to desispec.io.read_spectra
+
+    Returns desispec.spectra.Spectra object.  If the file was written with
+    write_shared_resolution, resolution_data[band] is a read-only
+    [nspec, ndiag, nwave] broadcast of the shared matrix and every entry of
+    R[band] refers to the same Resolution object.
+    """
+    from desispec.resolution import Resolution
+
+    spectra = desispec.io.read_spectra(filename, **kwargs)
+
+    with fitsio.FITS(filename) as fx:
+        shared = dict()
+        for band in spectra.bands:
+            extname = '{}-RESOLUTION'.format(band.upper())
+            if extname in fx:
+                shared[band] = native_endian(fx[extname].read())
+
+    if len(shared) == 0:
+        return spectra
+
+    if spectra.resolution_data is None:
+        spectra.resolution_data = dict()
+        spectra.R = dict()
+
+    for band, rdata in shared.items():
+        nspec = spectra.flux[band].shape[0]
+        spectra.resolution_data[band] = np.broadcast_to(rdata,
+                                                        (nspec,) + rdata.shape)
+        R = Resolution(rdata)
+        spectra.R[band] = np.empty(nspec, dtype=object)
+        for i in range(nspec):
+            spectra.R[band][i] = R
+
+    return spectra
+
 def load_simspec_summary(indir, verbose=False):
     '''
     Combine fibermap and simspec files under indir into single truth catalog
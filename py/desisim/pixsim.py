@@ -11,6 +11,7 @@ import sys
 import os
 import os.path
 import random
+import time
 from time import asctime
 import socket
 
@@ -24,6 +25,7 @@ from desispec.image import Image
 import desispec.cosmics
 
 from . import obs, io
+import desisim.rng
 from desiutil.log import get_logger
 log = get_logger()
 
@@ -36,7 +38,7 @@ from astropy.time import Time
 
 def simulate_exposure(simspecfile, rawfile, cameras=None,
         ccdshape=None, simpixfile=None, addcosmics=None, comm=None,
-        **kwargs):
+        asyncwrite=True, **kwargs):
     """
     Simulate frames from an exposure, including I/O
 
@@ -50,6 +52,8 @@ def simulate_exposure(simspecfile, rawfile, cameras=None,
         simpixfile: output file for noiseless truth pixels
         addcosmics: if True (must be specified via command input), add cosmics from real data
         comm: MPI communicator object
+        asyncwrite: if True (default), write outputs in a background thread
+            while the next camera is simulated
 
     Additional keyword args are passed to pixsim.simulate()
 
@@ -86,7 +90,7 @@ def simulate_exposure(simspecfile, rawfile, cameras=None,
             cameras = io.fibers2cameras(fibermap['FIBER'])
             log.debug('Found cameras {} in input simspec file'.format(cameras))
             if len(cameras) % num_nodes != 0:
-                raise ValueError('Number of cameras {} should be evenly divisible by number of nodes {}'.format(
+                log.warning('Number of cameras {} is not evenly divisible by number of nodes {}; some nodes will idle'.format(
                     len(cameras), num_nodes))
 
     if comm is not None:
@@ -120,6 +124,15 @@ def simulate_exposure(simspecfile, rawfile, cameras=None,
     if rank == 0:
         log.debug('Reading PSFs at {}'.format(asctime()))
 
+    #- Outputs are written asynchronously while the next camera is simulated;
+    #- with MPI each node writes separate per-camera files instead of taking
+    #- turns writing to the same file
+    tmprawfile = rawfile + '.tmp'
+    writer = None
+    if node_rank == 0:
+        writer = CameraWriter(tmprawfile, simpixfile=simpixfile,
+            percamera=(comm is not None), threaded=asyncwrite)
+
     psfs = dict()
     #need to initialize previous channel
     previous_channel = 'a'
@@ -157,40 +170,419 @@ def simulate_exposure(simspecfile, rawfile, cameras=None,
             log.info("Starting simulate for camera {} on node {}".format(camera,node_index))
         image, rawpix, truepix = simulate(camera, simspec, psf, comm=comm_node, preproc=False, cosmics=cosmics, **kwargs)
 
-        #- Use input communicator as barrier since multiple sub-communicators
-        #- will write to the same output file
-        if rank == 0:
-            log.debug('Writing outputs at {}'.format(asctime()))
+        #- Hand off to the writer and move on to the next camera; with MPI
+        #- each node writes its own per-camera files that are merged below
+        if node_rank == 0:
+            writer.put(camera, rawpix, image.meta, truepix)
 
-        tmprawfile = rawfile + '.tmp'
-        if comm is not None:
-            for i in range(comm.size):
-                if (i == comm.rank) and (comm_node.rank == 0):
-                    desispec.io.write_raw(tmprawfile, rawpix, image.meta,
-                                          camera=camera)
-                    if simpixfile is not None:
-                        io.write_simpix(simpixfile, truepix, camera=camera,
-                                        meta=image.meta)
-                comm.barrier()
-        else:
-            desispec.io.write_raw(tmprawfile, rawpix, image.meta, camera=camera)
-            if simpixfile is not None:
-                io.write_simpix(simpixfile, truepix, camera=camera,
-                                meta=image.meta)
+        previous_channel = channel
 
-        if rank == 0:
-            log.info('Wrote {}'.format(rawfile))
-            log.debug('done at {}'.format(asctime()))
+    #- Wait for outstanding writes; raises if any of them failed
+    if writer is not None:
+        _close_writer(writer, comm)
 
-        previous_channel = channel
+    if comm is not None:
+        comm.barrier()
 
-    #- All done; rename temporary raw file to final location
+    #- All done; merge per-camera files if needed and rename temporary raw
+    #- file to final location
     if comm is None or comm.rank == 0:
+        if comm is not None:
+            log.debug('Merging per-camera outputs at {}'.format(asctime()))
+            merge_camera_files(
+                [camera_tmpfile(tmprawfile, c) for c in cameras], tmprawfile,
+                filename=rawfile)
+            if simpixfile is not None:
+                merge_camera_files(
+                    [camera_tmpfile(simpixfile, c) for c in cameras],
+                    simpixfile)
+
         os.rename(tmprawfile, rawfile)
+        log.info('Wrote {}'.format(rawfile))
+        log.debug('done at {}'.format(asctime()))
+
+
+def simulate_exposures(simspecfiles, rawfiles, cameras, simpixfiles=None,
+        ccdshape=None, addcosmics=None, comm=None, asyncwrite=True,
+        timingfile=None, **kwargs):
+    """
+    Simulate frames from several exposures with dynamic camera scheduling
+
+    Args:
+        simspecfiles: list of input simspec files, one per exposure
+        rawfiles: list of output raw data files, one per exposure
+        cameras: list of cameras to simulate for every exposure
+
+    Options:
+        simpixfiles: list of output files for noiseless truth pixels
+        ccdshape: (npix_y, npix_x) primarily used to limit memory while testing
+        addcosmics: if True, add cosmics from real data
+        comm: MPI communicator object
+        asyncwrite: if True (default), write outputs in a background thread
+            while the next camera is simulated
+        timingfile: if not None, write a table of per-task timing to this file
+
+    Additional keyword args are passed to pixsim.simulate()
+
+    Returns:
+        astropy Table of per-task timing on rank 0 (None on other ranks)
+
+    Every (exposure, camera) pair is an independent task.  The communicator
+    is split by node and each node pulls the next task from a shared queue
+    when it is done with the previous one, so the number of cameras doesn't
+    need to divide evenly by the number of nodes.  While a node is
+    simulating one task, its first rank reads the simspec (and cosmics) for
+    the next one in a background thread.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from astropy.table import Table
+
+    if len(simspecfiles) != len(rawfiles):
+        raise ValueError('simspecfiles and rawfiles must have the same length')
+    if simpixfiles is None:
+        simpixfiles = [None,] * len(rawfiles)
+
+    if comm is not None:
+        rank, size = comm.rank, comm.size
+        comm_node, node_index, num_nodes = mpi_split_by_node(comm, 1)
+        node_rank = comm_node.rank
+    else:
+        log.debug('Not using MPI')
+        rank, size = 0, 1
+        comm_node = None
+        node_index = 0
+        num_nodes = 1
+        node_rank = 0
+
+    tasks = [(i, camera) for i in range(len(rawfiles)) for camera in cameras]
+    ntasks = len(tasks)
+    if rank == 0:
+        log.info('Simulating {} frames from {} exposures on {} nodes at {}'.format(
+            ntasks, len(rawfiles), num_nodes, asctime()))
+
+    #- Only the first rank of each node pulls tasks from the queue
+    queue = TaskCounter(comm)
+
+    psfs = dict()
+    def get_psf(channel):
+        #- Note: current PSF object can't be pickled and thus every
+        #- rank must read it instead of rank 0 read + bcast
+        if channel not in psfs:
+            log.info('Reading {} PSF at {}'.format(channel, asctime()))
+            psfs[channel] = desimodel.io.load_psf(channel)
+            if ccdshape is not None:
+                psfs[channel].npix_y, psfs[channel].npix_x = ccdshape
+        return psfs[channel]
+
+    def prefetch(itask):
+        if itask >= ntasks:
+            return None
+        i, camera = tasks[itask]
+        shape = None
+        if addcosmics is True:
+            psf = get_psf(camera[0])
+            shape = (psf.npix_y, psf.npix_x)
+        return reader.submit(_read_task_inputs, simspecfiles[i], camera,
+            addcosmics=addcosmics, shape=shape)
+
+    reader = None
+    itask = None
+    future = None
+    if node_rank == 0:
+        reader = ThreadPoolExecutor(max_workers=1)
+        itask = queue.next()
+        future = prefetch(itask)
+    if comm_node is not None:
+        itask = comm_node.bcast(itask, root=0)
+
+    timing = list()
+    writer = None
+    writer_iexp = None
+    while itask < ntasks:
+        iexp, camera = tasks[itask]
+        t0 = time.time()
+
+        #- Wait for the inputs of this task and start reading the next one
+        simspec, cosmics, tread = None, None, 0.0
+        nexttask = None
+        if node_rank == 0:
+            simspec, cosmics, tread = future.result()
+            nexttask = queue.next()
+            future = prefetch(nexttask)
+        if comm_node is not None:
+            simspec = comm_node.bcast(simspec, root=0)
+            if addcosmics is True:
+                cosmics = comm_node.bcast(cosmics, root=0)
+        t1 = time.time()
+
+        psf = get_psf(camera[0])
+        image, rawpix, truepix = simulate(camera, simspec, psf, comm=comm_node,
+            preproc=False, cosmics=cosmics, **kwargs)
+        t2 = time.time()
+
+        if node_rank == 0:
+            #- tasks are handed out in order, thus this node is done with
+            #- previous exposures once it gets a task from a new one
+            if iexp != writer_iexp:
+                if writer is not None:
+                    _close_writer(writer, comm)
+                writer = CameraWriter(rawfiles[iexp] + '.tmp',
+                    simpixfile=simpixfiles[iexp], percamera=(comm is not None),
+                    threaded=asyncwrite)
+                writer_iexp = iexp
+            writer.put(camera, rawpix, image.meta, truepix)
+            t3 = time.time()
+
+            timing.append((itask, os.path.basename(rawfiles[iexp]), camera,
+                node_index, t0, tread, t1-t0, t2-t1, t3-t2))
+            log.info('Task {}/{} {} camera {} on node {}: read {:.1f}s (waited {:.1f}s), simulate {:.1f}s, queue output {:.1f}s'.format(
+                itask+1, ntasks, os.path.basename(rawfiles[iexp]), camera,
+                node_index, tread, t1-t0, t2-t1, t3-t2))
+
+        itask = nexttask
+        if comm_node is not None:
+            itask = comm_node.bcast(itask, root=0)
+
+    if writer is not None:
+        _close_writer(writer, comm)
+    if reader is not None:
+        reader.shutdown()
+    queue.free()
+
+    if comm is not None:
+        comm.barrier()
+
+    #- Merge per-camera files and rename temporary raw files; spread the
+    #- exposures across ranks so that the merges run in parallel
+    for iexp in range(rank, len(rawfiles), size):
+        tmprawfile = rawfiles[iexp] + '.tmp'
+        if comm is not None:
+            merge_camera_files(
+                [camera_tmpfile(tmprawfile, c) for c in cameras], tmprawfile,
+                filename=rawfiles[iexp])
+            if simpixfiles[iexp] is not None:
+                merge_camera_files(
+                    [camera_tmpfile(simpixfiles[iexp], c) for c in cameras],
+                    simpixfiles[iexp])
+        os.rename(tmprawfile, rawfiles[iexp])
+        log.info('Wrote {}'.format(rawfiles[iexp]))
+
+    if comm is not None:
+        timing = comm.gather(timing, root=0)
+        comm.barrier()
+    else:
+        timing = [timing,]
+
+    if rank != 0:
+        return None
+
+    rows = sorted([row for rows in timing for row in rows])
+    names = ('TASK', 'RAWFILE', 'CAMERA', 'NODE', 'START',
+             'READ_TIME', 'WAIT_TIME', 'SIMULATE_TIME', 'OUTPUT_TIME')
+    if len(rows) > 0:
+        timing = Table(rows=rows, names=names)
+        timing['START'] -= timing['START'].min()
+    else:
+        timing = Table(names=names)
+    if timingfile is not None:
+        timing.write(timingfile, overwrite=True)
+        log.info('Wrote {}'.format(timingfile))
+
+    return timing
+
+
+def _read_task_inputs(simspecfile, camera, addcosmics=None, shape=None):
+    """
+    Read the simspec and optional cosmics needed to simulate one camera
+
+    Returns (simspec, cosmics, duration) where cosmics is None unless
+    addcosmics is True and duration is the time spent reading
+    """
+    t0 = time.time()
+    simspec = io.read_simspec(simspecfile, cameras=[camera,], readflux=False)
+    cosmics = None
+    if addcosmics is True:
+        cosmics_file = io.find_cosmics(camera, simspec.header['EXPTIME'])
+        log.info('Reading cosmics templates {} at {}'.format(
+            cosmics_file, asctime()))
+        cosmics = io.read_cosmics(cosmics_file, simspec.header['EXPID'],
+            shape=shape)
+    return simspec, cosmics, time.time() - t0
+
+
+def _close_writer(writer, comm=None):
+    """
+    Close a CameraWriter, aborting all MPI ranks if any of its writes failed
+
+    Only node leaders write, so re-raising the error on that rank alone would
+    leave the other ranks waiting forever in the next collective call.
+    """
+    try:
+        writer.close()
+    except Exception:
+        if comm is not None:
+            log.critical('Writing outputs failed; aborting all MPI ranks',
+                         exc_info=True)
+            comm.Abort(1)
+        raise
+
+
+def camera_tmpfile(filename, camera):
+    """
+    Return the temporary per-camera file name used while writing filename
+
+    Args:
+        filename: final output file name
+        camera: e.g. b0, r1, .. z9
+    """
+    return '{}.{}.tmp'.format(filename, camera.lower())
+
+
+def merge_camera_files(infiles, outfile, filename=None):
+    """
+    Merge per-camera FITS files into outfile, removing the inputs
+
+    Args:
+        infiles: list of per-camera input files, in output HDU order
+        outfile: output file; HDUs are appended if it already exists
+
+    Options:
+        filename: if not None, value for the FILENAME keyword of merged HDUs
+
+    The primary HDU of outfile is taken from the first input file if outfile
+    doesn't yet exist.
+    """
+    from astropy.io import fits
+
+    hdus = None
+    if os.path.exists(outfile):
+        hdus = fits.open(outfile, mode='append', memmap=False)
+
+    for infile in infiles:
+        with fits.open(infile, memmap=False) as fx:
+            if hdus is None:
+                hdus = fits.HDUList([fits.PrimaryHDU(None, header=fx[0].header)])
+            for hdu in fx[1:]:
+                if hdu.name in hdus:
+                    hdus.close()
+                    raise ValueError('{} already in {}'.format(hdu.name, outfile))
+                if filename is not None:
+                    hdu.header['FILENAME'] = filename
+                #- force data to be loaded before the input file is closed
+                hdu.data
+                hdus.append(hdu)
+
+    if hdus is None:
+        return
+
+    if os.path.exists(outfile):
+        hdus.flush()
+    else:
+        hdus.writeto(outfile)
+    hdus.close()
+
+    for infile in infiles:
+        os.remove(infile)
+
+
+class CameraWriter(object):
+    """
+    Write simulated raw (and optionally simpix) camera data
+
+    With threaded=True the writes happen in a background thread so that the
+    caller can start simulating the next camera while the previous one is
+    being written.  At most maxqueue cameras wait in the queue in addition to
+    the one being written (double buffering for maxqueue=1).
+
+    Args:
+        rawfile: output raw data file
+        simpixfile (optional): output file for noiseless truth pixels
+
+    Options:
+        percamera: if True, write each camera to its own temporary file
+            camera_tmpfile(filename, camera) to be merged later with
+            merge_camera_files(); required if several writers (e.g. one per
+            MPI node) share the same output files
+        threaded: if True, write in a background thread
+        maxqueue: maximum number of cameras queued for writing
+    """
+    def __init__(self, rawfile, simpixfile=None, percamera=False,
+            threaded=True, maxqueue=1):
+        self.rawfile = rawfile
+        self.simpixfile = simpixfile
+        self.percamera = percamera
+        self._error = None
+        self._thread = None
+        if threaded:
+            import queue
+            import threading
+            self._queue = queue.Queue(maxsize=maxqueue)
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def put(self, camera, rawpix, header, truepix=None):
+        """
+        Write (or queue for writing) rawpix and truepix for camera
+
+        Args:
+            camera: e.g. b0, r1, .. z9
+            rawpix: 2D ndarray of raw pixel data
+            header: header for the raw data HDU
+            truepix (optional): 2D ndarray of noiseless truth pixels
+        """
+        if self._thread is None:
+            self._write(camera, rawpix, header, truepix)
+        else:
+            self._queue.put((camera, rawpix, header, truepix))
+
+    def close(self):
+        """
+        Finish writing all queued cameras
+
+        Raises the first exception encountered by the background writer
+        """
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            #- keep draining the queue after an error so that put() doesn't
+            #- block; the error is raised by close()
+            if self._error is None:
+                try:
+                    self._write(*item)
+                except Exception as err:
+                    log.error('Failed writing camera {}: {}'.format(item[0], err))
+                    self._error = err
+
+    def _write(self, camera, rawpix, header, truepix=None):
+        if self.percamera:
+            rawfile = camera_tmpfile(self.rawfile, camera)
+        else:
+            rawfile = self.rawfile
+
+        log.debug('Writing {} outputs at {}'.format(camera, asctime()))
+        desispec.io.write_raw(rawfile, rawpix, header, camera=camera)
+        if self.simpixfile is not None:
+            if self.percamera:
+                simpixfile = camera_tmpfile(self.simpixfile, camera)
+            else:
+                simpixfile = self.simpixfile
+            io.write_simpix(simpixfile, truepix, camera=camera, meta=header)
+        log.debug('Finished writing {} at {}'.format(camera, asctime()))
 
 
 def simulate(camera, simspec, psf, nspec=None, ncpu=None,
-    cosmics=None, wavemin=None, wavemax=None, preproc=True, comm=None):
+    cosmics=None, wavemin=None, wavemax=None, preproc=True, comm=None,
+    seed=None):
     """Run pixel-level simulation of input spectra
 
     Args:
@@ -205,6 +597,9 @@ def simulate(camera, simspec, psf, nspec=None, ncpu=None,
         wavemin (float): minimum wavelength range to simulate
         wavemax (float): maximum wavelength range to simulate
         preproc (boolean, optional) : also preprocess raw data (default True)
+        seed (int, optional): random seed for the noise; the stream for each
+            (EXPID, camera) is derived from it with desisim.rng.generator.
+            If None (default), the global np.random state is used.
 
     Returns:
         (image, rawpix, truepix) tuple, where image is the preproc Image object
@@ -275,13 +670,21 @@ def simulate(camera, simspec, psf, nspec=None, ncpu=None,
         header['FEEVER'] = 'SIM'
         header['DETECTOR'] = 'SIM'
 
+        #- Noise random numbers
+        if seed is None:
+            noiserand = np.random
+        else:
+            camkey = 'brz'.index(channel)*10 + ispec
+            noiserand = desisim.rng.generator(seed,
+                key=(simspec.header.get('EXPID', 0), camkey))
+
         #- Add cosmics from library of dark images
         ny = truepix.shape[0] // 2
         nx = truepix.shape[1] // 2
         if cosmics is not None:
             # set to zeros values with mask bit 0 (= dead column or hot pixels)
             cosmics_pix = cosmics.pix*((cosmics.mask&1)==0)
-            pix = np.random.poisson(truepix) + cosmics_pix
+            pix = noiserand.poisson(truepix) + cosmics_pix
             try:  #- cosmics templates >= v0.3
                 rdnoiseA = cosmics.meta['OBSRDNA']
                 rdnoiseB = cosmics.meta['OBSRDNB']
@@ -331,28 +734,28 @@ def simulate(camera, simspec, psf, nspec=None, ncpu=None,
             photpix2raw(pix[0:ny, 0:nx], gain, rdnoiseA,
                 readorder='lr', nprescan=nprescan, noverscan=noverscan,
                 offset=rand.uniform(100, 200),
-                noisydata=noisydata)
+                noisydata=noisydata, rand=noiserand)
 
         #- Amp B/2 Lower Right
         rawpix[0:nyraw, nxraw:nxraw+nxraw] = \
             photpix2raw(pix[0:ny, nx:nx+nx], gain, rdnoiseB,
                 readorder='rl', nprescan=nprescan, noverscan=noverscan,
                 offset=rand.uniform(100, 200),
-                noisydata=noisydata)
+                noisydata=noisydata, rand=noiserand)
 
         #- Amp C/3 Upper Left
         rawpix[nyraw:nyraw+nyraw, 0:nxraw] = \
             photpix2raw(pix[ny:ny+ny, 0:nx], gain, rdnoiseC,
                 readorder='lr', nprescan=nprescan, noverscan=noverscan,
                 offset=rand.uniform(100, 200),
-                noisydata=noisydata)
+                noisydata=noisydata, rand=noiserand)
 
         #- Amp D/4 Upper Right
         rawpix[nyraw:nyraw+nyraw, nxraw:nxraw+nxraw] = \
             photpix2raw(pix[ny:ny+ny, nx:nx+nx], gain, rdnoiseD,
                 readorder='rl', nprescan=nprescan, noverscan=noverscan,
                 offset=rand.uniform(100, 200),
-                noisydata=noisydata)
+                noisydata=noisydata, rand=noiserand)
 
         def xyslice2header(xyslice):
             '''
@@ -467,7 +870,7 @@ def simulate(camera, simspec, psf, nspec=None, ncpu=None,
 
 
 def photpix2raw(phot, gain=1.0, readnoise=3.0, offset=None,
-    nprescan=7, noverscan=50, readorder='lr', noisydata=True):
+    nprescan=7, noverscan=50, readorder='lr', noisydata=True, rand=None):
     '''
     Add prescan, overscan, noise, and integerization to an image
 
@@ -483,6 +886,8 @@ def photpix2raw(phot, gain=1.0, readnoise=3.0, offset=None,
             'rl' : add prescan on right and overscan on left of image
         noisydata (boolean, optional) : if True, don't add noise,
             e.g. because input signal already had noise from a cosmics image
+        rand (optional): np.random.Generator or RandomState for the noise;
+            default global np.random
 
     Returns 2D integer ndarray:
         image = int((poisson(phot) + offset + gauss(readnoise))/gain)
@@ -503,21 +908,24 @@ def photpix2raw(phot, gain=1.0, readnoise=3.0, offset=None,
     img = np.zeros((ny, nx), dtype=float)
     img[:, nprescan:nprescan+phot.shape[1]] = phot
 
+    if rand is None:
+        rand = np.random
+
     if offset is None:
-        offset = np.random.uniform(100, 200)
+        offset = rand.uniform(100, 200)
 
     if noisydata:
         #- Data already has noise; just add offset and noise to pre/overscan
         img += offset
-        img[0:ny, 0:nprescan] += np.random.normal(scale=readnoise, size=(ny, nprescan))
+        img[0:ny, 0:nprescan] += rand.normal(scale=readnoise, size=(ny, nprescan))
         ix = phot.shape[1] + nprescan
-        img[0:ny, ix:ix+noverscan] += np.random.normal(scale=readnoise, size=(ny, noverscan))
+        img[0:ny, ix:ix+noverscan] += rand.normal(scale=readnoise, size=(ny, noverscan))
         img /= gain
 
     else:
         #- Add offset and noise to everything
-        noise = np.random.normal(loc=offset, scale=readnoise, size=img.shape)
-        img = np.random.poisson(img) + noise
+        noise = rand.normal(loc=offset, scale=readnoise, size=img.shape)
+        img = rand.poisson(img) + noise
         img /= gain
 
     return img.astype(np.int32)
@@ -765,3 +1173,47 @@ def mpi_split_by_node(comm, nodes_per_communicator):
     comm_node = comm.Split(color = node_index)
 
     return comm_node, node_index, num_nodes
+
+class TaskCounter(object):
+    """
+    Shared counter handing out task indices 0, 1, 2, ... in order
+
+    Args:
+        comm: MPI communicator, or None for a serial counter
+
+    With MPI the counter lives in an RMA window on rank 0 and next() uses an
+    atomic fetch-and-add, so any rank can pull the next task without the
+    other ranks participating.  Creating and freeing the counter are
+    collective over comm.
+    """
+    def __init__(self, comm=None):
+        self._count = 0
+        self._win = None
+        if comm is not None:
+            from mpi4py import MPI
+            self._buf = np.zeros(1, dtype=np.int64)
+            if comm.rank == 0:
+                self._win = MPI.Win.Create(self._buf, disp_unit=self._buf.itemsize, comm=comm)
+            else:
+                self._win = MPI.Win.Create(None, comm=comm)
+            comm.barrier()
+
+    def next(self):
+        """Return the next task index"""
+        if self._win is None:
+            self._count += 1
+            return self._count - 1
+        else:
+            from mpi4py import MPI
+            one = np.ones(1, dtype=np.int64)
+            result = np.zeros(1, dtype=np.int64)
+            self._win.Lock(0)
+            self._win.Fetch_and_op(one, result, 0, 0, MPI.SUM)
+            self._win.Unlock(0)
+            return int(result[0])
+
+    def free(self):
+        """Release the MPI window; collective"""
+        if self._win is not None:
+            self._win.Free()
+            self._win = None
@@ -224,8 +224,8 @@ def desi_qso_templates(z_wind=0.2, zmnx=(0.4,4.), outfil=None, N_perz=500,
 
     # Cosmology
     if cosmo is None:
-        from astropy import cosmology
-        cosmo = cosmology.core.FlatLambdaCDM(70., 0.3)
+        from desisim.cosmology import get_lcdm
+        cosmo = get_lcdm(70., 0.3)
 
     if old_read:
         # PCA values
@@ -10,13 +10,12 @@ from __future__ import absolute_import, division, print_function
 
 import os
 import yaml
-from collections import Counter
 from pkg_resources import resource_filename
 from time import asctime
 
 import numpy as np
-from astropy.io import fits
-from astropy.table import Table, Column, vstack
+import fitsio
+from astropy.table import Table, vstack
 import sys
 import scipy.special as sp
 import desisim
@@ -136,7 +135,7 @@ def get_zeff_obs(simtype, obsconditions):
     return pobs
 
 
-def get_redshift_efficiency(simtype, targets, truth, targets_in_tile, obsconditions, params, ignore_obscondition=False):
+def get_redshift_efficiency(simtype, targets, truth, targets_in_tile, obsconditions, params, ignore_obscondition=False, tile_matches=None):
     """
     Simple model to get the redshift effiency from the observational conditions or observed magnitudes+redshuft
 
@@ -155,6 +154,8 @@ def get_redshift_efficiency(simtype, targets, truth, targets_in_tile, obsconditi
            'SEEING': array of FWHM seeing during spectroscopic observation on a tile.
         parameter_filename: yaml file with quickcat parameters
         ignore_obscondition: if True, no variation of efficiency with obs. conditions (adjustment of exposure time should correct for mean change of S/N)
+        tile_matches: optional precomputed (itarget, itile) from _match_targets_in_tile
+            for these targets and obsconditions['TILEID']
     Returns:
         tuple of arrays (observed, p) both with same length as targets
 
@@ -263,49 +264,78 @@ def get_redshift_efficiency(simtype, targets, truth, targets_in_tile, obsconditi
         zeff_obs = np.ones(ncond)
     else :
         zeff_obs = get_zeff_obs(simtype, obsconditions)
+    if tile_matches is None:
+        tile_matches = _match_targets_in_tile(targetid, targets_in_tile,
+                                              obsconditions['TILEID'])
+    itarget, itile = tile_matches
+
+    #- Accumulate the failure probability of every (target, tile)
+    #- observation at once; targets observed on several tiles get the
+    #- product of their failure probabilities
     pfail = np.ones(n)
+    tmp = (simulated_eff[itarget]*zeff_obs[itile]).clip(0, 1)
+    np.multiply.at(pfail, itarget, 1-tmp)
     observed = np.zeros(n, dtype=bool)
+    observed[itarget] = True
+
+    simulated_eff = (1-pfail)
+
+    return observed, simulated_eff
+
+def _match_targets_in_tile(targetid, targets_in_tile, tileids):
+    """Find all observations of targets on tiles
+
+    Args:
+        targetid: array of unique TARGETIDs
+        targets_in_tile: dictionary. Keys correspond to tileids, its values
+            are the arrays of targetids observed in that tile.
+        tileids: array of tile IDs, e.g. obsconditions['TILEID']
+
+    Returns:
+        tuple of arrays (itarget, itile), one entry per observation of a
+        target on a tile: targetid[itarget] was observed on tileids[itile].
+        Targetids in tiles that are not in targetid (sky, standards) are
+        dropped.
+    """
+    targetid = np.asarray(targetid)
+    tileids = np.atleast_1d(tileids)
+    ntargets_per_tile = np.array([len(targets_in_tile[tileid]) for tileid in tileids],
+                                 dtype=np.int64)
+    if np.sum(ntargets_per_tile) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    # Extract the targets-per-tile lists into one huge list and match it
+    # against the sorted target list.  Assume targetid is unique, so not
+    # checking this.
+    concat_targets_in_tile = np.concatenate([targets_in_tile[tileid] for tileid in tileids])
+    itile = np.repeat(np.arange(len(tileids)), ntargets_per_tile)
 
-    # More efficient alternative for large numbers of tiles + large target
-    # list, but requires pre-computing the sort order of targetids.
-    # Assume targets['TARGETID'] is unique, so not checking this.
     sort_targetid = np.argsort(targetid)
+    index, matched = _match_sorted(targetid[sort_targetid], concat_targets_in_tile)
+    itarget = sort_targetid[index[matched]]
 
-    # Extract the targets-per-tile lists into one huge list.
-    concat_targets_in_tile  = np.concatenate([targets_in_tile[tileid] for tileid in obsconditions['TILEID']])
-    ntargets_per_tile       = np.array([len(targets_in_tile[tileid])  for tileid in obsconditions['TILEID']])
-
-    # Match entries in each tile list against sorted target list.
-    target_idx    = targetid[sort_targetid].searchsorted(concat_targets_in_tile,side='left')
-    target_idx_r  = targetid[sort_targetid].searchsorted(concat_targets_in_tile,side='right')
-    del(concat_targets_in_tile)
-
-    # Flag targets in tiles that do not appear in the target list (sky,
-    # standards).
-    not_matched = target_idx_r - target_idx == 0
-    target_idx[not_matched] = -1
-    del(target_idx_r,not_matched)
-
-    # Not every tile has 5000 targets, so use individual counts to
-    # construct offset of each tile in target_idx.
-    offset  = np.concatenate([[0],np.cumsum(ntargets_per_tile[:-1])])
-
-    # For each tile, process targets.
-    for i, tileid in enumerate(obsconditions['TILEID']):
-        if ntargets_per_tile[i] > 0:
-            # Quickly get all the matched targets on this tile.
-            targets_this_tile  = target_idx[offset[i]:offset[i]+ntargets_per_tile[i]]
-            targets_this_tile  = targets_this_tile[targets_this_tile > 0]
-            # List of indices into sorted target list for each observed
-            # source.
-            ii  = sort_targetid[targets_this_tile]
-            tmp = (simulated_eff[ii]*zeff_obs[i]).clip(0, 1)
-            pfail[ii] *= (1-tmp)
-            observed[ii] = True
+    return itarget, itile[matched]
 
-    simulated_eff = (1-pfail)
+def _match_sorted(sortedids, targetids):
+    """Match targetids against a sorted array of unique ids
 
-    return observed, simulated_eff
+    Args:
+        sortedids: sorted array of unique ids, e.g. TARGETID
+        targetids: array of ids to look up in sortedids
+
+    Returns:
+        tuple of arrays (index, matched) with same length as targetids;
+        sortedids[index[matched]] == targetids[matched] and index is
+        meaningless where matched is False
+    """
+    targetids = np.asarray(targetids)
+    if len(sortedids) == 0:
+        return (np.zeros(len(targetids), dtype=np.int64),
+                np.zeros(len(targetids), dtype=bool))
+
+    index = np.searchsorted(sortedids, targetids).clip(0, len(sortedids)-1)
+    matched = (np.asarray(sortedids)[index] == targetids)
+    return index, matched
 
 # Efficiency model
 def eff_model(x, nsigma, sigma, max_efficiency=1):
@@ -396,6 +426,11 @@ def get_observed_redshifts(targets, truth, targets_in_tile, obsconditions, param
     if(n_tiles!=len(targets_in_tile)):
         raise ValueError('Number of obsconditions {} != len(targets_in_tile) {}'.format(n_tiles, len(targets_in_tile)))
 
+    #- Match targets to tiles once for all objtypes, then select the
+    #- observations of each objtype's targets below
+    itarget, itile = _match_targets_in_tile(targets['TARGETID'], targets_in_tile,
+                                            obsconditions['TILEID'])
+
     for objtype in objtypes:
 
         ii=(simtype==objtype)
@@ -461,10 +496,13 @@ def get_observed_redshifts(targets, truth, targets_in_tile, obsconditions, param
         # Set ZWARN flags for some targets
         # the redshift efficiency only sets warning, but does not impact
         # the redshift value and its error.
+        keep = ii[itarget]
+        subindex = np.cumsum(ii) - 1
         was_observed, goodz_prob = get_redshift_efficiency(
             objtype, targets[ii], truth[ii], targets_in_tile,
             obsconditions=obsconditions,params=params,
-            ignore_obscondition=ignore_obscondition)
+            ignore_obscondition=ignore_obscondition,
+            tile_matches=(subindex[itarget[keep]], itile[keep]))
 
         n=np.sum(ii)
         assert len(was_observed) == n
@@ -567,7 +605,68 @@ def get_median_obsconditions(tileids):
 
     return obsconditions
 
-def quickcat(tilefiles, targets, truth, fassignhdu='FIBERASSIGN', zcat=None, obsconditions=None, perfect=False):
+def _read_tile_targetids(infile, fassignhdu='FIBERASSIGN'):
+    """Read TILEID and assigned TARGETIDs from a single fiberassign file"""
+    with fitsio.FITS(infile) as fx:
+        header = fx[fassignhdu].read_header()
+        targetids = fx[fassignhdu].read_column('TARGETID')
+
+    # hack needed here rnc 7/26/18
+    if 'TILEID' in header:
+        tileid = header['TILEID']
+    else:
+        fnew=infile.split('/')[-1]
+        tileid=fnew.split("_")[-1]
+        tileid=int(tileid[:-5])
+        log.error('TILEID missing from {} header'.format(fnew))
+        log.error('{} -> TILEID {}'.format(infile, tileid))
+
+    return tileid, targetids[targetids != -1]  #- targets with assignments
+
+def read_tile_targetids(tilefiles, fassignhdu='FIBERASSIGN', nproc=None):
+    """
+    Read the assigned TARGETIDs of many fiberassign tile files
+
+    Only the TARGETID column and the header are read, using a pool of
+    processes since fitsio holds the GIL while reading.
+
+    Args:
+        tilefiles: list of fiberassign tile files
+        fassignhdu (optional): name of the fiber assignment HDU
+        nproc (optional): number of processes; default cpu_count()//2,
+            at most len(tilefiles)
+
+    Returns:
+        tuple of arrays (tileids, targetids, offsets) where targetids are
+        the concatenated TARGETIDs (excluding -1, i.e. unassigned) of all
+        tiles and targetids[offsets[i]:offsets[i+1]] are the ones of
+        tileids[i]; offsets has length len(tilefiles)+1
+    """
+    import multiprocessing as mp
+    from functools import partial
+
+    if nproc is None:
+        nproc = mp.cpu_count() // 2
+    nproc = max(1, min(nproc, len(tilefiles)))
+
+    read = partial(_read_tile_targetids, fassignhdu=fassignhdu)
+    if nproc > 1:
+        with mp.Pool(nproc) as pool:
+            results = pool.map(read, tilefiles)
+    else:
+        results = [read(infile) for infile in tilefiles]
+
+    tileids = np.array([tileid for tileid, tmp in results], dtype=np.int64)
+    ntargets = [len(tmp) for tileid, tmp in results]
+    offsets = np.concatenate([[0], np.cumsum(ntargets, dtype=np.int64)])
+    if len(results) > 0:
+        targetids = np.concatenate([tmp for tileid, tmp in results])
+    else:
+        targetids = np.zeros(0, dtype=np.int64)
+
+    return tileids, targetids, offsets
+
+def quickcat(tilefiles, targets, truth, fassignhdu='FIBERASSIGN', zcat=None, obsconditions=None, perfect=False, nproc=None):
     """
     Generates quick output zcatalog
 
@@ -579,6 +678,7 @@ def quickcat(tilefiles, targets, truth, fassignhdu='FIBERASSIGN', zcat=None, obs
         obsconditions (optional): Table or ndarray with observing conditions from surveysim
         perfect (optional): if True, treat spectro pipeline as perfect with input=output,
             otherwise add noise and zwarn!=0 flags
+        nproc (optional): number of processes used to read the tile files
 
     Returns:
         zcatalog astropy Table based upon input truth, plus ZERR, ZWARN,
@@ -590,28 +690,15 @@ def quickcat(tilefiles, targets, truth, fassignhdu='FIBERASSIGN', zcat=None, obs
 
     #- Count how many times each target was observed for this set of tiles
     log.info('{} QC Reading {} tiles'.format(asctime(), len(tilefiles)))
-    nobs = Counter()
-    targets_in_tile = {}
-    tileids = list()
-    for infile in tilefiles:
-        
-        fibassign, header = fits.getdata(infile, fassignhdu, header=True)
- 
-        # hack needed here rnc 7/26/18
-        if 'TILEID' in header:
-            tileidnew = header['TILEID']
-        else:
-            fnew=infile.split('/')[-1]
-            tileidnew=fnew.split("_")[-1]
-            tileidnew=int(tileidnew[:-5])
-            log.error('TILEID missing from {} header'.format(fnew))
-            log.error('{} -> TILEID {}'.format(infile, tileidnew))
-
-        tileids.append(tileidnew)
+    tileids, tile_targetids, offsets = read_tile_targetids(tilefiles,
+        fassignhdu=fassignhdu, nproc=nproc)
+    targets_in_tile = dict()
+    for i, tileid in enumerate(tileids):
+        targets_in_tile[tileid] = tile_targetids[offsets[i]:offsets[i+1]]
 
-        ii = (fibassign['TARGETID'] != -1)  #- targets with assignments
-        nobs.update(fibassign['TARGETID'][ii])
-        targets_in_tile[tileidnew] = fibassign['TARGETID'][ii]
+    #- Sorted unique TARGETIDs of observed targets and their number of
+    #- observations; used as an index for all matching below
+    obs_targetids, nobs = np.unique(tile_targetids, return_counts=True)
 
     #- Trim obsconditions to just the tiles that were observed
     if obsconditions is not None:
@@ -634,8 +721,7 @@ def quickcat(tilefiles, targets, truth, fassignhdu='FIBERASSIGN', zcat=None, obs
 
     #- Trim truth down to just ones that have already been observed
     log.info('{} QC Trimming truth to just observed targets'.format(asctime()))
-    obs_targetids = np.array(list(nobs.keys()))
-    iiobs = np.in1d(truth['TARGETID'], obs_targetids)
+    iobs, iiobs = _match_sorted(obs_targetids, truth['TARGETID'])
     truth = truth[iiobs]
     targets = targets[iiobs]
 
@@ -671,9 +757,7 @@ def quickcat(tilefiles, targets, truth, fassignhdu='FIBERASSIGN', zcat=None, obs
 
     #- Add numobs column
     log.info('{} QC Adding NUMOBS column'.format(asctime()))
-    newzcat.add_column(Column(name='NUMOBS', length=nz, dtype=np.int32))
-    for i in range(nz):
-        newzcat['NUMOBS'][i] = nobs[newzcat['TARGETID'][i]]
+    newzcat['NUMOBS'] = nobs[iobs[iiobs]].astype(np.int32)
 
     #- Merge previous zcat with newzcat
     log.info('{} QC Merging previous zcat'.format(asctime()))
@@ -683,33 +767,28 @@ def quickcat(tilefiles, targets, truth, fassignhdu='FIBERASSIGN', zcat=None, obs
         #- efficient while still letting us modify a column if needed
         zcat = zcat.copy()
 
-        # needed to have the same ordering both in zcat and newzcat
-        # to ensure consistent use of masks from np.in1d()
+        #- sort both catalogs by TARGETID; inew[repeats] are then the rows
+        #- of newzcat matching the rows zcat[repeats], in the same order
         zcat.sort(keys='TARGETID')
         newzcat.sort(keys='TARGETID') 
-        
-        #- targets that are in both zcat and newzcat
-        repeats = np.in1d(zcat['TARGETID'], newzcat['TARGETID'])
+        inew, repeats = _match_sorted(newzcat['TARGETID'], zcat['TARGETID'])
 
         #- update numobs in both zcat and newzcat
-        ii = np.in1d(newzcat['TARGETID'], zcat['TARGETID'][repeats])
         orig_numobs = zcat['NUMOBS'][repeats].copy()
-        new_numobs = newzcat['NUMOBS'][ii].copy()
+        new_numobs = newzcat['NUMOBS'][inew[repeats]].copy()
         zcat['NUMOBS'][repeats] += new_numobs
-        newzcat['NUMOBS'][ii] += orig_numobs
+        newzcat['NUMOBS'][inew[repeats]] += orig_numobs
 
         #- replace only repeats that had ZWARN flags in original zcat
         #- replace in new
         replace = repeats & (zcat['ZWARN'] != 0)
-        jj = np.in1d(newzcat['TARGETID'], zcat['TARGETID'][replace])
-        zcat[replace] = newzcat[jj]
+        for colname in zcat.colnames:
+            zcat[colname][replace] = newzcat[colname][inew[replace]]
 
         #- trim newzcat to ones that shouldn't override original zcat
-        discard = np.in1d(newzcat['TARGETID'], zcat['TARGETID'])
-        newzcat = newzcat[~discard]
-
-        #- Should be non-overlapping now
-        assert np.all(np.in1d(zcat['TARGETID'], newzcat['TARGETID']) == False)
+        keep = np.ones(len(newzcat), dtype=bool)
+        keep[inew[repeats]] = False
+        newzcat = newzcat[keep]
 
         #- merge them
         newzcat = vstack([zcat, newzcat])
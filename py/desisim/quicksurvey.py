@@ -140,22 +140,47 @@ class SimSetup(object):
             return False
 
         
-    def backup_epoch_data(self, epoch_id=0):
-        """Deletes files in the temporary output directory
+    def epoch_path(self, epoch_id=0):
+        """Returns the output directory for an epoch, creating it if needed.
 
         Args:
-            epoch_id (int): Epoch's ID to backup/copy from the output directory.
-
+            epoch_id (int): Epoch's ID.
         """
         backup_path = os.path.join(self.output_path, '{}'.format(epoch_id))
-
-        # keep a copy of zcat.fits
         if not os.path.exists(backup_path):
             os.makedirs(backup_path)
 
-        # keep a copy of mtl.fits
-        shutil.copy(self.mtl_file, backup_path)
-        shutil.copy(self.zcat_file, backup_path)
+        return backup_path
+
+    def read_epoch_zcat(self, epoch_id=0):
+        """Reads the zcat checkpoint of a previous epoch.
+
+        Args:
+            epoch_id (int): Epoch's ID.
+
+        Returns:
+            Table: redshift catalog written at the end of that epoch.
+        """
+        zcat_file = os.path.join(self.output_path, '{}'.format(epoch_id), 'zcat.fits')
+        print('{} reading zcat from {}'.format(asctime(), zcat_file))
+        return Table(fitsio.read(zcat_file, 'ZCATALOG'))
+
+    def backup_epoch_data(self, epoch_id=0):
+        """Copies the epoch outputs to the epoch output directory
+
+        Args:
+            epoch_id (int): Epoch's ID to backup/copy from the output directory.
+
+        Notes:
+            mtl.fits and zcat.fits are only copied if they weren't already
+            written directly to the epoch directory by simulate_epoch.
+        """
+        backup_path = self.epoch_path(epoch_id)
+
+        # keep a copy of mtl.fits and zcat.fits
+        for filename in (self.mtl_file, self.zcat_file):
+            if os.path.dirname(os.path.abspath(filename)) != os.path.abspath(backup_path):
+                shutil.copy(filename, backup_path)
 
         # keep a copy of all the fiberassign files
         fiber_backup_path = os.path.join(backup_path, 'fiberassign')
@@ -212,16 +237,24 @@ class SimSetup(object):
             truth (Table): Truth data
             targets (Table): Targets data
             zcat (Table): Redshift Catalog Data
+        Returns:
+            Table: updated redshift catalog, to be passed as zcat to the
+            next epoch
         Notes:
             This routine simulates three steps:
             * Merged target list creation
             * Fiber allocation
             * Redshift catalogue construction
+
+            The MTL and zcat are written directly to the epoch output
+            directory; zcat.fits is written last (atomically) and
+            marks the epoch as done.
         """
+        epoch_path = self.epoch_path(epoch)
 
         # create the MTL file
         print("{} Starting MTL".format(asctime()))
-        self.mtl_file = os.path.join(self.tmp_output_path, 'mtl.fits')
+        self.mtl_file = os.path.join(epoch_path, 'mtl.fits')
         if zcat is None:
             mtl = desitarget.mtl.make_mtl(targets)
         else:
@@ -247,7 +280,7 @@ class SimSetup(object):
         f = open('fiberassign.log','a')
         
         p = subprocess.call([self.fiberassign, 
-                             '--mtl',  os.path.join(self.tmp_output_path, 'mtl.fits'),
+                             '--mtl',  self.mtl_file,
                              '--stdstar',  self.stdfile,  
                              '--sky',  self.skyfile, 
                              '--surveytiles',  self.surveyfile,
@@ -269,26 +302,34 @@ class SimSetup(object):
         obsconditions = None
         print('tilefiles', len(self.tilefiles))
         
-        # write the zcat, it uses the tilesfiles constructed in the last step
-        self.zcat_file = os.path.join(self.tmp_output_path, 'zcat.fits')
+        # update the zcat with the tilesfiles constructed in the last step
+        self.zcat_file = os.path.join(epoch_path, 'zcat.fits')
         print("{} starting quickcat".format(asctime()))
         newzcat = quickcat(self.tilefiles, targets, truth, zcat=zcat,
                            obsconditions=obsconditions, perfect=perfect)
+
+        # checkpoint the zcat; the next epoch uses the in-memory copy
         print("{} writing zcat".format(asctime()))
-        newzcat.write(self.zcat_file, format='fits', overwrite=True)
+        tmpfile = self.zcat_file + '.tmp'
+        fitsio.write(tmpfile, newzcat.as_array(), extname='ZCATALOG', clobber=True)
+        os.rename(tmpfile, self.zcat_file)
         print("{} Finished zcat".format(asctime()))
-        del newzcat
         gc.collect()
-        return 
+        return newzcat
 
 
     def simulate(self):
         """Simulate the DESI setup described by a SimSetup object.
+
+        Notes:
+            truth, targets and the zcat are kept in memory across epochs;
+            the zcat of a previous epoch is only read from disk when
+            restarting after epochs that were already simulated.
         """
         self.create_directories()
 
-        truth = Table.read(os.path.join(self.targets_path,'truth.fits'))
-        targets = Table.read(os.path.join(self.targets_path,'targets.fits'))
+        truth = Table.read(self.truthfile)
+        targets = Table.read(self.targetsfile)
 
         print(truth.keys())
         #- Drop columns that aren't needed to save memory while manipulating
@@ -302,29 +343,28 @@ class SimSetup(object):
             truth.remove_column('MOCKID')
 
 
+        #- zcat from the previous epoch; None means not yet loaded
+        zcat = None
         for epoch in range(self.start_epoch, self.n_epochs):
             print('--- Epoch {} ---'.format(epoch))
             
             if not self.epoch_data_exists(epoch_id=epoch):
                 
                 # Initializes mtl and zcat
-                if epoch == 0:
-                    zcat = None
-                else:
+                if epoch > 0 and zcat is None:
                     print('INFO: Running Epoch {}'.format(epoch))
                     print('INFO: reading zcat from previous epoch')
-                    epochdir = os.path.join(self.output_path, str(epoch-1))
-                    zcat = Table.read(os.path.join(epochdir, 'zcat.fits'))
+                    zcat = self.read_epoch_zcat(epoch_id=epoch-1)
 
                 # Update mtl and zcat
-                self.simulate_epoch(epoch, truth, targets, perfect=True, zcat=zcat)
+                zcat = self.simulate_epoch(epoch, truth, targets, perfect=True, zcat=zcat)
 
-                # copy mtl and zcat to epoch directory
+                # copy fiberassign outputs to epoch directory
                 self.backup_epoch_data(epoch_id=epoch)
-                del zcat
                 gc.collect()
             else:
                 print('--- Epoch {} Already Exists ---'.format(epoch))
+                zcat = None
                 
         self.cleanup_directories()
 
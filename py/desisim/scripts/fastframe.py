@@ -29,6 +29,8 @@ def parse(options=None):
     parser.add_argument("--cframe", action="store_true",
                         help="directly write cframe")
     parser.add_argument("--dwave", type=float, default=0.8, help="output wavelength step, in Angstrom")
+    parser.add_argument("--ncpu", type=int, default=None,
+                        help="number of processes writing frames in parallel; default cpu_count()//2")
 
     if options is None:
         args = parser.parse_args()
@@ -37,6 +39,46 @@ def parse(options=None):
 
     return args
 
+def _write_frame(args):
+    '''
+    Builds and writes one frame; args are (outfile, wave, phot, ivar, rdata,
+    spectrograph, fibermap, meta, units) where rdata is the 2D resolution data
+    shared by all fibers
+    '''
+    outfile, wave, phot, ivar, rdata, spectro, fibermap, meta, units = args
+    Rdata = np.broadcast_to(rdata, (phot.shape[0],) + rdata.shape)
+    frame = Frame(wave, phot, ivar, resolution_data=Rdata,
+                  spectrograph=spectro, fibermap=fibermap, meta=meta)
+    print('writing {}'.format(outfile))
+    desispec.io.write_frame(outfile, frame, units=units)
+    return outfile
+
+def write_frames(frameargs, ncpu=None):
+    '''
+    Writes frames in parallel using ncpu processes
+
+    Args:
+        frameargs: list of argument tuples for _write_frame
+        ncpu (int, optional): number of processes; default cpu_count()//2,
+            serial if <= 1
+
+    Returns list of output filenames
+    '''
+    import multiprocessing as mp
+    if ncpu is None:
+        ncpu = mp.cpu_count() // 2
+    ncpu = min(ncpu, len(frameargs))
+
+    #- Create output directories up front so that workers don't race
+    for outdir in set([os.path.dirname(os.path.abspath(x[0])) for x in frameargs]):
+        os.makedirs(outdir, exist_ok=True)
+
+    if ncpu <= 1:
+        return [_write_frame(x) for x in frameargs]
+    else:
+        with mp.Pool(ncpu) as pool:
+            return pool.map(_write_frame, frameargs)
+
 def main(args=None):
     '''
     Converts simspec -> frame files; see fastframe --help for usage options
@@ -88,6 +130,7 @@ def main(args=None):
 
     sim.generate_random_noise()
 
+    frameargs = list()
     for i, results in enumerate(sim.camera_output):
         results = sim.camera_output[i]
         wave = results['wavelength']
@@ -102,10 +145,8 @@ def main(args=None):
                     results['random_noise_electrons']).T
             ivar = 1.0 / results['variance_electrons'].T
 
+        #- Same resolution for every fiber, expanded per frame when written
         R = Resolution(sim.instrument.cameras[i].get_output_resolution_matrix())
-        Rdata = np.tile(R.data.T, nspec).T.reshape(
-                        nspec, R.data.shape[0], R.data.shape[1])
-        assert np.all(Rdata[0] == R.data)
         assert phot.shape == (nspec, len(wave))
         for spectro in range(10):
             imin = max(firstspec, spectro*500) - firstspec
@@ -144,13 +185,13 @@ def main(args=None):
             meta['OBSRDNC'] = readnoise
             meta['OBSRDND'] = readnoise
 
-            frame = Frame(wave, xphot, xivar, resolution_data=Rdata[0:imax-imin],
-                          spectrograph=spectro, fibermap=xfibermap, meta=meta)
             if args.cframe :
                 outfile = desispec.io.findfile('cframe', night, expid, camera,
                                                outdir=args.outdir)
             else :
                 outfile = desispec.io.findfile('frame', night, expid, camera,
                                                outdir=args.outdir)
-            print('writing {}'.format(outfile))
-            desispec.io.write_frame(outfile, frame, units=units)
+            frameargs.append((outfile, wave, xphot, xivar, R.data, spectro,
+                              xfibermap, meta, units))
+
+    write_frames(frameargs, ncpu=args.ncpu)
@@ -29,6 +29,9 @@ def parse(options=None):
     parser.add_argument('--outdir', type=str, help="output directory")
     parser.add_argument('--nspec', type=int, default=None, help="number of spectra to include")
     parser.add_argument('--clobber', action='store_true', help="overwrite any pre-existing output files")
+    parser.add_argument('--simspec-phot', type=str, default='full',
+                        choices=['full', 'compress', 'none'],
+                        help="simspec per-camera photon HDUs: full, tile-compressed, or none (derived when read)")
 
     log = get_logger()
     if options is None:
@@ -123,4 +126,5 @@ def main(args=None):
         outdir=args.outdir), overwrite=args.clobber)
 
     desisim.io.write_simspec(sim, meta, fibermap, obs, args.expid, night, header=header,
-                             objmeta=objmeta, outdir=args.outdir, overwrite=args.clobber)
+                             objmeta=objmeta, outdir=args.outdir, overwrite=args.clobber,
+                             phot=args.simspec_phot)
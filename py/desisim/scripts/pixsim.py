@@ -89,8 +89,8 @@ def parse(options=None):
     parser.add_argument("--overwrite", action="store_true", 
         help="Overwrite existing raw and simpix files")
 
-    #- Not yet supported so don't pretend it is
-    ### parser.add_argument("--seed", type=int, help="random number seed")
+    parser.add_argument("--seed", type=int,
+        help="random number seed for the noise; default global np.random state")
 
     parser.add_argument("--ncpu", type=int, 
         help="Number of cpu cores per thread to use", default=0)
@@ -124,5 +124,5 @@ def main(args, comm=None):
     simulate_exposure(args.simspec, args.rawfile, cameras=args.cameras,
         simpixfile=args.simpixfile, addcosmics=args.cosmics,
         nspec=args.nspec, wavemin=args.wavemin, wavemax=args.wavemax,
-        comm=comm)
+        comm=comm, seed=args.seed)
 
@@ -8,6 +8,7 @@ from __future__ import absolute_import, division, print_function
 
 import os,sys
 import os.path
+import re
 import shutil
 
 import random
@@ -22,10 +23,7 @@ from desispec.parallel import stdouterr_redirected
 
 from . import pixsim
 
-from ..pixsim import simulate_exposure
-from ..pixsim import get_nodes_per_exp
-from ..pixsim import mpi_count_nodes
-from ..pixsim import mpi_split_by_node
+from ..pixsim import simulate_exposures
 
 from ..io import SimSpec
 from .. import obs, io
@@ -55,7 +53,8 @@ def parse(options=None):
     # parser.add_argument("--wavemin", type=float, help="Minimum wavelength to simulate")
     # parser.add_argument("--wavemax", type=float, help="Maximum wavelength to simulate")
     parser.add_argument("--cameras", type=str, default=None, help="cameras, e.g. b0,r5,z9")
-    parser.add_argument("--nodes_per_exp", type=int, default=None, help="nodes per exposure")
+    parser.add_argument("--nodes_per_exp", type=int, default=None, help="deprecated; cameras are scheduled dynamically")
+    parser.add_argument("--timingfile", type=str, default=None, help="output table of per-camera timing")
 
     args = None
     if options is None:
@@ -153,60 +152,21 @@ def main(args, comm=None):
     else:
         addcosmics = False
 
-    ncameras=len(cams)
-    nexposures=len(night_exposure_list)
-    #call ultity function to figure out how many nodes we have
-    nnodes=mpi_count_nodes(comm)
-
-    #call utility functions to divide our workload
-    if args.nodes_per_exp is not None:
-        user_specified_nodes=args.nodes_per_exp
-    else:
-        user_specified_nodes=None
-
-    nodes_per_comm_exp=get_nodes_per_exp(nnodes,nexposures,ncameras,user_specified_nodes)    
-    #also figure out how many exposure communicators we have
-    num_exp_comm = nnodes // nodes_per_comm_exp 
- 
-    #split the communicator into exposure communicators
-    comm_exp, node_index_exp, num_nodes_exp = mpi_split_by_node(comm, nodes_per_comm_exp)
-    #further splitting will happen automatically in simulate_exposure
-
-    #based on this, figure out which simspecfiles and rawfiles are assigned to each communicator
-    #find all specfiles
-    #find all rawfiles
+    #find all simspecfiles and rawfiles
     rawfile_list=[]
     simspecfile_list=[]
-    night_list=[]
-    expid_list=[]
-    for i in range(len(night_exposure_list)):
-        night_list.append(night_exposure_list[i][0])
-        expid_list.append(night_exposure_list[i][1])
-        rawfile_list.append(desispec.io.findfile('raw', night_list[i], expid_list[i]))
-        simspecfile_list.append(io.findfile('simspec', night_list[i], expid_list[i]))
- 
-    #now divy the rawfiles and specfiles between node communicators
-    #there is onerawfile and one specfile for each exposure
-    rawfile_comm_exp=[]
-    simspecfile_comm_exp=[]
-    for i in range(num_exp_comm):
-        if node_index_exp == i: #assign rawfile, simspec file to one communicator at a time
-            rawfile_comm_exp=rawfile_list[i::num_exp_comm]
-            simspecfile_comm_exp=simspecfile_list[i::num_exp_comm] 
-            night_comm_exp=night_list[i::num_exp_comm]
-            expid_comm_exp=expid_list[i::num_exp_comm]
-    
-    comm.Barrier()
-
-    #now wrap pixsim.simulate_exposure for each exposure (in desisim.pixsim)
-    if comm_exp.rank == 0:
-        log.info("Starting simulate_exposure for night {} expid {}".format(night_comm_exp, expid_comm_exp))
-    for i in range(len(rawfile_comm_exp)):
-        simulate_exposure(simspecfile_comm_exp[i], rawfile_comm_exp[i], cameras=cams,
-            ccdshape=None, simpixfile=None, addcosmics=addcosmics, comm=comm_exp)
-
-
-    comm.Barrier()
+    for night, expid in night_exposure_list:
+        rawfile_list.append(desispec.io.findfile('raw', night, expid))
+        simspecfile_list.append(io.findfile('simspec', night, expid))
+
+    if args.nodes_per_exp is not None and rank == 0:
+        log.warning('--nodes_per_exp is deprecated and ignored; cameras are scheduled dynamically')
+
+    #each (exposure, camera) pair is a task; nodes pull tasks from a shared
+    #queue so the number of cameras doesn't need to divide the number of nodes
+    simulate_exposures(simspecfile_list, rawfile_list, cams,
+        ccdshape=None, simpixfiles=None, addcosmics=addcosmics, comm=comm,
+        timingfile=args.timingfile)
 
     if rank == 0:
         log.info('Finished pixsim nights {}'.format(args.nights, asctime()))
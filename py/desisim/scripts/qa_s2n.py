@@ -18,6 +18,7 @@ def parse(options=None):
     #parser.add_argument('--rawdir', type = str, default = None, metavar = 'PATH',
     #                    help = 'Override default path ($DESI_SPECTRO_DATA) to processed data.')
     parser.add_argument('--qaprod_dir', type=str, default=None, help = 'Path to where QA figure files are generated.  Default is qaprod_dir')
+    parser.add_argument('--nproc', type=int, default=None, help = 'Number of processes used to read the exposures')
 
     if options is None:
         args = parser.parse_args()
@@ -31,9 +32,7 @@ def main(args):
 
     import desispec.io
     from desiutil.log import get_logger
-    from desisim.spec_qa.s2n import load_s2n_values, obj_s2n_wave, obj_s2n_z
-    from desisim.spec_qa.s2n import load_all_s2n_values
-    from desisim.spec_qa.s2n import parse_s2n_values
+    from desisim.spec_qa.s2n import accumulate_s2n, obj_s2n_wave, obj_s2n_z
 
     # Initialize
     if args.qaprod_dir is not None:
@@ -44,16 +43,9 @@ def main(args):
     # Grab nights
     nights = desispec.io.get_nights()
 
-
-    # Load all s2n (once)
-    all_s2n_values = []
+    # Loop on channel
     channels = ['b', 'r', 'z']
     for channel in channels:
-        print("Loading S/N for channel {}".format(channel))
-        all_s2n_values.append(load_all_s2n_values(nights, channel))
-
-    # Loop on channel
-    for ss, channel in enumerate(channels):
         if channel == 'b':
             wv_bins = np.arange(3570., 5700., 20.)
         elif channel == 'r':
@@ -63,7 +55,8 @@ def main(args):
             z_bins = np.linspace(1.0, 1.6, 100) # z camera
         else:
             raise IOError("Bad channel value: {}".format(channel))
-        # Loop on OBJTYPE
+        # Bins for each OBJTYPE
+        bins = dict()
         for objtype in ['ELG', 'LRG', 'QSO']:
             if objtype == 'ELG':
                 flux_bins = np.linspace(19., 24., 6)
@@ -72,17 +65,23 @@ def main(args):
                 flux_bins = np.linspace(16., 22., 6)
             elif objtype == 'QSO':
                 flux_bins = np.linspace(15., 24., 6)
-            # Parse
-            fdict = all_s2n_values[ss]
-            s2n_dict = parse_s2n_values(objtype, fdict)
-            # Plot
-            outfile = qaprod_dir+'/QA_s2n_{:s}_{:s}.png'.format(objtype, channel)
-            desispec.io.util.makepath(outfile)
-            obj_s2n_wave(s2n_dict, wv_bins, flux_bins, objtype, outfile=outfile)
+            bins[objtype] = dict(wave=wv_bins, mag=flux_bins)
             # S/N vs. z for ELG
             if (channel == 'z') & (objtype=='ELG'):
-                outfile = qaprod_dir+'/QA_s2n_{:s}_{:s}_redshift.png'.format(objtype,channel)
-                desispec.io.util.makepath(outfile)
-                obj_s2n_z(s2n_dict, z_bins, oii_bins, objtype, outfile=outfile)
+                bins[objtype].update(z=z_bins, oii=oii_bins)
 
+        # Accumulate the S/N histograms
+        print("Loading S/N for channel {}".format(channel))
+        hists = accumulate_s2n(nights, channel, bins, nproc=args.nproc)
 
+        # Plot
+        for objtype, obins in bins.items():
+            outfile = qaprod_dir+'/QA_s2n_{:s}_{:s}.png'.format(objtype, channel)
+            desispec.io.util.makepath(outfile)
+            obj_s2n_wave(None, obins['wave'], obins['mag'], objtype, outfile=outfile,
+                         hist=hists[objtype]['wave'])
+            if 'z' in hists[objtype]:
+                outfile = qaprod_dir+'/QA_s2n_{:s}_{:s}_redshift.png'.format(objtype,channel)
+                desispec.io.util.makepath(outfile)
+                obj_s2n_z(None, obins['z'], obins['oii'], objtype, outfile=outfile,
+                          hist=hists[objtype]['z'])
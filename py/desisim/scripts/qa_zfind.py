@@ -27,6 +27,8 @@ def parse(options=None):
                         help = 'YAML file for debugging (primarily).')
     parser.add_argument('--write_simz_table', type=str, default=None, help = 'Write simz to this filename')
     parser.add_argument('--qaprod_dir', type=str, default=None, help = 'Path to where QA figure files are generated.  Default is specprod_dir+/QA')
+    parser.add_argument('--nproc', type=int, default=None, help = 'Number of processes used to read the simspec and zbest files')
+    parser.add_argument('--cachefile', type=str, default=None, help = 'Cache the merged simspec and zbest tables in this .npz file; reused if the inputs are unchanged')
 
     if options is None:
         args = parser.parse_args()
@@ -102,7 +104,8 @@ def main(args):
             sys.exit(1)
 
         # Write? Table
-        simz_tab, zbtab = dsqa_z.load_z(fibermap_files, zbest_files=zbest_files)
+        simz_tab, zbtab = dsqa_z.load_z(fibermap_files, zbest_files=zbest_files,
+                                         nproc=args.nproc, cachefile=args.cachefile)
         dsqa_z.match_truth_z(simz_tab, zbtab)
         if args.write_simz_table is not None:
             simz_tab.write(args.write_simz_table, overwrite=True)
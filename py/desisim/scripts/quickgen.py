@@ -79,9 +79,9 @@ from desispec.fluxcalibration import FluxCalib
 from desiutil.log import get_logger, DEBUG, INFO
 from desisim.obs import get_night
 from desisim.targets import sample_objtype
-from desisim.specsim import get_simulator
+from desisim.specsim import get_simulator, resize_simulator
 from desimodel.io import load_desiparams
-from desisim.simexp import get_source_types
+from desisim.simexp import get_source_types, generate_fiber_noise, noise_chunksize
 
 def _add_truth(hdus, header, meta, trueflux, sflux, wave, channel):
     """Utility function for adding truth to an output FITS file."""
@@ -96,6 +96,89 @@ def _add_truth(hdus, header, meta, trueflux, sflux, wave, channel):
         metahdu.header['EXTNAME'] = '_TRUTH'
         hdus.append(metahdu)
 
+def _write_camera_outputs(task):
+    """Write the frame, cframe, sky and calib files of one camera.
+
+    task is a dict of output filenames and the arrays for that camera built
+    in main(); the cframe, sky and calib files are skipped if there is no
+    'cframefile' entry.
+    """
+    log = get_logger()
+    camera = task['camera']
+    wave = task['wave']
+    nfiber = task['frame_flux'].shape[0]
+    resol = np.broadcast_to(task['resolution'],
+                            (nfiber,) + task['resolution'].shape)
+
+    # must create desispec.Frame object
+    frame=Frame(wave, task['frame_flux'], task['frame_ivar'],\
+        resolution_data=resol, spectrograph=task['spectrograph'], \
+        fibermap=task['fibermap'], \
+        meta=dict(CAMERA=camera, FLAVOR=task['flavor']) )
+    desispec.io.write_frame(task['framefile'], frame)
+    log.info("Wrote file {}".format(task['framefile']))
+
+    if 'cframefile' not in task:
+        return
+
+    # must create desispec.Frame object
+    cframe = Frame(wave, task['cframe_flux'], task['cframe_ivar'], \
+        resolution_data=resol, spectrograph=task['spectrograph'],
+        fibermap=task['fibermap'],
+        meta=dict(CAMERA=camera, FLAVOR=task['flavor']) )
+    desispec.io.frame.write_frame(task['cframefile'],cframe)
+    log.info("Wrote file {}".format(task['cframefile']))
+
+    # must create desispec.Sky object
+    skyflux = task['sky_flux']
+    skymask=np.zeros(skyflux.shape, dtype=np.uint32)
+    skymodel = SkyModel(wave, skyflux, task['sky_ivar'], skymask,
+        header=dict(CAMERA=camera))
+    desispec.io.sky.write_sky(task['skyfile'], skymodel)
+    log.info("Wrote file {}".format(task['skyfile']))
+
+    # Write calib file
+    flux = task['calib_flux']
+    phot = task['calib_phot']
+    calibration = np.zeros_like(phot)
+    jj = (flux>0)
+    calibration[jj] = phot[jj] / flux[jj]
+
+    #- TODO: what should calibivar be?
+    #- For now, model it as the noise of combining ~10 spectra
+    calibivar=10/task['cframe_ivar']
+    #mask=(1/calibivar>0).astype(int)??
+    mask=np.zeros(calibration.shape, dtype=np.uint32)
+
+    # write flux calibration
+    fluxcalib = FluxCalib(wave, calibration, calibivar, mask)
+    write_flux_calibration(task['calibfile'], fluxcalib)
+    log.info("Wrote file {}".format(task['calibfile']))
+
+def write_camera_outputs(tasks, ncpu=None):
+    """Write the per-camera outputs of quickgen using ncpu processes.
+
+    ncpu defaults to cpu_count()//2; tasks are written serially if <= 1.
+    """
+    import multiprocessing as mp
+    if ncpu is None:
+        ncpu = mp.cpu_count() // 2
+    ncpu = min(ncpu, len(tasks))
+
+    #- Create output directories up front so that workers don't race
+    for task in tasks:
+        for key in ['framefile', 'cframefile', 'skyfile', 'calibfile']:
+            if key in task:
+                outdir = os.path.dirname(os.path.abspath(task[key]))
+                os.makedirs(outdir, exist_ok=True)
+
+    if ncpu <= 1:
+        for task in tasks:
+            _write_camera_outputs(task)
+    else:
+        with mp.Pool(ncpu) as pool:
+            pool.map(_write_camera_outputs, tasks)
+
 def parse(options=None):
     parser=argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
@@ -106,6 +189,8 @@ def parse(options=None):
     parser.add_argument('--spectrograph',type=int, default=None,help='Spectrograph no. 0-9')
     parser.add_argument('--config', type=str, default='desi', help='specsim configuration')
     parser.add_argument('-s','--seed', type=int, default=0,  help="random seed")
+    parser.add_argument('--blocksize', type=int, default=500, help='number of spectra simulated at once, rounded up to a multiple of {}'.format(noise_chunksize))
+    parser.add_argument('--ncpu', type=int, default=None, help='number of processes writing output files; default cpu_count()//2')
     # Only produce uncalibrated output
     parser.add_argument('--frameonly', action="store_true", help="only output frame files")
 
@@ -419,7 +504,8 @@ def main(args):
         # Lookup this camera's resolution matrix and convert to the sparse
         # format used in desispec.
         R = Resolution(camera.get_output_resolution_matrix())
-        resolution[camera.name] = np.tile(R.to_fits_array(), [args.nspec, 1, 1])
+        # Same for every fiber; expanded per frame when writing
+        resolution[camera.name] = R.to_fits_array()
         waves[camera.name] = (camera.output_wavelength.to(u.Angstrom).value.astype(np.float32))
         nwave = len(waves[camera.name])
         maxbin = max(maxbin, len(waves[camera.name]))
@@ -496,60 +582,76 @@ def main(args):
 
             sys.exit(0)
 
-    # Repeat the simulation for all spectra
+    # Simulate the spectra in blocks of fibers, with independent random
+    # streams per spectrum or chunk of fibers so that results don't depend
+    # upon the blocksize
     fluxunits = 1e-17 * u.erg / (u.s * u.cm ** 2 * u.Angstrom)
-    for j in range(args.nspec):
-
-        thisobjtype = objtype[j]
-        sys.stdout.flush()
-        if flavor == 'arc':
-            qsim.source.update_in(
-                'Quickgen source {0}'.format, 'perfect',
-                wavelengths * u.Angstrom, spectra * fluxunits)
+    source_types = np.char.lower(np.asarray(objtype[:args.nspec], dtype=str))
+    wave_out = qsim.source.wavelength_out.to(u.Angstrom).value
+    noise_seed = random_state.randint(2**32)
+    sky_seeds = random_state.randint(2**32, size=args.nspec, dtype=np.uint64)
+    #- round up to whole chunks of fibers sharing a noise stream
+    blocksize = noise_chunksize * max(1, -(-args.blocksize // noise_chunksize))
+    for start in range(0, args.nspec, blocksize):
+        stop = min(start + blocksize, args.nspec)
+        jj = slice(start, stop)
+        if qsim.num_fibers != stop - start:
+            resize_simulator(qsim, stop - start)
+
+        # Resample the input spectra to the simulation grid, as
+        # specsim.source.Source.update_out does for a single source
+        if np.array_equal(wavelengths, wave_out):
+            block_flux = spectra[jj]
         else:
-            qsim.source.update_in(
-                'Quickgen source {0}'.format(j), thisobjtype.lower(),
-                wavelengths * u.Angstrom, spectra[j, :] * fluxunits)
-        qsim.source.update_out()
+            block_flux = scipy.interpolate.interp1d(wavelengths, spectra[jj],
+                kind='linear', copy=False)(wave_out)
 
-        qsim.simulate()
-        qsim.generate_random_noise(random_state)
+        log.debug('Simulating spectra {}:{}'.format(start, stop))
+        qsim.simulate(source_fluxes=block_flux * fluxunits,
+                      source_types=source_types[jj])
+        generate_fiber_noise(qsim, noise_seed, first_fiber=start)
 
         for i, output in enumerate(qsim.camera_output):
             assert output['observed_flux'].unit == 1e17 * fluxunits
             # Extract the simulation results needed to create our uncalibrated
             # frame output file.
             num_pixels = len(output)
-            nobj[j, i, :num_pixels] = output['num_source_electrons'][:,0]
-            nsky[j, i, :num_pixels] = output['num_sky_electrons'][:,0]
-            nivar[j, i, :num_pixels] = 1.0 / output['variance_electrons'][:,0]
+            nobj[jj, i, :num_pixels] = output['num_source_electrons'].T
+            nsky[jj, i, :num_pixels] = output['num_sky_electrons'].T
+            nivar[jj, i, :num_pixels] = 1.0 / output['variance_electrons'].T
 
             # Get results for our flux-calibrated output file.
-            cframe_observedflux[j, i, :num_pixels] = 1e17 * output['observed_flux'][:,0]
-            cframe_ivar[j, i, :num_pixels] = 1e-34 * output['flux_inverse_variance'][:,0]
+            cframe_observedflux[jj, i, :num_pixels] = 1e17 * output['observed_flux'].T
+            cframe_ivar[jj, i, :num_pixels] = 1e-34 * output['flux_inverse_variance'].T
 
             # Fill brick arrays from the results.
             camera = output.meta['name']
-            trueflux[camera][j][:] = 1e17 * output['observed_flux'][:,0]
-            noisyflux[camera][j][:] = 1e17 * (output['observed_flux'][:,0] +
-                output['flux_calibration'][:,0] * output['random_noise_electrons'][:,0])
-            obsivar[camera][j][:] = 1e-34 * output['flux_inverse_variance'][:,0]
+            trueflux[camera][jj] = 1e17 * output['observed_flux'].T
+            noisyflux[camera][jj] = 1e17 * (output['observed_flux'] +
+                output['flux_calibration'] * output['random_noise_electrons']).T
+            obsivar[camera][jj] = 1e-34 * output['flux_inverse_variance'].T
 
             # Use the same noise realization in the cframe and frame, without any
             # additional noise from sky subtraction for now.
-            frame_rand_noise[j, i, :num_pixels] = output['random_noise_electrons'][:,0]
-            cframe_rand_noise[j, i, :num_pixels] = 1e17 * (
-                output['flux_calibration'][:,0] * output['random_noise_electrons'][:,0])
+            frame_rand_noise[jj, i, :num_pixels] = output['random_noise_electrons'].T
+            cframe_rand_noise[jj, i, :num_pixels] = 1e17 * (
+                output['flux_calibration'] * output['random_noise_electrons']).T
 
             # The sky output file represents a model fit to ~40 sky fibers.
             # We reduce the variance by a factor of 25 to account for this and
             # give the sky an independent (Gaussian) noise realization.
-            sky_ivar[j, i, :num_pixels] = 25.0 / (
-                output['variance_electrons'][:,0] - output['num_source_electrons'][:,0])
-            sky_rand_noise[j, i, :num_pixels] = random_state.normal(
-                scale=1.0 / np.sqrt(sky_ivar[j,i,:num_pixels]),size=num_pixels)
+            sky_ivar[jj, i, :num_pixels] = 25.0 / (
+                output['variance_electrons'] - output['num_source_electrons']).T
+
+        for j in range(start, stop):
+            sky_random_state = np.random.RandomState(sky_seeds[j])
+            for i, output in enumerate(qsim.camera_output):
+                num_pixels = len(output)
+                sky_rand_noise[j, i, :num_pixels] = sky_random_state.normal(
+                    scale=1.0 / np.sqrt(sky_ivar[j,i,:num_pixels]),size=num_pixels)
 
     armName={"b":0,"r":1,"z":2}
+    tasks = list()
     for channel in 'brz':
 
         #Before writing, convert from counts/bin to counts/A (as in Pixsim output)
@@ -580,82 +682,35 @@ def main(args):
                 log.info("Writing files for channel:{}, spectrograph:{}, spectra:{} to {}".format(channel,ii,start,end))
                 num_pixels = len(waves[channel])
 
-                # Write frame file
-                framefileName=desispec.io.findfile("frame",NIGHT,EXPID,camera)
+                # Collect the per-camera outputs, written in parallel below
+                task = dict(camera=camera, spectrograph=ii,
+                            flavor=simspec.flavor, wave=waves[channel],
+                            resolution=resolution[channel],
+                            fibermap=fibermap[start:end])
 
-                frame_flux=nobj[start:end,armName[channel],:num_pixels]+ \
+                task['framefile'] = desispec.io.findfile("frame",NIGHT,EXPID,camera)
+                task['frame_flux'] = nobj[start:end,armName[channel],:num_pixels]+ \
                 nsky[start:end,armName[channel],:num_pixels] + \
                 frame_rand_noise[start:end,armName[channel],:num_pixels]
-                frame_ivar=nivar[start:end,armName[channel],:num_pixels]
-
-                sh1=frame_flux.shape[0]  # required for slicing the resolution metric, resolusion matrix has (nspec,ndiag,wave)
-                                          # for example if nstart =400, nspec=150: two spectrographs:
-                                          # 400-499=> 0 spectrograph, 500-549 => 1
-                if (args.nstart==start):
-                    resol=resolution[channel][:sh1,:,:]
-                else:
-                    resol=resolution[channel][-sh1:,:,:]
-
-                # must create desispec.Frame object
-                frame=Frame(waves[channel], frame_flux, frame_ivar,\
-                    resolution_data=resol, spectrograph=ii, \
-                    fibermap=fibermap[start:end], \
-                    meta=dict(CAMERA=camera, FLAVOR=simspec.flavor) )
-                desispec.io.write_frame(framefileName, frame)
-
-                framefilePath=desispec.io.findfile("frame",NIGHT,EXPID,camera)
-                log.info("Wrote file {}".format(framefilePath))
+                task['frame_ivar'] = nivar[start:end,armName[channel],:num_pixels]
 
                 if args.frameonly or simspec.flavor == 'arc':
+                    tasks.append(task)
                     continue
 
-                # Write cframe file
-                cframeFileName=desispec.io.findfile("cframe",NIGHT,EXPID,camera)
-                cframeFlux=cframe_observedflux[start:end,armName[channel],:num_pixels]+cframe_rand_noise[start:end,armName[channel],:num_pixels]
-                cframeIvar=cframe_ivar[start:end,armName[channel],:num_pixels]
+                task['cframefile'] = desispec.io.findfile("cframe",NIGHT,EXPID,camera)
+                task['cframe_flux'] = cframe_observedflux[start:end,armName[channel],:num_pixels]+cframe_rand_noise[start:end,armName[channel],:num_pixels]
+                task['cframe_ivar'] = cframe_ivar[start:end,armName[channel],:num_pixels]
 
-                # must create desispec.Frame object
-                cframe = Frame(waves[channel], cframeFlux, cframeIvar, \
-                    resolution_data=resol, spectrograph=ii,
-                    fibermap=fibermap[start:end],
-                    meta=dict(CAMERA=camera, FLAVOR=simspec.flavor) )
-                desispec.io.frame.write_frame(cframeFileName,cframe)
+                task['skyfile'] = desispec.io.findfile("sky",NIGHT,EXPID,camera)
+                task['sky_flux'] = nsky[start:end,armName[channel],:num_pixels] + \
+                sky_rand_noise[start:end,armName[channel],:num_pixels]
+                task['sky_ivar'] = sky_ivar[start:end,armName[channel],:num_pixels]
 
-                cframefilePath=desispec.io.findfile("cframe",NIGHT,EXPID,camera)
-                log.info("Wrote file {}".format(cframefilePath))
+                task['calibfile'] = desispec.io.findfile("calib",NIGHT,EXPID,camera)
+                task['calib_flux'] = cframe_observedflux[start:end,armName[channel],:num_pixels]
+                task['calib_phot'] = nobj[start:end,armName[channel],:num_pixels]
 
-                # Write sky file
-                skyfileName=desispec.io.findfile("sky",NIGHT,EXPID,camera)
-                skyflux=nsky[start:end,armName[channel],:num_pixels] + \
-                sky_rand_noise[start:end,armName[channel],:num_pixels]
-                skyivar=sky_ivar[start:end,armName[channel],:num_pixels]
-                skymask=np.zeros(skyflux.shape, dtype=np.uint32)
-
-                # must create desispec.Sky object
-                skymodel = SkyModel(waves[channel], skyflux, skyivar, skymask,
-                    header=dict(CAMERA=camera))
-                desispec.io.sky.write_sky(skyfileName, skymodel)
-
-                skyfilePath=desispec.io.findfile("sky",NIGHT,EXPID,camera)
-                log.info("Wrote file {}".format(skyfilePath))
-
-                # Write calib file
-                calibVectorFile=desispec.io.findfile("calib",NIGHT,EXPID,camera)
-                flux = cframe_observedflux[start:end,armName[channel],:num_pixels]
-                phot = nobj[start:end,armName[channel],:num_pixels]
-                calibration = np.zeros_like(phot)
-                jj = (flux>0)
-                calibration[jj] = phot[jj] / flux[jj]
-
-                #- TODO: what should calibivar be?
-                #- For now, model it as the noise of combining ~10 spectra
-                calibivar=10/cframe_ivar[start:end,armName[channel],:num_pixels]
-                #mask=(1/calibivar>0).astype(int)??
-                mask=np.zeros(calibration.shape, dtype=np.uint32)
-
-                # write flux calibration
-                fluxcalib = FluxCalib(waves[channel], calibration, calibivar, mask)
-                write_flux_calibration(calibVectorFile, fluxcalib)
-
-                calibfilePath=desispec.io.findfile("calib",NIGHT,EXPID,camera)
-                log.info("Wrote file {}".format(calibfilePath))
+                tasks.append(task)
+
+    write_camera_outputs(tasks, ncpu=args.ncpu)
@@ -23,6 +23,7 @@ from desisim.lya_spectra import read_lya_skewers , apply_lya_transmission, apply
 from desisim.dla import dla_spec,insert_dlas
 from desisim.bal import BAL
 from desisim.io import empty_metatable
+import desisim.rng
 from desisim.eboss import FootprintEBOSS, sdss_subsample, RedshiftDistributionEBOSS, sdss_subsample_redshift
 from desispec.interpolation import resample_flux
 
@@ -147,6 +148,8 @@ Use 'all' or no argument for mock version < 7.3 or final metal runs. ",nargs='?'
 
     parser.add_argument('--save-resolution',action='store_true', help="Save full resolution in spectra file. By default only one matrix is saved in the truth file.")
 
+    parser.add_argument('--obscache-dir', type=str, default=None, help="Directory to cache sky/dark/read noise products shared by all input files with the same observing conditions")
+
     if options is None:
         args = parser.parse_args()
     else:
@@ -260,6 +263,9 @@ def get_pixel_seed(pixel, nside, global_seed):
     if global_seed is None:
         # return a random seed
         return np.random.randint(2**32, size=1)[0]
+    if desisim.rng.get_engine() != 'legacy':
+        # seed for this pixel only, without drawing seeds for every pixel
+        return desisim.rng.generator(global_seed, key=(nside, pixel)).integers(2**32)
     npix=healpy.nside2npix(nside)
     np.random.seed(global_seed)
     seeds = np.unique(np.random.randint(2**32, size=10*npix))[:npix]
@@ -726,7 +732,8 @@ def simulate_one_healpix(ifilename,args,model,obsconditions,decam_and_wise_filte
     resolution=sim_spectra(qso_wave,qso_flux, args.program, obsconditions=obsconditions,spectra_filename=ofilename,
                            sourcetype="qso", skyerr=args.skyerr,ra=metadata["RA"],dec=metadata["DEC"],targetid=targetid,
                            meta=specmeta,seed=seed,fibermap_columns=fibermap_columns,use_poisson=False,
-                           specsim_config_file=specsim_config_file, dwave_out=dwave_out, save_resolution=args.save_resolution)
+                           specsim_config_file=specsim_config_file, dwave_out=dwave_out, save_resolution=args.save_resolution,
+                           obscache_dir=args.obscache_dir)
 
     ### Keep input redshift
     Z_spec = metadata['Z'].copy()
@@ -22,9 +22,42 @@ import desitarget
 from desispec.spectra import Spectra
 from desispec.resolution import Resolution
 
+def make_spectra_fibermap(frame_fibermap, night, expid, tileid=0):
+    """
+    Returns a Spectra fibermap filled with the columns of a frame fibermap
+
+    Args:
+        frame_fibermap : frame fibermap Table, e.g. from desispec.io.empty_fibermap
+        night : night to record in the NIGHT column
+        expid : exposure ID to record in the EXPID column
+        tileid : tile ID to record in the TILEID column
+
+    Columns are copied in bulk, casting to the dtype of the standard
+    fibermap columns; extra columns of frame_fibermap are appended.
+    """
+    nspec = len(frame_fibermap)
+
+    # spectra fibermap has two extra fields : night and expid
+    # This would be cleaner if desispec would provide the spectra equivalent
+    # of desispec.io.empty_fibermap()
+    spectra_fibermap = desispec.io.empty_fibermap(nspec)
+    spectra_fibermap = desispec.io.util.add_columns(spectra_fibermap,
+                       ['NIGHT', 'EXPID', 'TILEID'],
+                       [np.int32(night), np.int32(expid), np.int32(tileid)],
+                       )
+
+    for colname in frame_fibermap.colnames:
+        if colname in spectra_fibermap.colnames:
+            spectra_fibermap[colname][:] = frame_fibermap[colname]
+        else:
+            spectra_fibermap[colname] = frame_fibermap[colname]
+
+    return spectra_fibermap
+
 def sim_spectra(wave, flux, program, spectra_filename, obsconditions=None,
                 sourcetype=None, targetid=None, redshift=None, expid=0, seed=0, skyerr=0.0, ra=None,
-                dec=None, meta=None, fibermap_columns=None, fullsim=False, use_poisson=True, specsim_config_file="desi", dwave_out=None, save_resolution=True):
+                dec=None, meta=None, fibermap_columns=None, fullsim=False, use_poisson=True, specsim_config_file="desi", dwave_out=None, save_resolution=True, blocksize=None, shared_resolution=False, obscache_dir=None,
+                fiberloss_method=None):
     """
     Simulate spectra from an input set of wavelength and flux and writes a FITS file in the Spectra format that can
     be used as input to the redshift fitter.
@@ -54,6 +87,17 @@ def sim_spectra(wave, flux, program, spectra_filename, obsconditions=None,
         realizations.
         save_resolution : if True it will save the Resolution matrix for each spectra.
         If False returns a resolution matrix (useful for mocks to save disk space).
+        shared_resolution : if True (and save_resolution), write a single Resolution matrix per band
+        instead of one per spectrum to reduce the file size; read it back with desisim.io.read_spectra.
+        This does not reduce memory usage while simulating.
+        blocksize : if not None, simulate spectra in blocks of this many fibers to limit memory usage,
+        rounded up to a multiple of desisim.simexp.noise_chunksize.
+        The noise is then generated with a random stream per chunk of fibers and does not depend on
+        blocksize, but it differs from the realization with blocksize=None.
+        obscache_dir : if not None, directory where sky, dark and read noise products are cached per
+        observing conditions, to be reused by other processes and runs with the same conditions.
+        fiberloss_method : if not None, override the specsim fiberloss method; 'grid' interpolates
+        galsim fiberlosses precomputed in $DESISIM_FIBERLOSS_GRID, see desisim.fiberloss.
     """ 
     log = get_logger()
     
@@ -100,19 +144,9 @@ def sim_spectra(wave, flux, program, spectra_filename, obsconditions=None,
     # add TARGETID
     frame_fibermap['TARGETID'] = targetid
          
-    # spectra fibermap has two extra fields : night and expid
-    # This would be cleaner if desispec would provide the spectra equivalent
-    # of desispec.io.empty_fibermap()
-    spectra_fibermap = desispec.io.empty_fibermap(nspec)
-    spectra_fibermap = desispec.io.util.add_columns(spectra_fibermap,
-                       ['NIGHT', 'EXPID', 'TILEID'],
-                       [np.int32(night), np.int32(expid), np.int32(tileid)],
-                       )
+    spectra_fibermap = make_spectra_fibermap(frame_fibermap, night=night,
+                                             expid=expid, tileid=tileid)
 
-    for s in range(nspec):
-        for tp in frame_fibermap.dtype.fields:
-            spectra_fibermap[s][tp] = frame_fibermap[s][tp]
- 
     if ra is not None :
         spectra_fibermap["TARGET_RA"] = ra
         spectra_fibermap["FIBER_RA"]    = ra
@@ -182,22 +216,31 @@ def sim_spectra(wave, flux, program, spectra_filename, obsconditions=None,
     wave = wave[ii]*u.Angstrom
     flux = flux[:,ii]*flux_unit
 
+    if fullsim and blocksize is not None :
+        raise ValueError('fullsim is not supported with blocksize')
+
+    if blocksize is not None :
+        resolution = _sim_spectra_blocks(wave, flux, spectra_filename,
+            frame_fibermap, spectra_fibermap, obsconditions=obsconditions,
+            redshift=redshift, seed=seed, skyerr=skyerr, meta=meta,
+            use_poisson=use_poisson, specsim_config_file=specsim_config_file,
+            dwave_out=dwave_out, save_resolution=save_resolution,
+            blocksize=blocksize, shared_resolution=shared_resolution,
+            obscache_dir=obscache_dir, fiberloss_method=fiberloss_method)
+        if not save_resolution :
+            return resolution
+        return
+
     sim = desisim.simexp.simulate_spectra(wave, flux, fibermap=frame_fibermap,
         obsconditions=obsconditions, redshift=redshift, seed=seed,
-        psfconvolve=True, specsim_config_file=specsim_config_file, dwave_out=dwave_out)
+        psfconvolve=True, specsim_config_file=specsim_config_file, dwave_out=dwave_out,
+        obscache=obscache_dir is not None, cachedir=obscache_dir,
+        fiberloss_method=fiberloss_method)
 
     random_state = np.random.RandomState(seed)
     sim.generate_random_noise(random_state,use_poisson=use_poisson)
 
-    scale=1e17
-    specdata = None
-
-    resolution={}
-    for camera in sim.instrument.cameras:
-        R = Resolution(camera.get_output_resolution_matrix())
-        resolution[camera.name] = np.tile(R.to_fits_array(), [nspec, 1, 1])
-        if not save_resolution :
-            resolution[camera.name] = R.to_fits_array()
+    resolution = _get_resolution(sim)
 
     skyscale = skyerr * random_state.normal(size=sim.num_fibers)
 
@@ -208,78 +251,148 @@ def sim_spectra(wave, flux, program, spectra_filename, obsconditions=None,
             table.write(table_filename,format="fits",overwrite=True)
             print("wrote",table_filename)
 
-    if specsim_config_file == "eboss":
-        for table in sim._eboss_camera_output:
-            wave = table['wavelength'].astype(float)
-            flux = (table['observed_flux']+table['random_noise_electrons']*table['flux_calibration']).T.astype(float)
-            if np.any(skyscale):
-                flux += ((table['num_sky_electrons']*skyscale)*table['flux_calibration']).T.astype(float)
+    bands = list()
+    outwave = dict()
+    outflux = dict()
+    outivar = dict()
+    for table in _camera_tables(sim, specsim_config_file) :
+        band  = table.meta['name'].strip()[0]
+        bands.append(band)
+        outwave[band] = table['wavelength'].astype(float)
+        outflux[band], outivar[band] = _observed_flux_ivar(table, skyscale)
 
-            ivar = table['flux_inverse_variance'].T.astype(float)
-            
-            band  = table.meta['name'].strip()[0]
-            
-            flux = flux * scale
-            ivar = ivar / scale**2
-            mask  = np.zeros(flux.shape).astype(int)
-            
-            spec = Spectra([band], {band : wave}, {band : flux}, {band : ivar}, 
-                        resolution_data=None, 
-                        mask={band : mask}, 
-                        fibermap=spectra_fibermap, 
-                        meta=meta,
-                        single=True)
-            
-            if specdata is None :
-                specdata = spec
-            else :
-                specdata.update(spec)
-    
+    _write_sim_spectra(spectra_filename, bands, outwave, outflux, outivar,
+        resolution, spectra_fibermap, meta, save_resolution=save_resolution,
+        shared_resolution=shared_resolution,
+        specsim_config_file=specsim_config_file)
+
+    if not save_resolution :
+        return resolution
+
+def _get_resolution(sim):
+    """Returns dict of the fits resolution data of each camera of sim"""
+    resolution = dict()
+    for camera in sim.instrument.cameras:
+        R = Resolution(camera.get_output_resolution_matrix())
+        resolution[camera.name] = R.to_fits_array()
+    return resolution
+
+def _camera_tables(sim, specsim_config_file):
+    """Returns the per-camera output tables of sim"""
+    if specsim_config_file == "eboss":
+        return sim._eboss_camera_output
     else:
-        for table in sim.camera_output :
-            wave = table['wavelength'].astype(float)
-            flux = (table['observed_flux']+table['random_noise_electrons']*table['flux_calibration']).T.astype(float)
-            if np.any(skyscale):
-                flux += ((table['num_sky_electrons']*skyscale)*table['flux_calibration']).T.astype(float)
+        return sim.camera_output
 
-            ivar = table['flux_inverse_variance'].T.astype(float)
-            
-            band  = table.meta['name'].strip()[0]
-            
-            flux = flux * scale
-            ivar = ivar / scale**2
-            mask  = np.zeros(flux.shape).astype(int)
-            
-            if not save_resolution :
-                spec = Spectra([band], {band : wave}, {band : flux}, {band : ivar},
-                        resolution_data=None,
-                        mask={band : mask},
-                        fibermap=spectra_fibermap,
-                        meta=meta,
-                        single=True)
-            else :
-                spec = Spectra([band], {band : wave}, {band : flux}, {band : ivar},
-                        resolution_data={band : resolution[band]},
-                        mask={band : mask},
-                        fibermap=spectra_fibermap,
-                        meta=meta,
-                        single=True)
-            
-            if specdata is None :
-                specdata = spec
-            else :
-                specdata.update(spec)
-    
-    desispec.io.write_spectra(spectra_filename, specdata)        
+def _observed_flux_ivar(table, skyscale, scale=1e17):
+    """
+    Returns noisy flux and ivar [nspec, nwave] arrays of a camera output table,
+    including sky residuals scaled by skyscale[nspec], in units of 1/scale
+    """
+    flux = table['observed_flux']+table['random_noise_electrons']*table['flux_calibration']
+    if np.any(skyscale):
+        flux = flux + table['num_sky_electrons']*skyscale*table['flux_calibration']
+    flux = np.asarray(flux).T * scale
+    ivar = np.asarray(table['flux_inverse_variance']).T / scale**2
+    return flux, ivar
+
+def _write_sim_spectra(spectra_filename, bands, wave, flux, ivar, resolution,
+                       spectra_fibermap, meta, save_resolution=True,
+                       shared_resolution=False, specsim_config_file="desi"):
+    """
+    Writes simulated spectra, as assembled by sim_spectra and _sim_spectra_blocks
+
+    wave, flux, ivar are dicts keyed by band, and resolution is a dict
+    of the per-band resolution data shared by all spectra
+    """
+    log = get_logger()
+    resolution_data = None
+    if save_resolution and not shared_resolution and specsim_config_file != "eboss":
+        resolution_data = dict()
+        for band in bands :
+            nspec = flux[band].shape[0]
+            resolution_data[band] = np.broadcast_to(resolution[band],
+                                                    (nspec,)+resolution[band].shape)
+
+    mask = dict()
+    for band in bands :
+        mask[band] = np.zeros(flux[band].shape).astype(int)
+
+    specdata = Spectra(bands, wave, flux, ivar,
+                       resolution_data=resolution_data,
+                       mask=mask,
+                       fibermap=spectra_fibermap,
+                       meta=meta,
+                       single=True)
+
+    desispec.io.write_spectra(spectra_filename, specdata)
+    if shared_resolution and save_resolution and specsim_config_file != "eboss" :
+        desisim.io.write_shared_resolution(spectra_filename, resolution)
     log.info('Wrote '+spectra_filename)
-    
-    # need to clear the simulation buffers that keeps growing otherwise
-    # because of a different number of fibers each time ...
-    desisim.specsim._simulators.clear()
-    desisim.specsim._simdefaults.clear()
 
-    if not save_resolution :
-        return resolution
+def _sim_spectra_blocks(wave, flux, spectra_filename, frame_fibermap,
+                        spectra_fibermap, obsconditions, redshift=None, seed=0,
+                        skyerr=0.0, meta=None, use_poisson=True,
+                        specsim_config_file="desi", dwave_out=None,
+                        save_resolution=True, blocksize=500,
+                        shared_resolution=False, obscache_dir=None,
+                        fiberloss_method=None):
+    """
+    Streaming version of sim_spectra, simulating blocksize spectra at a time
+
+    Only the output flux and ivar arrays are kept for all spectra; the
+    specsim tables are reused from one block to the next.  blocksize is
+    rounded up to a multiple of desisim.simexp.noise_chunksize, so that the
+    noise does not depend upon it.
+    Returns the resolution matrix per band.
+    """
+    log = get_logger()
+    nspec = flux.shape[0]
+
+    chunksize = desisim.simexp.noise_chunksize
+    if blocksize % chunksize != 0:
+        blocksize = chunksize * max(1, -(-blocksize // chunksize))
+        log.debug('Rounding blocksize up to {}'.format(blocksize))
+
+    #- Random draws independent of blocksize
+    random_state = np.random.RandomState(seed)
+    noise_seed = random_state.randint(2**32)
+    skyscale = skyerr * random_state.normal(size=nspec)
+
+    bands = list()
+    outwave = dict()
+    outflux = dict()
+    outivar = dict()
+    for start, stop, sim in desisim.simexp.iter_simulate_spectra(wave, flux,
+            fibermap=frame_fibermap, obsconditions=obsconditions,
+            redshift=redshift, seed=seed, psfconvolve=True,
+            specsim_config_file=specsim_config_file, dwave_out=dwave_out,
+            blocksize=blocksize, obscache=obscache_dir is not None,
+            cachedir=obscache_dir,
+            fiberloss_method=fiberloss_method):
+
+        desisim.simexp.generate_fiber_noise(sim, noise_seed, first_fiber=start,
+            use_poisson=use_poisson)
+
+        for table in _camera_tables(sim, specsim_config_file) :
+            band = table.meta['name'].strip()[0]
+            if band not in outflux :
+                bands.append(band)
+                outwave[band] = table['wavelength'].astype(float)
+                outflux[band] = np.zeros((nspec, len(table)))
+                outivar[band] = np.zeros((nspec, len(table)))
+
+            outflux[band][start:stop], outivar[band][start:stop] = \
+                _observed_flux_ivar(table, skyscale[start:stop])
+
+    resolution = _get_resolution(sim)
+
+    _write_sim_spectra(spectra_filename, bands, outwave, outflux, outivar,
+        resolution, spectra_fibermap, meta, save_resolution=save_resolution,
+        shared_resolution=shared_resolution,
+        specsim_config_file=specsim_config_file)
+
+    return resolution
 
 
 def parse(options=None):
@@ -305,6 +418,10 @@ def parse(options=None):
     parser.add_argument('--source-type', type=str, default=None, help="Source type (for fiber loss), among sky,elg,lrg,qso,bgs,star")
     parser.add_argument('--skyerr', type=float, default=0.0, help="Fractional sky subtraction error")
     parser.add_argument('--fullsim',action='store_true',help="write full simulation data in extra file per camera, for debugging")
+    parser.add_argument('--shared-resolution', action='store_true', help="Write one resolution matrix per band instead of one per spectrum")
+    parser.add_argument('--blocksize', type=int, default=None, help="Simulate spectra in blocks of this many fibers to limit memory usage")
+    parser.add_argument('--fiberloss-method', type=str, default=None, choices=['table', 'fastsim', 'galsim'], help="Fiberloss method")
+    parser.add_argument('--obscache-dir', type=str, default=None, help="Directory to cache sky/dark/read noise products per observing conditions")
 
     if options is None:
         args = parser.parse_args()
@@ -401,5 +518,7 @@ def main(args=None):
    
     sim_spectra(input_wave, input_flux, args.program, obsconditions=obsconditions,
         spectra_filename=args.out_spectra,seed=args.seed,sourcetype=sourcetype,
-        skyerr=args.skyerr,fullsim=args.fullsim)
+        skyerr=args.skyerr,fullsim=args.fullsim,blocksize=args.blocksize,
+        shared_resolution=args.shared_resolution, obscache_dir=args.obscache_dir,
+        fiberloss_method=args.fiberloss_method)
     
@@ -4,6 +4,7 @@ import sys
 import os.path
 import warnings
 import datetime, time
+from collections import OrderedDict
 
 import numpy as np
 
@@ -25,6 +26,9 @@ from desiutil.iers import freeze_iers
 import desispec.interpolation
 import desisim.io
 import desisim.specsim
+import desisim.fiberloss
+import desisim.cosmology
+import desisim.rng
 
 #- Reference observing conditions for each of dark, gray, bright
 reference_conditions = dict(DARK=dict(), GRAY=dict(), BRIGHT=dict())
@@ -363,7 +367,8 @@ def fibermeta2fibermap(fiberassign, meta):
 
 def simulate_spectra(wave, flux, fibermap=None, obsconditions=None, redshift=None,
                      dwave_out=None, seed=None, psfconvolve=True,
-                     specsim_config_file = "desi"):
+                     specsim_config_file = "desi", obscache=False, cachedir=None,
+                     fiberloss_method=None):
     '''
     Simulates an exposure without reading/writing data files
 
@@ -382,12 +387,59 @@ def simulate_spectra(wave, flux, fibermap=None, obsconditions=None, redshift=Non
             if True, convolve with PSF and include per-camera outputs
         specsim_config_file (str, optional): path to DESI instrument config file.
             default is desi config in specsim package.
+        obscache (bool, optional): reuse sky, dark and read noise products
+            cached per observing conditions, see desisim.specsim.simulate
+        cachedir (str, optional): if obscache, directory to persist those
+            products across processes and runs
+        fiberloss_method (str, optional): override the specsim fiberloss
+            method, 'table', 'fastsim', 'galsim', or 'grid' to interpolate
+            galsim fiberlosses precomputed by desisim.fiberloss in
+            $DESISIM_FIBERLOSS_GRID
 
     Returns:
         A specsim.simulator.Simulator object
 
+    See iter_simulate_spectra() to simulate large numbers of spectra in
+    fixed size blocks of fibers.
+
     TODO: galsim support
 
+    '''
+    nspec = flux.shape[0]
+    for start, stop, sim in iter_simulate_spectra(wave, flux,
+            fibermap=fibermap, obsconditions=obsconditions, redshift=redshift,
+            dwave_out=dwave_out, seed=seed, psfconvolve=psfconvolve,
+            specsim_config_file=specsim_config_file, blocksize=nspec,
+            obscache=obscache, cachedir=cachedir,
+            fiberloss_method=fiberloss_method):
+        pass
+
+    return sim
+
+def iter_simulate_spectra(wave, flux, fibermap=None, obsconditions=None,
+                          redshift=None, dwave_out=None, seed=None,
+                          psfconvolve=True, specsim_config_file="desi",
+                          blocksize=500, obscache=False, cachedir=None,
+                          fiberloss_method=None):
+    '''
+    Simulates an exposure in blocks of blocksize fibers
+
+    Args:
+        wave, flux, fibermap, obsconditions, redshift, dwave_out, seed,
+        psfconvolve, specsim_config_file, obscache, cachedir,
+            fiberloss_method: see simulate_spectra()
+        blocksize (int, optional): number of spectra simulated at once
+
+    Yields:
+        (start, stop, sim) for each block, where sim is a
+        specsim.simulator.Simulator object holding the simulation of spectra
+        flux[start:stop]
+
+    The same Simulator object is reused for every block, so its outputs
+    must be consumed before advancing to the next block.  Memory thus scales
+    with blocksize instead of the total number of spectra.  Random draws
+    per spectrum are made for all spectra up front so that results do not
+    depend upon blocksize.
     '''
     import specsim.simulator
     import specsim.config
@@ -399,9 +451,7 @@ def simulate_spectra(wave, flux, fibermap=None, obsconditions=None, redshift=Non
     freeze_iers()
 
     # Input cosmology to calculate the angular diameter distance of the galaxy's redshift
-    from astropy.cosmology import FlatLambdaCDM
-    LCDM = FlatLambdaCDM(H0=70, Om0=0.3)
-    ang_diam_dist = LCDM.angular_diameter_distance
+    ang_diam_dist = desisim.cosmology.get_lcdm(H0=70, Om0=0.3).angular_diameter_distance
 
     random_state = np.random.RandomState(seed)
 
@@ -418,10 +468,14 @@ def simulate_spectra(wave, flux, fibermap=None, obsconditions=None, redshift=Non
     log.debug('loading specsim desi config {}'.format(specsim_config_file))
     config = _specsim_config_for_wave(wave.to('Angstrom').value, dwave_out=dwave_out, specsim_config_file=specsim_config_file)
 
+    if blocksize is None or blocksize < 1:
+        blocksize = nspec
+    blocksize = min(blocksize, nspec)
+
     #- Create simulator
     log.debug('creating specsim desi simulator')
     # desi = specsim.simulator.Simulator(config, num_fibers=nspec)
-    desi = desisim.specsim.get_simulator(config, num_fibers=nspec,
+    desi = desisim.specsim.get_simulator(config, num_fibers=blocksize,
         camera_output=psfconvolve)
 
     if obsconditions is None:
@@ -484,10 +538,17 @@ def simulate_spectra(wave, flux, fibermap=None, obsconditions=None, redshift=Non
     # source types are sky elg lrg qso bgs star , they
     # are only used in specsim.fiberloss for the desi.instrument.fiberloss_method="table" method
 
-    if specsim_config_file == "desi":
-        desi.instrument.fiberloss_method = 'fastsim'
+    if fiberloss_method is None:
+        if specsim_config_file == "desi":
+            fiberloss_method = 'fastsim'
+        else:
+            fiberloss_method = desi.instrument.fiberloss_method
+
+    #- 'grid' is interpolated by desisim, not specsim
+    if fiberloss_method != 'grid':
+        desi.instrument.fiberloss_method = fiberloss_method
 
-    log.debug('running simulation with {} fiber loss method'.format(desi.instrument.fiberloss_method))
+    log.debug('running simulation with {} fiber loss method'.format(fiberloss_method))
 
     unique_source_types = set(source_types)
     comment_line="source types:"
@@ -500,8 +561,8 @@ def simulate_spectra(wave, flux, fibermap=None, obsconditions=None, redshift=Non
     source_minor_major_axis_ratio=None
     source_position_angle=None
 
-    if desi.instrument.fiberloss_method == 'fastsim' or desi.instrument.fiberloss_method == 'galsim' :
-        # the following parameters are used only with fastsim and galsim methods
+    if fiberloss_method in ('fastsim', 'galsim', 'grid'):
+        # the following parameters are used only with fastsim, galsim and grid methods
 
         elgs=(source_types=="elg")
         lrgs=(source_types=="lrg")
@@ -559,8 +620,8 @@ def simulate_spectra(wave, flux, fibermap=None, obsconditions=None, redshift=Non
         source_half_light_radius[bgss,0]= bgs_disk_z01 * angscales # disk comp in BGS, arcsec
         source_half_light_radius[bgss,1]= bgs_bulge_z01 * angscales  # bulge comp in BGS, arcsec
 
-        if desi.instrument.fiberloss_method == 'galsim' :
-            # the following parameters are used only with galsim method
+        if fiberloss_method in ('galsim', 'grid'):
+            # the following parameters are used only with galsim and grid methods
 
             # source_minor_major_axis_ratio[:,0] is the axis ratio for the DISK profile
             # source_minor_major_axis_ratio[:,1] is the axis ratio for the BULGE profile
@@ -578,19 +639,94 @@ def simulate_spectra(wave, flux, fibermap=None, obsconditions=None, redshift=Non
             source_position_angle[lrgs,1]=random_angles[lrgs]
             source_position_angle[bgss,1]=random_angles[bgss]
 
-    #- Work around randomness in specsim quickfiberloss calculations
-    #- while not impacting global random state.
-    #- See https://github.com/desihub/specsim/issues/83
-    randstate = np.random.get_state()
-    np.random.seed(seed)
-    desi.simulate(source_fluxes=flux, focal_positions=xy, source_types=source_types,
-                  source_fraction=source_fraction,
-                  source_half_light_radius=source_half_light_radius,
-                  source_minor_major_axis_ratio=source_minor_major_axis_ratio,
-                  source_position_angle=source_position_angle)
-    np.random.set_state(randstate)
+    def _block(x, start, stop):
+        return None if x is None else x[start:stop]
+
+    #- eBOSS simulators have their own simulate() with extra outputs
+    if obscache and hasattr(desi, '_eboss_camera_output'):
+        obscache = False
+
+    for start in range(0, nspec, blocksize):
+        stop = min(start + blocksize, nspec)
+        if desi.num_fibers != stop - start:
+            desisim.specsim.resize_simulator(desi, stop - start)
+
+        if nspec > blocksize:
+            log.debug('simulating spectra {}:{}'.format(start, stop))
+
+        #- Work around randomness in specsim quickfiberloss calculations
+        #- while not impacting global random state.
+        #- See https://github.com/desihub/specsim/issues/83
+        randstate = np.random.get_state()
+        np.random.seed(seed)
+        sourceargs = dict(
+            source_types=source_types[start:stop],
+            source_fraction=_block(source_fraction, start, stop),
+            source_half_light_radius=_block(source_half_light_radius, start, stop),
+            source_minor_major_axis_ratio=_block(source_minor_major_axis_ratio, start, stop),
+            source_position_angle=_block(source_position_angle, start, stop))
+        if fiberloss_method == 'grid':
+            sourceargs['fiber_acceptance_fraction'] = \
+                desisim.fiberloss.calculate_fiber_acceptance_fraction(
+                    xy[start:stop, 0], xy[start:stop, 1],
+                    desi.simulated['wavelength'].quantity,
+                    desi.atmosphere, desi.instrument,
+                    sourceargs['source_fraction'],
+                    sourceargs['source_half_light_radius'],
+                    sourceargs['source_minor_major_axis_ratio'])
+        if obscache:
+            desisim.specsim.simulate(desi, flux[start:stop], xy[start:stop],
+                                     cachedir=cachedir, **sourceargs)
+        else:
+            desi.simulate(source_fluxes=flux[start:stop],
+                          focal_positions=xy[start:stop], **sourceargs)
+        np.random.set_state(randstate)
+
+        yield start, stop, desi
+
+#- Number of consecutive fibers whose noise is drawn from one random stream
+#- in generate_fiber_noise
+noise_chunksize = 25
 
-    return desi
+def generate_fiber_noise(sim, seed, first_fiber=0, use_poisson=True):
+    '''
+    Generate a random noise realization for the fibers of a simulation
+
+    Args:
+        sim: specsim.simulator.Simulator object after sim.simulate()
+        seed (int): random seed of the full set of simulated fibers
+        first_fiber (int, optional): index of the first fiber of sim in that
+            set; must be a multiple of noise_chunksize
+        use_poisson (bool, optional): if False, use gaussian instead of
+            poisson noise; see specsim Simulator.generate_random_noise
+
+    Like sim.generate_random_noise(), but the noise of each chunk of
+    noise_chunksize consecutive fibers is drawn from its own
+    desisim.rng.generator(seed, key=chunk) stream.  The noise of a given
+    fiber therefore does not depend upon how many fibers are simulated
+    together, as long as every block of fibers starts at a multiple of
+    noise_chunksize.
+    '''
+    if first_fiber % noise_chunksize != 0:
+        raise ValueError('first_fiber {} is not a multiple of {}'.format(
+            first_fiber, noise_chunksize))
+
+    outputs = sim.camera_output
+    nfibers = sim.num_fibers
+    for lo in range(0, nfibers, noise_chunksize):
+        hi = min(lo + noise_chunksize, nfibers)
+        rng = desisim.rng.generator(seed, key=(first_fiber + lo) // noise_chunksize)
+        for output in outputs:
+            mean_electrons = np.asarray(output['num_source_electrons'][:, lo:hi] +
+                output['num_sky_electrons'][:, lo:hi] +
+                output['num_dark_electrons'][:, lo:hi])
+            read_noise = np.asarray(output['read_noise_electrons'][:, lo:hi])
+            if use_poisson:
+                noise = (rng.poisson(mean_electrons) - mean_electrons +
+                    rng.normal(scale=read_noise))
+            else:
+                noise = rng.normal(scale=np.sqrt(mean_electrons + read_noise**2))
+            output['random_noise_electrons'][:, lo:hi] = noise
 
 def _specsim_config_for_wave(wave, dwave_out=None, specsim_config_file = "desi"):
     '''
@@ -753,7 +889,7 @@ def testslit_fibermap():
 #- MOVE THESE TO desitarget.mocks.io (?)
 #-------------------------------------------------------------------------
 
-def get_mock_spectra(fiberassign, mockdir=None, nside=64, obscon=None):
+def get_mock_spectra(fiberassign, mockdir=None, nside=64, obscon=None, nproc=None):
     '''
     Args:
         fiberassign: table loaded from fiberassign tile file
@@ -762,9 +898,13 @@ def get_mock_spectra(fiberassign, mockdir=None, nside=64, obscon=None):
         mockdir (str): base directory under which files are found
         nside (int): healpix nside for file directory grouping
         obscon (str): (observing conditions) None/dark/bright extra dir level
+        nproc (int): number of processes reading truth files in parallel;
+            default cpu_count()//2, at most the number of truth files
 
     Returns (flux, wave, meta) tuple
     '''
+    import multiprocessing as mp
+
     nspec = len(fiberassign)
     flux = None
     meta = None
@@ -784,15 +924,32 @@ def get_mock_spectra(fiberassign, mockdir=None, nside=64, obscon=None):
     unassigned |= (fiberassign['TARGETID'] < 0)
     ## TODO: check desi_mask.NO_TARGET once that bit exists
 
-    for truthfile, targetids in zip(*targets2truthfiles(
-                        fiberassign[~unassigned], basedir=mockdir, nside=nside,
-                        obscon=obscon)):
+    truthfiles, truthtargetids = targets2truthfiles(
+        fiberassign[~unassigned], basedir=mockdir, nside=nside, obscon=obscon)
+
+    #- Sky fibers aren't in the truth files
+    truthtargetids = [targetids[~np.in1d(targetids, skyids)]
+                      for targetids in truthtargetids]
 
-        #- Sky fibers aren't in the truth files
-        ok = ~np.in1d(targetids, skyids)
+    #- Read the truth files in parallel; fitsio holds the GIL while reading,
+    #- so this uses processes rather than threads
+    if nproc is None:
+        nproc = mp.cpu_count() // 2
+    nproc = max(1, min(nproc, len(truthfiles)))
 
-        tmpflux, tmpwave, tmpmeta, tmpobjmeta = read_mock_spectra(truthfile, targetids[ok])
+    if nproc > 1:
+        with mp.Pool(nproc) as pool:
+            results = pool.starmap(read_mock_spectra, zip(truthfiles, truthtargetids))
+    else:
+        results = [read_mock_spectra(truthfile, targetids)
+                   for truthfile, targetids in zip(truthfiles, truthtargetids)]
+
+    #- TARGETID -> fiber index of assigned fibers
+    assigned = np.where(~unassigned)[0]
+    fiber_order = assigned[np.argsort(fiberassign['TARGETID'][assigned])]
+    sorted_fiber_targetids = np.asarray(fiberassign['TARGETID'])[fiber_order]
 
+    for tmpflux, tmpwave, tmpmeta, tmpobjmeta in results:
         if flux is None:
             nwave = tmpflux.shape[1]
             flux = np.zeros((nspec, nwave))
@@ -803,7 +960,7 @@ def get_mock_spectra(fiberassign, mockdir=None, nside=64, obscon=None):
             for key in tmpobjmeta.keys():
                 objmeta[key] = list()
 
-        ii = np.in1d(fiberassign['TARGETID'], tmpmeta['TARGETID'])
+        ii = fiber_order[np.searchsorted(sorted_fiber_targetids, tmpmeta['TARGETID'])]
         flux[ii] = tmpflux
         meta[ii] = tmpmeta
         assert np.all(wave == tmpwave)
@@ -826,6 +983,79 @@ def get_mock_spectra(fiberassign, mockdir=None, nside=64, obscon=None):
 
     return flux, wave, astropy.table.Table(meta), objmeta
 
+#- Cached TARGETID -> row index of truth file HDUs, keyed by
+#- (truthfile, extname) and invalidated when the file is modified;
+#- most recently used last, at most max_truth_index HDUs
+_truth_index = OrderedDict()
+max_truth_index = 64
+
+def _get_truth_index(fx, truthfile, extname, columns=('TARGETID',)):
+    '''
+    Returns cached columns of a truth file table HDU plus argsort of TARGETID
+
+    Args:
+        fx: open fitsio.FITS object for truthfile
+        truthfile (str): filename, used as cache key
+        extname (str): table HDU name
+        columns (tuple): columns to read; must include TARGETID
+
+    Returns (data, isort) where data[columns] are numpy arrays for all rows
+    and data['TARGETID'][isort] is sorted
+    '''
+    mtime = os.path.getmtime(truthfile)
+    key = (os.path.abspath(truthfile), extname)
+    if key in _truth_index:
+        _truth_index.move_to_end(key)
+        cached_mtime, data, isort = _truth_index[key]
+        if cached_mtime == mtime and set(columns) <= set(data.dtype.names):
+            return data, isort
+
+    data = fx[extname].read(columns=list(columns))
+    isort = np.argsort(data['TARGETID'], kind='stable')
+    _truth_index[key] = (mtime, data, isort)
+    while len(_truth_index) > max(1, max_truth_index):
+        _truth_index.popitem(last=False)
+    return data, isort
+
+def _find_rows(index, isort, targetids):
+    '''
+    Returns rows of an index with index['TARGETID'][rows] == targetids
+
+    Raises ValueError listing any targetids that are not in the index
+    '''
+    sortedids = index['TARGETID'][isort]
+    k = np.searchsorted(sortedids, targetids).clip(0, max(len(sortedids)-1, 0))
+    missing = (len(sortedids) == 0) | (sortedids[k] != targetids)
+    if np.any(missing):
+        raise ValueError('missing TARGETIDs {}'.format(np.asarray(targetids)[missing]))
+    return isort[k]
+
+def _read_image_rows(hdu, rows, maxgap=16):
+    '''
+    Reads rows of a 2D fitsio image HDU
+
+    Args:
+        hdu: fitsio ImageHDU
+        rows: sorted unique row indices
+        maxgap (int): gaps of up to maxgap unneeded rows are read through
+            rather than starting a new read
+
+    Returns 2D array of the requested rows
+    '''
+    rows = np.asarray(rows)
+    if len(rows) == 0:
+        ncol = hdu.get_dims()[1]
+        return np.zeros((0, ncol), dtype=hdu[0:1, :].dtype)
+
+    #- Split into blocks of nearly contiguous rows
+    breaks = np.where(np.diff(rows) > maxgap+1)[0] + 1
+    blocks = list()
+    for block in np.split(rows, breaks):
+        data = hdu[block[0]:block[-1]+1, :]
+        blocks.append(data[block - block[0]])
+
+    return np.vstack(blocks)
+
 def read_mock_spectra(truthfile, targetids, mockdir=None):
     r'''
     Reads mock spectra from a truth file
@@ -840,7 +1070,11 @@ def read_mock_spectra(truthfile, targetids, mockdir=None):
         wave[nwave]: wavelengths in Angstroms
         truth[nspec]: metadata truth table
         objtruth: dictionary keyed by objtype type with type-specific truth
+
+    Only the TRUTH and FLUX rows of the requested targets are read, using a
+    TARGETID index of the truth file that is cached across calls.
     '''
+    targetids = np.asarray(targetids)
     if len(targetids) != len(np.unique(targetids)):
         from desiutil.log import get_logger
         log = get_logger()
@@ -849,77 +1083,50 @@ def read_mock_spectra(truthfile, targetids, mockdir=None):
 
     #- astropy.io.fits doesn't return a real ndarray, causing problems
     #- with the reordering downstream so use fitsio instead
-    # with fits.open(truthfile, memmap=False) as fx:
-    #     truth = fx['TRUTH'].data
-    #     wave = fx['WAVE'].data
-    #     flux = fx['FLUX'].data
     objtruth = dict()
     with fitsio.FITS(truthfile) as fx:
-        truth = fx['TRUTH'].read()
-        wave = fx['WAVE'].read()
-        flux = fx['FLUX'].read()
-
-        if 'OBJTYPE' in truth.dtype.names:
+        colnames = fx['TRUTH'].get_colnames()
+        if 'OBJTYPE' in colnames:
             # output of desisim.obs.new_exposure
-            if isinstance(truth['OBJTYPE'][0], bytes):
-                objtype = [oo.decode('ascii').strip().upper() \
-                        for oo in truth['OBJTYPE']]
-            else:
-                objtype = [oo.strip().upper() for oo in truth['OBJTYPE']]
+            typecol = 'OBJTYPE'
         else:
             # output of desitarget.mock.build.write_targets_truth
-            if isinstance(truth['TEMPLATETYPE'][0], bytes):
-                objtype = [oo.decode('ascii').strip().upper() \
-                        for oo in truth['TEMPLATETYPE']]
-            else:
-                objtype = [oo.strip().upper() for oo in truth['TEMPLATETYPE']]
+            typecol = 'TEMPLATETYPE'
+
+        index, isort = _get_truth_index(fx, truthfile, 'TRUTH',
+                                        columns=('TARGETID', typecol))
+        try:
+            rows = _find_rows(index, isort, targetids)
+        except ValueError:
+            missing = np.in1d(targetids, index['TARGETID'], invert=True)
+            raise ValueError('Targets missing from {}: {}'.format(
+                truthfile, targetids[missing]))
+
+        #- Read each needed row once, in file order, then gather them
+        #- into the order of the requested targetids
+        uniqrows, inverse = np.unique(rows, return_inverse=True)
+        truth = fx['TRUTH'].read(rows=uniqrows)[inverse]
+        flux = _read_image_rows(fx['FLUX'], uniqrows)[inverse]
+        wave = fx['WAVE'].read()
 
-        for obj in set(objtype):
+        objtype = np.char.upper(np.char.strip(
+            np.char.decode(index[typecol]) if index[typecol].dtype.kind == 'S'
+            else index[typecol]))
+
+        for obj in np.unique(objtype):
             extname = 'TRUTH_{}'.format(obj)
             if extname in fx:
-                objtruth[obj] = fx[extname].read()
+                # it doesn't matter if objtruth is sorted
+                objindex, _ = _get_truth_index(fx, truthfile, extname)
+                ii = np.where(np.in1d(objindex['TARGETID'], targetids))[0]
+                objtruth[obj] = fx[extname].read(rows=ii)
 
-    missing = np.in1d(targetids, truth['TARGETID'], invert=True)
-    if np.any(missing):
-        missingids = targetids[missing]
-        raise ValueError('Targets missing from {}: {}'.format(truthfile, missingids))
-
-    #- Trim to just the spectra for these targetids
-    ii = np.in1d(truth['TARGETID'], targetids)
-    flux = flux[ii]
-    truth = truth[ii]
-    if bool(objtruth):
-        for obj in objtruth.keys():
-            ii = np.in1d(objtruth[obj]['TARGETID'], targetids)
-            objtruth[obj] = objtruth[obj][ii]
-
-    assert set(targetids) == set(truth['TARGETID'])
-
-    #- sort truth to match order of input targetids
-    # it doesn't matter if objtruth is sorted
-    if len(targetids) == len(truth['TARGETID']):
-        i = np.argsort(targetids)
-        j = np.argsort(truth['TARGETID'])
-        k = np.argsort(i)
-        reordered_truth = truth[j[k]]
-        reordered_flux = flux[j[k]]
-    else:
-        #- Slower, but works even with repeated TARGETIDs
-        ii = np.argsort(truth['TARGETID'])
-        sorted_truthids = truth['TARGETID'][ii]
-        reordered_flux = np.empty(shape=(len(targetids), flux.shape[1]), dtype=flux.dtype)
-        reordered_truth = np.empty(shape=(len(targetids),), dtype=truth.dtype)
-        for j, tx in enumerate(targetids):
-            k = np.searchsorted(sorted_truthids, tx)
-            reordered_flux[j] = flux[ii[k]]
-            reordered_truth[j] = truth[ii[k]]
-
-    assert np.all(reordered_truth['TARGETID'] == targetids)
+    assert np.all(truth['TARGETID'] == targetids)
 
     wave = desispec.io.util.native_endian(wave).astype(np.float64)
-    reordered_flux = desispec.io.util.native_endian(reordered_flux).astype(np.float64)
+    flux = desispec.io.util.native_endian(flux).astype(np.float64)
 
-    return reordered_flux, wave, reordered_truth, objtruth
+    return flux, wave, truth, objtruth
 
 def targets2truthfiles(targets, basedir, nside=64, obscon=None):
     '''
@@ -17,8 +17,7 @@ import sys, os, pdb, glob
 from matplotlib import pyplot as plt
 import matplotlib.gridspec as gridspec
 
-from astropy.io import fits
-from astropy.table import Table, vstack, hstack, MaskedColumn, join
+from astropy.table import Table, MaskedColumn
 
 try:
     from scipy import constants
@@ -197,7 +196,149 @@ def find_zbest_files(fibermap_data):
     return zbest_files
 
 
-def load_z(fibermap_files, zbest_files=None, outfil=None):
+# Columns of the zbest files used by match_truth_z.
+_zbest_columns = ['TARGETID', 'Z', 'ZERR', 'ZWARN', 'SPECTYPE', 'DESI_TARGET']
+
+
+def _concatenate(arrays):
+    """Concatenate numpy structured arrays, promoting the column dtypes
+    (e.g. string widths) and zero-filling columns missing from some arrays.
+    """
+    dtypes = dict()
+    for data in arrays:
+        for name in data.dtype.names:
+            if name in dtypes:
+                dtypes[name] = np.promote_types(dtypes[name], data.dtype[name])
+            else:
+                dtypes[name] = data.dtype[name]
+
+    out = np.zeros(sum([len(data) for data in arrays]),
+                   dtype=[(name, dt.newbyteorder('=')) for name, dt in dtypes.items()])
+    i0 = 0
+    for data in arrays:
+        i1 = i0 + len(data)
+        for name in data.dtype.names:
+            out[name][i0:i1] = data[name]
+        i0 = i1
+    return out
+
+
+def _unique_targets(data):
+    """Sort a structured array by TARGETID and drop duplicate TARGETIDs"""
+    targetid, idx = np.unique(data['TARGETID'], return_index=True)
+    return data[idx]
+
+
+def _sorted_match(sorted_id, targetid):
+    """Return (found, idx) such that sorted_id[idx[found]] == targetid[found]"""
+    idx = np.searchsorted(sorted_id, targetid)
+    if len(sorted_id) == 0:
+        return np.zeros(len(targetid), dtype=bool), idx
+    idx[idx == len(sorted_id)] = 0
+    found = sorted_id[idx] == targetid
+    return found, idx
+
+
+def _read_simspec_z(fibermap_file, find_zbest=False):
+    """Read the FIBERMAP, TRUTH and TRUTH_ELG columns of the simspec file
+    matching fibermap_file for load_z
+
+    Returns (fibermap, truth, truth_elg, zbest_files); truth only includes
+    the columns not in the fibermap, truth_elg is None if the file has no
+    TRUTH_ELG HDU, and zbest_files is only filled if find_zbest is True.
+    """
+    import fitsio
+    log = get_logger()
+
+    zbest_files = []
+    if find_zbest:
+        fibermap_data = desispec.io.read_fibermap(fibermap_file)
+        zbest_files = find_zbest_files(fibermap_data)
+
+    log.info('Reading: {:s}'.format(fibermap_file))
+    simspec_file = fibermap_file.replace('fibermap','simspec')
+    with fitsio.FITS(simspec_file) as fx:
+        fibermap = fx['FIBERMAP'].read()
+        columns = [c for c in fx['TRUTH'].get_colnames()
+                   if c == 'TARGETID' or c not in fibermap.dtype.names]
+        truth = fx['TRUTH'].read(columns=columns)
+        if 'OIIFLUX' not in columns and 'TRUTH_ELG' in fx:
+            truth_elg = fx['TRUTH_ELG'].read(columns=['TARGETID', 'OIIFLUX'])
+        else:
+            truth_elg = None
+
+    return fibermap, truth, truth_elg, zbest_files
+
+
+def _wrap_read_simspec_z(args):
+    return _read_simspec_z(*args)
+
+
+def _read_zbest(zbest_file, columns=None):
+    """Read the requested columns of a zbest file; None if it is missing"""
+    import fitsio
+    log = get_logger()
+    if not os.path.exists(zbest_file):
+        log.error("zbest file {} not found".format(zbest_file))
+        return None
+
+    with fitsio.FITS(zbest_file) as fx:
+        if columns is not None:
+            colnames = fx[1].get_colnames()
+            columns = [c for c in columns if c in colnames]
+        return fx[1].read(columns=columns)
+
+
+def _wrap_read_zbest(args):
+    return _read_zbest(*args)
+
+
+def _load_z_cache_key(fibermap_files, zbest_files):
+    """Return the (filename, mtime) pairs that a load_z cache depends upon"""
+    files = [f.replace('fibermap','simspec') for f in fibermap_files]
+    files += sorted(zbest_files)
+    return [(f, os.path.getmtime(f) if os.path.exists(f) else None) for f in files]
+
+
+def _read_load_z_cache(cachefile, fibermap_files, zbest_files, zbest_columns):
+    """Return (simz, zbest, meta) from cachefile if it is valid for these
+    inputs and none of its inputs have been modified, otherwise None
+    """
+    import json
+    if not os.path.exists(cachefile):
+        return None
+
+    with np.load(cachefile, allow_pickle=False) as data:
+        cache = json.loads(str(data['cache']))
+        if cache['fibermap_files'] != list(fibermap_files) or \
+           cache['zbest_files'] != (None if zbest_files is None else sorted(zbest_files)) or \
+           cache['zbest_columns'] != (None if zbest_columns is None else list(zbest_columns)):
+            return None
+        for filename, mtime in cache['mtimes']:
+            if mtime != (os.path.getmtime(filename) if os.path.exists(filename) else None):
+                return None
+        return data['simz'], data['zbest'], cache['meta']
+
+
+def _write_load_z_cache(cachefile, fibermap_files, zbest_files, zbest_columns,
+                        found_zbest_files, simz, zbest, meta):
+    """Write the merged load_z arrays to cachefile, with the mtimes of the
+    input files used to validate it
+    """
+    import json
+    cache = dict(fibermap_files=list(fibermap_files),
+                 zbest_files=None if zbest_files is None else sorted(zbest_files),
+                 zbest_columns=None if zbest_columns is None else list(zbest_columns),
+                 mtimes=_load_z_cache_key(fibermap_files, found_zbest_files),
+                 meta=meta)
+    tmpfile = cachefile + '.tmp'
+    with open(tmpfile, 'wb') as fx:
+        np.savez(fx, simz=simz, zbest=zbest, cache=np.array(json.dumps(cache)))
+    os.rename(tmpfile, cachefile)
+
+
+def load_z(fibermap_files, zbest_files=None, outfil=None, nproc=None,
+           zbest_columns=_zbest_columns, cachefile=None):
     '''Load input and output redshift values for a set of exposures
 
     Parameters
@@ -209,6 +350,13 @@ def load_z(fibermap_files, zbest_files=None, outfil=None):
       Slurped from fibermap info if not provided
     outfil: str, optional
       Output file for the table
+    nproc: int, optional
+      Number of processes used to read the files; default cpu_count()//2
+    zbest_columns: list, optional
+      Columns to read from the zbest files (if present); None for all
+    cachefile: str, optional
+      .npz file caching the merged tables; it is reused if the input files
+      have not been modified since it was written, and rewritten otherwise
 
     Returns
     -------
@@ -217,73 +365,86 @@ def load_z(fibermap_files, zbest_files=None, outfil=None):
     zb_tab: astropy.Table
       Merged table of zbest output
     '''
-    # imports
+    import multiprocessing as mp
+    import fitsio
     log = get_logger()
 
-    # Init
-    if zbest_files is None:
-        flag_load_zbest = True
-        zbest_files = []
-    else:
-        flag_load_zbest = False
-    # Load up fibermap and simspec tables
-    fbm_tabs = []
-    sps_tabs = []
-    for fibermap_file in fibermap_files:
-
-        # zbest?
-        if flag_load_zbest:
-            fibermap_data = desispec.io.read_fibermap(fibermap_file)
-            zbest_files += find_zbest_files(fibermap_data)
-
-        log.info('Reading: {:s}'.format(fibermap_file))
-        # Load simspec (for fibermap too!)
-        simspec_file = fibermap_file.replace('fibermap','simspec')
-        sps_hdu = fits.open(simspec_file)
-        # Make Tables
-        fbm_tabs.append(Table(sps_hdu['FIBERMAP'].data,masked=True))
-        truth = Table(sps_hdu['TRUTH'].data,masked=True)
-        if 'TRUTH_ELG' in sps_hdu:
-           truth_elg = Table(sps_hdu['TRUTH_ELG'].data)
-           truth = join(truth, truth_elg['TARGETID', 'OIIFLUX'],
-                   keys='TARGETID', join_type='left')
+    cache = None
+    if cachefile is not None:
+        cache = _read_load_z_cache(cachefile, fibermap_files, zbest_files,
+                                   zbest_columns)
+        if cache is not None:
+            log.info('Reading cached redshift tables from {}'.format(cachefile))
+            simz, zbest, meta = cache
         else:
-            truth['OIIFLUX'] = 0.0
-
-        sps_tabs.append(truth)
-        sps_hdu.close()
-
-    # Stack + Sort
-    fbm_tab = vstack(fbm_tabs)
-    sps_tab = vstack(sps_tabs)
-    del fbm_tabs, sps_tabs
-
-    fbm_tab.sort('TARGETID')
-    sps_tab.sort('TARGETID')
-
-    # Add the version number header keywords from fibermap_files[0]
-    hdr = fits.getheader(fibermap_files[0].replace('fibermap', 'simspec'))
-    for key, value in sorted(hdr.items()):
-        if key.startswith('DEPNAM') or key.startswith('DEPVER'):
-            fbm_tab.meta[key] = value
-
-    # Drop to unique
-    univ, uni_idx = np.unique(np.array(fbm_tab['TARGETID']),return_index=True)
-    fbm_tab = fbm_tab[uni_idx]
-    sps_tab = sps_tab[uni_idx]
-
-    # Combine
-    assert np.all(fbm_tab['TARGETID'] == sps_tab['TARGETID'])
-    keep_colnames = list()
-    for colname in sps_tab.colnames:
-        if colname not in fbm_tab.colnames:
-            keep_colnames.append(colname)
+            log.info('{} is missing or out of date'.format(cachefile))
+
+    if cache is None:
+        if nproc is None:
+            nproc = mp.cpu_count() // 2
+        nproc = max(1, min(nproc, len(fibermap_files)))
+
+        # Load up fibermap and simspec tables, and slurp the zbest files
+        # from the fibermaps if needed
+        find_zbest = zbest_files is None
+        args = [(f, find_zbest) for f in fibermap_files]
+        if nproc > 1:
+            with mp.Pool(nproc) as pool:
+                results = pool.map(_wrap_read_simspec_z, args)
+        else:
+            results = [_wrap_read_simspec_z(x) for x in args]
+
+        fibermap, truth, truth_elg, found_zbest_files = zip(*results)
+        fibermap = _unique_targets(_concatenate(fibermap))
+        truth = _unique_targets(_concatenate(truth))
+        truth_elg = [x for x in truth_elg if x is not None]
+        if find_zbest:
+            found_zbest_files = sorted(set(sum(found_zbest_files, [])))
+        else:
+            found_zbest_files = sorted(zbest_files)
+
+        # Combine; truth columns also in the fibermap were not read
+        assert np.all(fibermap['TARGETID'] == truth['TARGETID'])
+        keep_colnames = [c for c in truth.dtype.names if c != 'TARGETID']
+        dtype = [(c, fibermap.dtype[c]) for c in fibermap.dtype.names]
+        dtype += [(c, truth.dtype[c]) for c in keep_colnames]
+        if 'OIIFLUX' not in fibermap.dtype.names + truth.dtype.names:
+            dtype.append(('OIIFLUX', truth_elg[0].dtype['OIIFLUX'] if truth_elg else 'f8'))
+        simz = np.zeros(len(fibermap), dtype=dtype)
+        for name in fibermap.dtype.names:
+            simz[name] = fibermap[name]
+        for name in keep_colnames:
+            simz[name] = truth[name]
+
+        # Single sorted match of the [OII] fluxes; 0 for non-ELGs
+        if len(truth_elg) > 0 and 'OIIFLUX' not in truth.dtype.names:
+            truth_elg = _unique_targets(_concatenate(truth_elg))
+            found, idx = _sorted_match(truth_elg['TARGETID'], simz['TARGETID'])
+            simz['OIIFLUX'][found] = truth_elg['OIIFLUX'][idx[found]]
+
+        # Add the version number header keywords from fibermap_files[0]
+        hdr = fitsio.read_header(fibermap_files[0].replace('fibermap', 'simspec'))
+        meta = dict()
+        for key in sorted(hdr.keys()):
+            if key.startswith('DEPNAM') or key.startswith('DEPVER'):
+                meta[key] = hdr[key]
+
+        # Load up zbest files
+        args = [(f, zbest_columns) for f in found_zbest_files]
+        if nproc > 1:
+            with mp.Pool(nproc) as pool:
+                zbest = pool.map(_wrap_read_zbest, args)
+        else:
+            zbest = [_wrap_read_zbest(x) for x in args]
+        zbest = _unique_targets(_concatenate([x for x in zbest if x is not None]))
 
-    simz_tab = hstack([fbm_tab,sps_tab[keep_colnames]],join_type='exact')
+        if cachefile is not None:
+            log.info('Caching redshift tables in {}'.format(cachefile))
+            _write_load_z_cache(cachefile, fibermap_files, zbest_files,
+                                zbest_columns, found_zbest_files, simz, zbest, meta)
 
-    # Cleanup some names
-    #simz_tab.rename_column('OBJTYPE_1', 'OBJTYPE')
-    #simz_tab.rename_column('OBJTYPE_2', 'TRUETYPE')
+    simz_tab = Table(simz, masked=True)
+    simz_tab.meta.update(meta)
 
     # Update QSO naming
     qsol = np.where( match_otype(simz_tab, 'QSO') & (simz_tab['TRUEZ'] >= 2.1))[0]
@@ -291,20 +452,7 @@ def load_z(fibermap_files, zbest_files=None, outfil=None):
     qsot = np.where( match_otype(simz_tab, 'QSO') & (simz_tab['TRUEZ'] < 2.1))[0]
     simz_tab['TEMPLATETYPE'][qsot] = 'QSO_T'
 
-    # Load up zbest files
-    zb_tabs = []
-    for zbest_file in zbest_files:
-        try:
-            zb_hdu = fits.open(zbest_file)
-        except FileNotFoundError:
-            log.error("zbest file {} not found".format(zbest_file))
-        else:
-            zb_tabs.append(Table(zb_hdu[1].data))
-
-    # Stack
-    zb_tab = vstack(zb_tabs)
-    univ, uni_idx = np.unique(np.array(zb_tab['TARGETID']),return_index=True)
-    zb_tab = zb_tab[uni_idx]
+    zb_tab = Table(zbest)
 
     # Return
     return simz_tab, zb_tab
@@ -320,14 +468,14 @@ def match_truth_z(simz_tab, zb_tab, mini_read=False, outfil=None):
     """
 
     nsim = len(simz_tab)
-    # Match up
+    # Match up with a single sorted search of the zbest TARGETIDs
     sim_id = np.array(simz_tab['TARGETID'])
     z_id = np.array(zb_tab['TARGETID'])
-    inz = np.in1d(z_id,sim_id,assume_unique=True)
-    ins = np.in1d(sim_id,z_id,assume_unique=True)
+    z_sort = np.argsort(z_id, kind='stable')
+    ins, idx = _sorted_match(z_id[z_sort], sim_id)
 
-    z_idx = np.arange(z_id.shape[0])[inz]
-    sim_idx = np.arange(sim_id.shape[0])[ins]
+    sim_idx = np.where(ins)[0]
+    z_idx = z_sort[idx[ins]]
     assert np.array_equal(sim_id[sim_idx],z_id[z_idx])
 
     # Fill up
@@ -349,10 +497,9 @@ def match_truth_z(simz_tab, zb_tab, mini_read=False, outfil=None):
     mask[sim_idx] = False
     for kk,ztag in enumerate(ztags):
         # Generate a MaskedColumn
-        new_clm = MaskedColumn([zb_tab[ztag][z_idx[0]]]*nsim, name=ztag, mask=mask)
-        #name=new_tags[kk], mask=mask)
-        # Fill
-        new_clm[sim_idx] = zb_tab[ztag][z_idx]
+        data = np.zeros(nsim, dtype=zb_tab[ztag].dtype)
+        data[sim_idx] = zb_tab[ztag][z_idx]
+        new_clm = MaskedColumn(data, name=ztag, mask=mask)
         # Append
         new_clms.append(new_clm)
     # Add columns
@@ -205,28 +205,205 @@ def load_s2n_values(objtype, nights, channel, sub_exposures=None):
     return fdict
 
 
-def obj_s2n_wave(s2n_dict, wv_bins, flux_bins, otype, outfile=None, ax=None):
+def bin_s2n(s2n_sum, s2n_N, s2n, x, x_bins, y, y_bins):
+    """
+    Add S/N values to histograms binned in x per pixel and y per spectrum
+
+    Args:
+        s2n_sum: ndarray [x_bins.size-1, y_bins.size-1], updated in place
+        s2n_N: ndarray [x_bins.size-1, y_bins.size-1], updated in place
+        s2n: ndarray [nspec, nwave]
+        x: ndarray [nwave], e.g. wavelength
+        x_bins: ndarray of bin edges
+        y: ndarray [nspec], e.g. magnitude
+        y_bins: ndarray of bin edges
+
+    """
+    nx, ny = x_bins.size-1, y_bins.size-1
+    x_i = np.digitize(x, x_bins) - 1
+    y_i = np.digitize(y, y_bins) - 1
+    xok = (x_i >= 0) & (x_i < nx)
+    yok = (y_i >= 0) & (y_i < ny)
+    if not (np.any(xok) and np.any(yok)):
+        return
+    # Flattened (y, x) bin index of every pixel
+    idx = x_i[xok] + nx * y_i[yok][:, np.newaxis]
+    s2n_sum += np.bincount(idx.ravel(), weights=s2n[yok][:, xok].ravel(),
+                           minlength=nx*ny).reshape(ny, nx).T
+    s2n_N += np.outer(np.bincount(x_i[xok], minlength=nx),
+                      np.bincount(y_i[yok], minlength=ny))
+
+def _read_s2n_truth(simspec_file):
+    """
+    Read TEMPLATETYPE, MAG and OIIFLUX per spectrum from a simspec file
+
+    OIIFLUX is matched from TRUTH_ELG by TARGETID if needed, and is 0 for
+    objects without [OII] truth.
+    """
+    import fitsio
+    with fitsio.FITS(simspec_file) as fx:
+        colnames = fx['TRUTH'].get_colnames()
+        columns = ['TARGETID', 'TEMPLATETYPE', 'MAG']
+        if 'OIIFLUX' in colnames:
+            columns.append('OIIFLUX')
+        truth = fx['TRUTH'].read(columns=columns)
+        templatetype = np.char.strip(truth['TEMPLATETYPE'].astype(str))
+        if 'OIIFLUX' in colnames:
+            oiiflux = truth['OIIFLUX'].astype(float)
+        else:
+            oiiflux = np.zeros(len(truth))
+            if 'TRUTH_ELG' in fx and fx['TRUTH_ELG'].get_nrows() > 0:
+                elg = fx['TRUTH_ELG'].read(columns=['TARGETID', 'OIIFLUX'])
+                srt = np.argsort(elg['TARGETID'])
+                idx = np.searchsorted(elg['TARGETID'], truth['TARGETID'], sorter=srt)
+                idx = srt[np.clip(idx, 0, len(elg)-1)]
+                found = elg['TARGETID'][idx] == truth['TARGETID']
+                oiiflux[found] = elg['OIIFLUX'][idx[found]]
+
+    return templatetype, truth['MAG'].astype(float), oiiflux
+
+def _empty_s2n_hists(bins):
+    """Return zeroed histograms for the bins of accumulate_s2n"""
+    hists = dict()
+    for objtype, obins in bins.items():
+        hists[objtype] = dict()
+        for key, x, y in (('wave', 'wave', 'mag'), ('z', 'z', 'oii')):
+            if x in obins and y in obins:
+                shape = (obins[x].size-1, obins[y].size-1)
+                hists[objtype][key] = (np.zeros(shape), np.zeros(shape, dtype=int))
+    return hists
+
+def _s2n_exposure_hists(night, exposure, channel, bins):
+    """
+    Histogram the S/N of one exposure for accumulate_s2n
+
+    Returns None for calibration exposures
+    """
+    fibermap_path = findfile(filetype='fibermap', night=night, expid=exposure)
+    fibermap_data = read_fibermap(fibermap_path)
+    flavor = fibermap_data.meta['FLAVOR']
+    if flavor.lower() in ('arc', 'flat', 'bias'):
+        log.debug('Skipping calibration {} exposure {:08d}'.format(flavor, exposure))
+        return None
+    # Load simspec
+    simspec_file = fibermap_path.replace('fibermap', 'simspec')
+    log.debug('Getting truth from {}'.format(simspec_file))
+    templatetype, mag, oiiflux = _read_s2n_truth(simspec_file)
+
+    hists = _empty_s2n_hists(bins)
+    # Load spectra (flux or not fluxed; should not matter)
+    for ii in range(10):
+        camera = channel+str(ii)
+        cframe_path = findfile(filetype='cframe', night=night, expid=exposure, camera=camera)
+        try:
+            log.debug('Reading from {}'.format(cframe_path))
+            cframe = read_frame(cframe_path)
+        except (IOError, OSError):
+            log.warn("Cannot find file: {:s}".format(cframe_path))
+            continue
+        # Calculate S/N per Ang
+        dwave = cframe.wave - np.roll(cframe.wave,1)
+        dwave[0] = dwave[1]
+        zELG = cframe.wave / 3728. - 1.
+        for objtype, obins in bins.items():
+            iobjs = np.where(templatetype[cframe.fibers] == objtype)[0]
+            if len(iobjs) == 0:
+                continue
+            fibers = cframe.fibers[iobjs]
+            s2n = cframe.flux[iobjs,:] * np.sqrt(cframe.ivar[iobjs,:]) / np.sqrt(dwave)
+            if 'wave' in hists[objtype]:
+                bin_s2n(*hists[objtype]['wave'], s2n, cframe.wave, obins['wave'],
+                        mag[fibers], obins['mag'])
+            if 'z' in hists[objtype]:
+                bin_s2n(*hists[objtype]['z'], s2n, zELG, obins['z'],
+                        oiiflux[fibers]*1e17, obins['oii'])
+
+    return hists
+
+def _wrap_s2n_exposure_hists(args):
+    return _s2n_exposure_hists(*args)
+
+def accumulate_s2n(nights, channel, bins, sub_exposures=None, nproc=None):
+    """
+    Accumulate S/N histograms for a set of spectra from an input list of nights
+
+    Each exposure is binned as it is read, in parallel over exposures, so
+    that memory is bounded by the size of the histograms rather than by
+    the number of spectra.
+
+    Args:
+        nights: list
+        channel: str  ('b','r','z')
+        bins: dict
+          Bin edges for each objtype, e.g. bins['ELG'] = dict(wave=..., mag=...,
+          z=..., oii=...); 'wave' and 'mag' give S/N vs. wavelength in bins of
+          MAG, and the optional 'z' and 'oii' give S/N vs. [OII] redshift in
+          bins of OIIFLUX [1e-17 erg/s/cm2]
+        sub_exposures: list, optional
+        nproc: int, optional
+          Number of processes; default cpu_count()//2
+
+    Returns:
+        hists: dict
+          For each objtype, a dict with 'wave' and/or 'z' entries of
+          (s2n_sum, s2n_N) arrays that can be passed to obj_s2n_wave and
+          obj_s2n_z
+
+    """
+    import multiprocessing as mp
+
+    args = list()
+    for night in nights:
+        if sub_exposures is not None:
+            exposures = sub_exposures
+        else:
+            exposures = get_exposures(night)#, raw=True)
+        for exposure in exposures:
+            args.append((night, exposure, channel, bins))
+
+    if nproc is None:
+        nproc = mp.cpu_count() // 2
+    nproc = max(1, min(nproc, len(args)))
+
+    hists = _empty_s2n_hists(bins)
+    def _add(exphists):
+        if exphists is None:
+            return
+        for objtype in hists:
+            for key in hists[objtype]:
+                for total, value in zip(hists[objtype][key], exphists[objtype][key]):
+                    total += value
+
+    if nproc > 1:
+        with mp.Pool(nproc) as pool:
+            for exphists in pool.imap_unordered(_wrap_s2n_exposure_hists, args):
+                _add(exphists)
+    else:
+        for x in args:
+            _add(_wrap_s2n_exposure_hists(x))
+
+    # Return
+    return hists
+
+
+def obj_s2n_wave(s2n_dict, wv_bins, flux_bins, otype, outfile=None, ax=None, hist=None):
     """Generate QA of S/N for a given object type
+
+    hist is an optional (s2n_sum, s2n_N) histogram from accumulate_s2n, in
+    which case s2n_dict is not used
     """
     logs = get_logger()
     nwv = wv_bins.size
     nfx = flux_bins.size
-    s2n_sum = np.zeros((nwv-1,nfx-1))
-    s2n_N = np.zeros((nwv-1,nfx-1)).astype(int)
-    # Loop on exposures+wedges  (can do just once if these are identical for each)
-    for jj, wave in enumerate(s2n_dict['waves']):
-        w_i = np.digitize(wave, wv_bins) - 1
-        m_i = np.digitize(s2n_dict['fluxes'][jj], flux_bins) - 1
-        mmm = []
-        for ll in range(nfx-1): # Only need to do once
-            mmm.append(m_i == ll)
-        #
-        for kk in range(nwv-1):
-            all_s2n = s2n_dict['s2n'][jj][:,w_i==kk]
-            for ll in range(nfx-1):
-                if np.any(mmm[ll]):
-                    s2n_sum[kk, ll] += np.sum(all_s2n[mmm[ll],:])
-                    s2n_N[kk, ll] += np.sum(mmm[ll]) * all_s2n.shape[1]
+    if hist is not None:
+        s2n_sum, s2n_N = hist
+    else:
+        s2n_sum = np.zeros((nwv-1,nfx-1))
+        s2n_N = np.zeros((nwv-1,nfx-1)).astype(int)
+        # Loop on exposures+wedges
+        for jj, wave in enumerate(s2n_dict['waves']):
+            bin_s2n(s2n_sum, s2n_N, s2n_dict['s2n'][jj], wave, wv_bins,
+                    s2n_dict['fluxes'][jj], flux_bins)
 
     sty_otype = get_sty_otype()
 
@@ -267,30 +444,26 @@ def obj_s2n_wave(s2n_dict, wv_bins, flux_bins, otype, outfile=None, ax=None):
         print("Wrote: {:s}".format(outfile))
 
 
-def obj_s2n_z(s2n_dict, z_bins, flux_bins, otype, outfile=None, ax=None):
+def obj_s2n_z(s2n_dict, z_bins, flux_bins, otype, outfile=None, ax=None, hist=None):
     """Generate QA of S/N for a given object type vs. z (mainly for ELG)
+
+    hist is an optional (s2n_sum, s2n_N) histogram from accumulate_s2n, in
+    which case s2n_dict is not used
     """
     logs = get_logger()
     nz = z_bins.size
     nfx = flux_bins.size
-    s2n_sum = np.zeros((nz-1,nfx-1))
-    s2n_N = np.zeros((nz-1,nfx-1)).astype(int)
-    # Loop on exposures+wedges  (can do just once if these are identical for each)
-    for jj, wave in enumerate(s2n_dict['waves']):
-        # Turn wave into z
-        zELG = wave / 3728. - 1.
-        z_i = np.digitize(zELG, z_bins) - 1
-        m_i = np.digitize(s2n_dict['OII'][jj]*1e17, flux_bins) - 1
-        mmm = []
-        for ll in range(nfx-1): # Only need to do once
-            mmm.append(m_i == ll)
-        #
-        for kk in range(nz-1):
-            all_s2n = s2n_dict['s2n'][jj][:,z_i==kk]
-            for ll in range(nfx-1):
-                if np.any(mmm[ll]):
-                    s2n_sum[kk, ll] += np.sum(all_s2n[mmm[ll],:])
-                    s2n_N[kk, ll] += np.sum(mmm[ll]) * all_s2n.shape[1]
+    if hist is not None:
+        s2n_sum, s2n_N = hist
+    else:
+        s2n_sum = np.zeros((nz-1,nfx-1))
+        s2n_N = np.zeros((nz-1,nfx-1)).astype(int)
+        # Loop on exposures+wedges
+        for jj, wave in enumerate(s2n_dict['waves']):
+            # Turn wave into z
+            zELG = wave / 3728. - 1.
+            bin_s2n(s2n_sum, s2n_N, s2n_dict['s2n'][jj], zELG, z_bins,
+                    s2n_dict['OII'][jj]*1e17, flux_bins)
 
     sty_otype = get_sty_otype()
 
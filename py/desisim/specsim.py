@@ -7,14 +7,28 @@ DESI wrapper functions for external specsim classes.
 
 from __future__ import absolute_import, division, print_function
 
-#- Cached simulators, keyed by config string
-_simulators = dict()
+import os
+import hashlib
+from collections import OrderedDict
+
+#- Cached simulators, keyed by (config, camera_output), most recently used last
+_simulators = OrderedDict()
 
 #- Cached defaults after loading a new simulator, to be used to reset a
 #- simulator back to a reference state before returning it as a cached copy
 _simdefaults = dict()
 
+#- Maximum number of cached simulators; least recently used ones are dropped
+max_simulators = 4
+
+#- Cached source-independent simulation products keyed by observing
+#- conditions, most recently used last; see get_obsproducts()
+_obsproducts = OrderedDict()
+max_obsproducts = 8
+
 import numpy as np
+import astropy.table
+import astropy.units as u
 
 from specsim.config import Configuration
 import desiutil.log
@@ -24,17 +38,23 @@ def get_simulator(config='desi', num_fibers=1, camera_output=True):
     '''
     returns new or cached specsim.simulator.Simulator object
 
+    Simulators are cached per configuration and wavelength grid independent
+    of num_fibers; a cached Simulator with a different number of fibers has
+    its result buffers resized instead of being rebuilt.  At most
+    max_simulators are cached.
+
     Also adds placeholder for BGS fiberloss if that isn't already in the config
     '''
     if isinstance(config, Configuration):
         w = config.wavelength
         wavehash = (np.min(w), np.max(w), len(w))
-        key = (config.name, wavehash, num_fibers, camera_output)
+        key = (config.name, wavehash, camera_output)
     else:
-        key = (config, num_fibers, camera_output)
+        key = (config, camera_output)
 
     if key in _simulators:
         log.debug('Returning cached {} Simulator'.format(key))
+        _simulators.move_to_end(key)
         qsim = _simulators[key]
         defaults = _simdefaults[key]
         qsim.source.focal_xy = defaults['focal_xy']
@@ -44,6 +64,11 @@ def get_simulator(config='desi', num_fibers=1, camera_output=True):
         qsim.atmosphere.moon.separation_angle = defaults['moon_angle']
         qsim.atmosphere.moon.moon_zenith = defaults['moon_zenith']
 
+        if qsim.num_fibers != num_fibers:
+            log.debug('Resizing cached Simulator from {} to {} fibers'.format(
+                qsim.num_fibers, num_fibers))
+            resize_simulator(qsim, num_fibers)
+
     else:
         log.debug('Creating new {} Simulator'.format(key))
 
@@ -64,5 +89,355 @@ def get_simulator(config='desi', num_fibers=1, camera_output=True):
         _simulators[key] = qsim
         _simdefaults[key] = defaults
 
+        #- Drop least recently used simulators
+        while len(_simulators) > max(1, max_simulators):
+            oldkey, oldsim = _simulators.popitem(last=False)
+            del _simdefaults[oldkey]
+            log.debug('Dropping cached {} Simulator'.format(oldkey))
+
     return qsim
 
+def _resize_table(table, num_fibers):
+    '''
+    Returns a zeroed copy of a specsim results table for num_fibers fibers
+
+    1D columns (e.g. wavelength) are copied; 2D [nwave, nfibers] columns are
+    reallocated with the new number of fibers.
+    '''
+    resized = astropy.table.Table(meta=table.meta.copy())
+    for name in table.colnames:
+        column = table[name]
+        if column.ndim == 1:
+            resized.add_column(column.copy())
+        else:
+            resized.add_column(astropy.table.Column(name=name,
+                dtype=column.dtype, length=len(column), shape=(num_fibers,),
+                unit=column.unit))
+
+    if 'num_fibers' in resized.meta:
+        resized.meta['num_fibers'] = num_fibers
+
+    return resized
+
+def resize_simulator(qsim, num_fibers):
+    '''
+    Resize the result buffers of a specsim Simulator in place
+
+    Args:
+        qsim: specsim.simulator.Simulator object
+        num_fibers: new number of fibers to simulate
+
+    This keeps the configured atmosphere, instrument, source and observation
+    models, which are the expensive parts of creating a Simulator, and only
+    reallocates the simulated and camera_output tables.
+    '''
+    num_fibers = int(num_fibers)
+    if num_fibers < 1:
+        raise ValueError('Must have num_fibers >= 1.')
+
+    qsim._num_fibers = num_fibers
+    qsim._simulated = _resize_table(qsim._simulated, num_fibers)
+    qsim._camera_output = [_resize_table(table, num_fibers)
+                           for table in qsim._camera_output]
+
+    #- eBOSS flavor of specsim has an extra set of camera outputs
+    if hasattr(qsim, '_eboss_camera_output'):
+        qsim._eboss_camera_output = [_resize_table(table, num_fibers)
+                                     for table in qsim._eboss_camera_output]
+
+    qsim.table_bytes = 0
+    for table in [qsim._simulated,] + list(qsim._camera_output):
+        for name in table.colnames:
+            d = table[name].data
+            qsim.table_bytes += np.prod(d.shape) * d.dtype.itemsize
+
+def _model_hash(qsim):
+    '''
+    Returns a hash of the atmosphere and instrument model data of a Simulator
+
+    This covers the sky surface brightness and extinction tables, the
+    photons per bin and the per-camera throughput, dark current, read noise
+    and resolution, so that two configurations with the same name but
+    different contents are distinguished.  It is computed once per Simulator.
+    '''
+    if getattr(qsim, '_desisim_model_hash', None) is not None:
+        return qsim._desisim_model_hash
+
+    sha = hashlib.sha1()
+    def _update(x):
+        x = getattr(x, 'value', x)
+        sha.update(np.ascontiguousarray(x, dtype=float).tobytes())
+
+    atmosphere = qsim.atmosphere
+    for condition in sorted(atmosphere._surface_brightness_dict):
+        sha.update(condition.encode())
+        _update(atmosphere._surface_brightness_dict[condition])
+    _update(atmosphere._extinction_coefficient)
+    sha.update(repr(atmosphere._extinct_emission).encode())
+    _update(qsim.instrument.photons_per_bin)
+    for camera in qsim.instrument.cameras:
+        sha.update(camera.name.encode())
+        _update(camera.throughput)
+        _update(camera.dark_current_per_bin)
+        _update(camera.read_noise_per_bin)
+        if camera.allow_convolution:
+            _update(camera._rms_resolution)
+            _update(camera.output_wavelength)
+
+    qsim._desisim_model_hash = sha.hexdigest()
+    return qsim._desisim_model_hash
+
+def obsproducts_key(qsim):
+    '''
+    Returns a hash string identifying the observing conditions of a Simulator
+
+    The key covers the desisim, specsim and desimodel versions and the
+    $DESIMODEL data location, the configuration name and model data (see
+    _model_hash), whether the Simulator has camera output, the simulation
+    and output wavelength grids, sky condition, airmass, seeing, exposure
+    time and moon geometry, i.e. everything that get_obsproducts() depends
+    upon.  Persistent cache files therefore do not outlive a package upgrade.
+    '''
+    import specsim
+    import desimodel
+    from desisim import __version__ as desisim_version
+
+    wave = np.asarray(qsim.simulated['wavelength'])
+    values = [desisim_version, specsim.__version__, desimodel.__version__,
+              os.getenv('DESIMODEL'),
+              qsim.instrument.name, _model_hash(qsim), bool(qsim.camera_output),
+              wave[0], wave[-1], len(wave),
+              qsim.atmosphere.condition, float(qsim.atmosphere.airmass),
+              qsim.atmosphere.seeing_fwhm_ref.to(u.arcsec).value,
+              qsim.observation.exposure_time.to(u.s).value]
+    moon = qsim.atmosphere.moon
+    if moon is not None:
+        values.extend([float(moon.moon_phase),
+                       moon.moon_zenith.to(u.deg).value,
+                       moon.separation_angle.to(u.deg).value])
+    for camera in qsim.instrument.cameras:
+        values.append(camera.name)
+        if qsim.camera_output:
+            wout = camera.output_wavelength.to(u.Angstrom).value
+            values.extend([wout[0], wout[-1], len(wout)])
+
+    return hashlib.sha1(repr(values).encode()).hexdigest()
+
+def _compute_obsproducts(qsim):
+    '''
+    Computes the source-independent products of a Simulator for a fiber
+    area of 1 arcsec2; see get_obsproducts()
+    '''
+    photons_per_bin = qsim.instrument.photons_per_bin
+    exptime = qsim.observation.exposure_time
+    sky_unit = qsim.simulated['sky_fiber_flux'].unit
+
+    products = dict()
+    products['extinction'] = np.asarray(qsim.atmosphere.extinction)
+    sky_flux = (qsim.atmosphere.surface_brightness * u.arcsec**2).to(sky_unit)
+    sky_photons = (sky_flux * photons_per_bin * exptime).to(1).value
+    products['sky_fiber_flux'] = sky_flux.value
+    products['num_sky_photons'] = sky_photons
+
+    for camera in qsim.instrument.cameras:
+        name = camera.name
+        sky_electrons = sky_photons * camera.throughput
+        dark_electrons = (camera.dark_current_per_bin *
+                          exptime).to(u.electron).value
+        read_noise = camera.read_noise_per_bin.to(u.electron).value
+        products['num_sky_electrons_'+name] = sky_electrons
+        products['num_dark_electrons_'+name] = dark_electrons
+        products['read_noise_electrons_'+name] = read_noise
+        if qsim.camera_output:
+            sky_electrons = camera.apply_resolution(sky_electrons)
+            products['num_sky_electrons_res_'+name] = sky_electrons
+            products['num_sky_electrons_out_'+name] = \
+                camera.downsample(sky_electrons)
+            products['num_dark_electrons_out_'+name] = \
+                camera.downsample(dark_electrons)
+            products['read_noise_electrons_out_'+name] = \
+                np.sqrt(camera.downsample(read_noise ** 2))
+
+    return products
+
+def get_obsproducts(qsim, cachedir=None):
+    '''
+    Returns source-independent simulation products for the current
+    observing conditions of a specsim Simulator
+
+    Args:
+        qsim: specsim.simulator.Simulator object
+        cachedir (str, optional): directory in which to persist products
+            as specsim-obs-{key}.npz files, shared across processes and runs
+
+    Returns dict of arrays: atmospheric extinction, sky fiber flux and
+    photons per arcsec2 of fiber area, and per camera the sky electrons per
+    arcsec2, dark electrons and read noise, on the simulation grid and (for
+    Simulators with camera output) with resolution applied and downsampled.
+
+    Products are cached in memory keyed by obsproducts_key(qsim); at most
+    max_obsproducts are kept.
+    '''
+    key = obsproducts_key(qsim)
+    if key in _obsproducts:
+        _obsproducts.move_to_end(key)
+        return _obsproducts[key]
+
+    products = None
+    if cachedir is not None:
+        cachefile = os.path.join(cachedir, 'specsim-obs-{}.npz'.format(key))
+        if os.path.exists(cachefile):
+            log.debug('Reading specsim products from {}'.format(cachefile))
+            with np.load(cachefile) as fx:
+                products = dict(fx)
+
+    if products is None:
+        log.debug('Computing specsim products {}'.format(key))
+        products = _compute_obsproducts(qsim)
+        if cachedir is not None:
+            #- write then rename so that concurrent readers never see a
+            #- partially written file
+            os.makedirs(cachedir, exist_ok=True)
+            tmpfile = '{}-{}.tmp.npz'.format(cachefile[:-4], os.getpid())
+            np.savez(tmpfile, **products)
+            os.replace(tmpfile, cachefile)
+
+    _obsproducts[key] = products
+    while len(_obsproducts) > max(1, max_obsproducts):
+        _obsproducts.popitem(last=False)
+
+    return products
+
+def simulate(qsim, source_fluxes, focal_positions, source_types=None,
+             source_fraction=None, source_half_light_radius=None,
+             source_minor_major_axis_ratio=None, source_position_angle=None,
+             fiber_acceptance_fraction=None, cachedir=None):
+    '''
+    Simulates sources with a specsim Simulator, reusing cached sky products
+
+    Args:
+        qsim: specsim.simulator.Simulator object
+        source_fluxes: 2D[num_fibers, nwave] Quantity source flux on the
+            simulation wavelength grid
+        focal_positions: 2D[num_fibers, 2] Quantity focal plane (x,y)
+
+    Options:
+        source_types, source_fraction, source_half_light_radius,
+        source_minor_major_axis_ratio, source_position_angle: per-fiber
+            source properties, as in specsim Simulator.simulate
+        fiber_acceptance_fraction: 2D[num_fibers, nwave] precomputed
+            fiber acceptance, e.g. from desisim.fiberloss, instead of
+            calculating it with the instrument fiberloss method
+        cachedir (str): see get_obsproducts()
+
+    Fills qsim.simulated and qsim.camera_output like
+    qsim.simulate(source_fluxes=..., focal_positions=..., ...), but takes
+    the atmospheric extinction, sky, dark current and read noise terms from
+    get_obsproducts() so that they (in particular the resolution convolution
+    of the sky) are computed once per observing conditions instead of once
+    per fiber per call.
+    '''
+    import specsim.fiberloss
+
+    products = get_obsproducts(qsim, cachedir=cachedir)
+
+    simulated = qsim.simulated
+    wavelength = simulated['wavelength']
+    source_flux = simulated['source_flux']
+    fiberloss = simulated['fiberloss']
+    source_fiber_flux = simulated['source_fiber_flux']
+    num_source_photons = simulated['num_source_photons']
+    nwlen = len(wavelength)
+
+    #- Position each fiber and calculate its on-sky area
+    if len(focal_positions) != qsim.num_fibers:
+        raise ValueError(
+            'Expected {0:d} focal_positions.'.format(qsim.num_fibers))
+    qsim.focal_x, qsim.focal_y = focal_positions.to(u.mm).T
+    focal_r = np.sqrt(qsim.focal_x ** 2 + qsim.focal_y ** 2)
+    if np.any(focal_r > qsim.instrument.field_radius):
+        raise RuntimeError(
+            'A source is located outside the field of view: r > {0:.1f}'
+            .format(qsim.instrument.field_radius))
+
+    radial_fiber_size = (0.5 * qsim.instrument.fiber_diameter /
+                         qsim.instrument.radial_scale(focal_r))
+    azimuthal_fiber_size = (0.5 * qsim.instrument.fiber_diameter /
+                            qsim.instrument.azimuthal_scale(focal_r))
+    qsim.fiber_area = np.pi * radial_fiber_size * azimuthal_fiber_size
+    fiber_area = qsim.fiber_area.to(u.arcsec ** 2).value
+
+    #- Source terms
+    if source_fluxes.shape != (qsim.num_fibers, nwlen):
+        raise ValueError('Invalid shape for source_fluxes.')
+    source_flux[:] = source_fluxes.to(source_flux.unit).T
+
+    if fiber_acceptance_fraction is None:
+        fiber_acceptance_fraction = \
+            specsim.fiberloss.calculate_fiber_acceptance_fraction(
+                qsim.focal_x, qsim.focal_y, wavelength.quantity,
+                qsim.source, qsim.atmosphere, qsim.instrument,
+                source_types, source_fraction, source_half_light_radius,
+                source_minor_major_axis_ratio, source_position_angle)
+    elif np.shape(fiber_acceptance_fraction) != (qsim.num_fibers, nwlen):
+        raise ValueError('Invalid shape for fiber_acceptance_fraction.')
+    fiberloss[:] = np.asarray(fiber_acceptance_fraction).T
+
+    extinction = products['extinction'][:, np.newaxis]
+    photons_per_bin = qsim.instrument.photons_per_bin[:, np.newaxis]
+    exptime = qsim.observation.exposure_time
+    source_fiber_flux[:] = (source_flux * extinction *
+                            fiberloss).to(source_fiber_flux.unit)
+    source_flux_to_photons = (extinction * fiberloss * photons_per_bin *
+                              exptime).to(source_flux.unit ** -1).value
+    num_source_photons[:] = (source_fiber_flux * photons_per_bin *
+                             exptime).to(1).value
+
+    #- Sky terms scale with the fiber area
+    simulated['sky_fiber_flux'][:] = np.outer(
+        products['sky_fiber_flux'], fiber_area)
+    simulated['num_sky_photons'][:] = np.outer(
+        products['num_sky_photons'], fiber_area)
+
+    for camera in qsim.instrument.cameras:
+        name = camera.name
+        simulated['num_source_electrons_'+name][:] = \
+            num_source_photons * camera.throughput[:, np.newaxis]
+        if qsim.camera_output:
+            sky = products['num_sky_electrons_res_'+name]
+        else:
+            sky = products['num_sky_electrons_'+name]
+        simulated['num_sky_electrons_'+name][:] = np.outer(sky, fiber_area)
+        simulated['num_dark_electrons_'+name][:] = \
+            products['num_dark_electrons_'+name][:, np.newaxis]
+        simulated['read_noise_electrons_'+name][:] = \
+            products['read_noise_electrons_'+name][:, np.newaxis]
+
+    for output, camera in zip(qsim.camera_output, qsim.instrument.cameras):
+        name = camera.name
+        num_source_electrons = simulated['num_source_electrons_'+name]
+        num_source_electrons[:] = camera.apply_resolution(num_source_electrons)
+
+        output['num_source_electrons'][:] = \
+            camera.downsample(num_source_electrons)
+        output['num_sky_electrons'][:] = np.outer(
+            products['num_sky_electrons_out_'+name], fiber_area)
+        output['num_dark_electrons'][:] = \
+            products['num_dark_electrons_out_'+name][:, np.newaxis]
+        output['read_noise_electrons'][:] = \
+            products['read_noise_electrons_out_'+name][:, np.newaxis]
+        output['variance_electrons'][:] = (
+            output['num_source_electrons'] +
+            output['num_sky_electrons'] +
+            output['num_dark_electrons'] +
+            output['read_noise_electrons'] ** 2)
+
+        output['flux_calibration'][:] = 1.0 / camera.downsample(
+            camera.apply_resolution(
+                source_flux_to_photons * camera.throughput.reshape(-1, 1)))
+        output['observed_flux'][:] = (
+            output['flux_calibration'] * output['num_source_electrons'])
+        output['flux_inverse_variance'][:] = (
+            output['flux_calibration'] ** -2 *
+            output['variance_electrons'] ** -1)
+        output['random_noise_electrons'][:] = 0.
@@ -178,16 +178,187 @@ def sample_objtype(nobj, program):
 
     return true_objtype, target_objtype
 
+def _target_bits(objtype):
+    '''
+    Returns (DESI_TARGET, BGS_TARGET, MWS_TARGET) bits for a simulated
+    true objtype, e.g. ELG, QSO_BAD, or MWS_STAR
+    '''
+    if objtype == 'SKY':
+        return desi_mask.SKY, 0, 0
+    elif objtype == 'ELG':
+        return desi_mask.ELG, 0, 0
+    elif objtype == 'LRG':
+        return desi_mask.LRG, 0, 0
+    elif objtype == 'BGS':
+        return desi_mask.BGS_ANY, bgs_mask.BGS_BRIGHT, 0
+    elif objtype in ('QSO', 'QSO_BAD'):
+        return desi_mask.QSO, 0, 0
+    elif objtype == 'STD':
+        #- Loop options for forwards/backwards compatibility
+        for name in ['STD_FAINT', 'STD_FSTAR', 'STD']:
+            if name in desi_mask.names():
+                return desi_mask[name], 0, 0
+        return 0, 0, 0
+    elif objtype == 'MWS_STAR':
+        #- MWS bit names changed after desitarget 0.6.0 so use number
+        #- instead of name for now (bit 0 = mask 1 = MWS_MAIN currently)
+        return desi_mask.MWS_ANY, 0, 1
+    else:
+        raise ValueError('Unable to simulate OBJTYPE={}'.format(objtype))
+
+#- Template makers cached per process by objtype, so that a worker only
+#- reads the basis templates it needs, and only once; get_targets and
+#- get_targets_parallel clear it when they finish
+_template_makers = dict()
+
+def _get_template_maker(objtype, wave):
+    '''
+    Returns cached desisim.templates instance for true objtype on wave grid
+    '''
+    if objtype in _template_makers:
+        maker = _template_makers[objtype]
+        if np.array_equal(maker.wave, wave):
+            return maker
+
+    import desisim.templates
+    if objtype == 'QSO_BAD':
+        # For a "bad" QSO simulate a normal star without color cuts, which isn't
+        # right. We need to apply the QSO color-cuts to the normal stars to pull
+        # out the correct population of contaminating stars.
+
+        # Note by @moustakas: we can now do this using desisim/#150, but we are
+        # going to need 'noisy' photometry (because the QSO color-cuts
+        # explicitly avoid the stellar locus).
+        #from desitarget.cuts import isQSO
+        #maker = desisim.templates.STAR(wave=wave, colorcuts_function=isQSO)
+        maker = desisim.templates.STAR(wave=wave)
+    elif objtype in ('ELG', 'LRG', 'BGS', 'QSO', 'STD', 'MWS_STAR'):
+        maker = getattr(desisim.templates, objtype)(wave=wave)
+    else:
+        raise ValueError('Unable to simulate OBJTYPE={}'.format(objtype))
+
+    _template_makers[objtype] = maker
+    return maker
+
+def _simulate_objtype(objtype, nobj, wave, seed=None, obj_kwargs=dict()):
+    '''
+    Simulates nobj spectra of true objtype (not SKY)
+
+    Returns (flux, meta, objmeta) from make_templates
+    '''
+    maker = _get_template_maker(objtype, wave)
+    obj_kwargs = dict(obj_kwargs)
+    if objtype == 'QSO':
+        obj_kwargs['lyaforest'] = False
+    elif objtype == 'MWS_STAR':
+        # TODO: mag ranges for different programs of STAR targets should be in desimodel
+        if 'magrange' not in obj_kwargs.keys():
+            obj_kwargs['magrange'] = (15.0,20.0)
+
+    simflux, wave1, meta1, objmeta1 = maker.make_templates(nmodel=nobj, seed=seed, **obj_kwargs)
+    return simflux, meta1, objmeta1
+
 #- multiprocessing needs one arg, not multiple args
-def _wrap_get_targets(args):
-    nspec, program, tileid, seed, specify_targets, specmin = args
-    return get_targets(nspec, program, tileid, seed=seed, specify_targets=specify_targets, specmin=specmin)
+def _wrap_simulate_objtype(args):
+    return _simulate_objtype(*args)
+
+def _init_targets(nspec, program, tileid=None, specmin=0):
+    '''
+    Samples target types for nspec fibers starting at specmin and fills the
+    fibermap with their target bits, TARGETID, and positions, using the
+    global np.random state
+
+    Returns fibermap, true_objtype
+    '''
+    if tileid is None:
+        tile_ra, tile_dec = 0.0, 0.0
+    else:
+        tile_ra, tile_dec = io.get_tile_radec(tileid)
+
+    #- Get distribution of target types
+    true_objtype, target_objtype = sample_objtype(nspec, program.upper())
+
+    fibermap = empty_fibermap(nspec)
+    fibermap['TARGETID'] = np.random.randint(sys.maxsize, size=nspec).astype(np.int64)
+    fibermap['OBJTYPE'][:] = target_objtype.astype(fibermap['OBJTYPE'].dtype)
+    for objtype in set(true_objtype):
+        ii = (true_objtype == objtype)
+        desi_target, bgs_target, mws_target = _target_bits(objtype)
+        fibermap['DESI_TARGET'][ii] = desi_target
+        fibermap['BGS_TARGET'][ii] = bgs_target
+        fibermap['MWS_TARGET'][ii] = mws_target
+
+    #- Load fiber -> positioner mapping and tile information
+    fiberpos = desimodel.io.load_fiberpos()
+
+    #- Where are these targets?  Centered on positioners for now.
+    x = fiberpos['X'][specmin:specmin+nspec]
+    y = fiberpos['Y'][specmin:specmin+nspec]
+    fp = FocalPlane(tile_ra, tile_dec)
+    ra, dec = fp.xy2radec(np.asarray(x), np.asarray(y))
+
+    #- Fill in the rest of the fibermap structure
+    fibermap['FIBER'] = np.arange(nspec, dtype='i4')
+    fibermap['POSITIONER'] = fiberpos['POSITIONER'][specmin:specmin+nspec]
+    fibermap['SPECTROID'] = fiberpos['SPECTROGRAPH'][specmin:specmin+nspec]
+    fibermap['TARGETCAT'] = np.zeros(nspec, dtype=(str, 20))
+    fibermap['LAMBDA_REF'] = np.ones(nspec, dtype=np.float32)*5400
+    fibermap['TARGET_RA'] = ra
+    fibermap['TARGET_DEC'] = dec
+    fibermap['FIBERASSIGN_X'] = x
+    fibermap['FIBERASSIGN_Y'] = y
+    fibermap['FIBER_RA'] = fibermap['TARGET_RA']
+    fibermap['FIBER_DEC'] = fibermap['TARGET_DEC']
+    fibermap['BRICKNAME'] = brick.brickname(ra, dec)
+
+    return fibermap, true_objtype
+
+def _insert_targets(ii, results, fibermap, flux, meta, objmeta):
+    '''
+    Inserts _simulate_objtype results for fibers ii into flux, meta, and
+    objmeta, using the TARGETIDs from fibermap
+    '''
+    simflux, meta1, objmeta1 = results
+    targetid = fibermap['TARGETID'][ii]
+
+    # Assign targetid
+    meta1['TARGETID'] = targetid
+    if hasattr(objmeta1, 'data'): # simqso.sqgrids.QsoSimPoints object
+        objmeta1.data['TARGETID'] = targetid
+    elif len(objmeta1) > 0:
+        objmeta1['TARGETID'] = targetid
+        # We want the dict key tied to the "true" object type (e.g., STAR),
+        # not, e.g., QSO_BAD.
+        key = meta1['OBJTYPE'][0]
+        if key in objmeta:
+            objmeta[key] = astropy.table.vstack( (objmeta[key], objmeta1) )
+        else:
+            objmeta[key] = objmeta1
+
+    flux[ii] = simflux
+    meta[ii] = meta1
+
+def _finish_targets(fibermap, flux, wave, meta):
+    '''Copies photometry into the fibermap and checks dimensionality'''
+    for band in ['G', 'R', 'Z', 'W1', 'W2']:
+        key = 'FLUX_'+band
+        fibermap[key] = meta[key]
+        #- TODO: FLUX_IVAR
+
+    nspec, nwave = flux.shape
+    assert len(fibermap) == nspec
+    assert len(meta) == nspec
+    assert len(wave) == nwave
 
 def get_targets_parallel(nspec, program, tileid=None, nproc=None, seed=None, specify_targets=dict()):
     '''
     Parallel wrapper for get_targets()
 
     nproc (int) is number of multiprocessing processes to use.
+
+    Work is split by objtype x chunk of targets so that each process only
+    instantiates the template classes (and reads the basis templates) of
+    the objtypes that it simulates.
     '''
     import multiprocessing as mp
     if nproc is None:
@@ -197,51 +368,54 @@ def get_targets_parallel(nspec, program, tileid=None, nproc=None, seed=None, spe
     if nspec < 20:
         log.debug('Not Parallelizing get_targets for only {} targets'.format(nspec))
         return get_targets(nspec, program, tileid, seed=seed, specify_targets=specify_targets)
-    else:
-        nproc = min(nproc, nspec//10)
-        log.debug('Parallelizing get_targets using {} cores'.format(nproc))
-        args = list()
-        n = nspec // nproc
-        #- Generate random seeds for each process to use as a random seed
-        np.random.seed(seed)
-        seeds = np.random.randint(2**32, size=nspec)
-        for i in range(0, nspec, n):
-            if i+n < nspec:
-                args.append( (n, program, tileid, seeds[i], specify_targets, i) )
-            else:
-                args.append( (nspec-i, program, tileid, seeds[i], specify_targets, i) )
-
-        with mp.Pool(nproc) as P:
-            results = P.map(_wrap_get_targets, args)
-        fibermaps, targets = list(zip(*results))
-        fibermap = np.concatenate(fibermaps)
-
-        #- wave should be the same for all targets
-        wave = targets[0][1]
-
-        #- vstack for arrays, hstack for tables, python-fu for dictionaries
-        flux = np.vstack([tx[0] for tx in targets])
-        meta = np.hstack([tx[2] for tx in targets])
-        objmeta = dict()
-        for tx in targets:
-            if len(tx[3]) > 0: # can be empty, e.g., for QSOs
-                for key in tx[3].keys():
-                    if key in objmeta:
-                        objmeta[key] = astropy.table.vstack( (objmeta[key], tx[3][key]) )
-                    else:
-                        objmeta[key] = tx[3][key]
-
-        #- Fix FIBER and SPECTROID entries in fibermap
-        fibermap['FIBER'] = np.arange(nspec)
-        fibermap['SPECTROID'] = fibermap['FIBER'] // 500
-
-        #- Check dimensionality
-        nspec, nwave = flux.shape
-        assert len(fibermap) == nspec
-        assert len(meta) == nspec
-        assert len(wave) == nwave
-
-        return fibermap, (flux, wave, meta, objmeta)
+
+    np.random.seed(seed)
+    fibermap, true_objtype = _init_targets(nspec, program, tileid)
+    wave = _default_wave()
+
+    #- Split each objtype into chunks of at least 10 targets
+    chunksize = max(10, nspec // max(nproc, 1))
+    indices = list()
+    args = list()
+    for objtype in sorted(set(true_objtype)):
+        if objtype == 'SKY':
+            continue
+        ii = np.where(true_objtype == objtype)[0]
+        obj_kwargs = specify_targets.get(objtype, dict())
+        for i in range(0, len(ii), chunksize):
+            indices.append(ii[i:i+chunksize])
+            args.append([objtype, len(indices[-1]), wave, None, obj_kwargs])
+
+    #- Generate random seeds for each chunk to use as a random seed
+    seeds = np.random.randint(2**32, size=len(args))
+    for i in range(len(args)):
+        args[i][3] = seeds[i]
+
+    nproc = min(nproc, len(args))
+    try:
+        if nproc > 1:
+            log.debug('Parallelizing get_targets using {} cores for {} objtype chunks'.format(
+                nproc, len(args)))
+            with mp.Pool(nproc) as P:
+                results = P.map(_wrap_simulate_objtype, args)
+        else:
+            results = [_wrap_simulate_objtype(x) for x in args]
+    finally:
+        _template_makers.clear()
+
+    flux = np.zeros( (nspec, len(wave)) )
+    meta, _ = empty_metatable(nmodel=nspec, objtype='SKY')
+    meta['TARGETID'] = fibermap['TARGETID']
+    objmeta = dict()
+    for ii, res in zip(indices, results):
+        _insert_targets(ii, res, fibermap, flux, meta, objmeta)
+
+    #- Fix SPECTROID entries in fibermap
+    fibermap['SPECTROID'] = fibermap['FIBER'] // 500
+
+    _finish_targets(fibermap, flux, wave, meta)
+
+    return fibermap, (flux, wave, meta, objmeta)
 
 def get_targets(nspec, program, tileid=None, seed=None, specify_targets=dict(), specmin=0):
     """
@@ -264,164 +438,33 @@ def get_targets(nspec, program, tileid=None, seed=None, specify_targets=dict(),
       * fibermap
       * targets as tuple of (flux, wave, meta)
     """
-    if tileid is None:
-        tile_ra, tile_dec = 0.0, 0.0
-    else:
-        tile_ra, tile_dec = io.get_tile_radec(tileid)
-
-    program = program.upper()
     log.debug('Using random seed {}'.format(seed))
     np.random.seed(seed)
 
-    #- Get distribution of target types
-    true_objtype, target_objtype = sample_objtype(nspec, program)
+    fibermap, true_objtype = _init_targets(nspec, program, tileid, specmin=specmin)
 
     #- Get DESI wavelength coverage
-    try:
-        params = desimodel.io.load_desiparams()
-        wavemin = params['ccd']['b']['wavemin']
-        wavemax = params['ccd']['z']['wavemax']
-    except KeyError:
-        wavemin = desimodel.io.load_throughput('b').wavemin
-        wavemax = desimodel.io.load_throughput('z').wavemax
-    dw = 0.2
-    wave = np.arange(round(wavemin, 1), wavemax, dw)
-    nwave = len(wave)
+    wave = _default_wave()
 
     flux = np.zeros( (nspec, len(wave)) )
     meta, _ = empty_metatable(nmodel=nspec, objtype='SKY')
+    meta['TARGETID'] = fibermap['TARGETID']
     objmeta = dict()
-    fibermap = empty_fibermap(nspec)
-
-    targetid = np.random.randint(sys.maxsize, size=nspec).astype(np.int64)
-    meta['TARGETID'] = targetid
-    fibermap['TARGETID'] = targetid
-    
-    for objtype in set(true_objtype):
-        ii = np.where(true_objtype == objtype)[0]
-        nobj = len(ii)
-
-        fibermap['OBJTYPE'][ii] = target_objtype[ii].astype(fibermap['OBJTYPE'].dtype)
-
-        if objtype in specify_targets.keys():
-            obj_kwargs = specify_targets[objtype]
-        else:
-            obj_kwargs = dict()
-                
-        # Simulate spectra
-        if objtype == 'SKY':
-            fibermap['DESI_TARGET'][ii] = desi_mask.SKY
-            continue
-
-        elif objtype == 'ELG':
-            from desisim.templates import ELG
-            elg = ELG(wave=wave)
-            simflux, wave1, meta1, objmeta1 = elg.make_templates(nmodel=nobj, seed=seed, **obj_kwargs)
-            fibermap['DESI_TARGET'][ii] = desi_mask.ELG
-
-        elif objtype == 'LRG':
-            from desisim.templates import LRG
-            lrg = LRG(wave=wave)
-            simflux, wave1, meta1, objmeta1 = lrg.make_templates(nmodel=nobj, seed=seed, **obj_kwargs)
-            fibermap['DESI_TARGET'][ii] = desi_mask.LRG
-
-        elif objtype == 'BGS':
-            from desisim.templates import BGS
-            bgs = BGS(wave=wave)
-            simflux, wave1, meta1, objmeta1 = bgs.make_templates(nmodel=nobj, seed=seed, **obj_kwargs)
-            fibermap['DESI_TARGET'][ii] = desi_mask.BGS_ANY
-            fibermap['BGS_TARGET'][ii] = bgs_mask.BGS_BRIGHT
-
-        elif objtype == 'QSO':
-            from desisim.templates import QSO
-            qso = QSO(wave=wave)
-            simflux, wave1, meta1, objmeta1 = qso.make_templates(nmodel=nobj, seed=seed, lyaforest=False, **obj_kwargs)
-            fibermap['DESI_TARGET'][ii] = desi_mask.QSO
-
-        # For a "bad" QSO simulate a normal star without color cuts, which isn't
-        # right. We need to apply the QSO color-cuts to the normal stars to pull
-        # out the correct population of contaminating stars.
-
-        # Note by @moustakas: we can now do this using desisim/#150, but we are
-        # going to need 'noisy' photometry (because the QSO color-cuts
-        # explicitly avoid the stellar locus).
-        elif objtype == 'QSO_BAD':
-            from desisim.templates import STAR
-            #from desitarget.cuts import isQSO
-            #star = STAR(wave=wave, colorcuts_function=isQSO)
-            star = STAR(wave=wave)
-            simflux, wave1, meta1, objmeta1 = star.make_templates(nmodel=nobj, seed=seed, **obj_kwargs)
-            fibermap['DESI_TARGET'][ii] = desi_mask.QSO
-
-        elif objtype == 'STD':
-            from desisim.templates import STD
-            std = STD(wave=wave)
-            simflux, wave1, meta1, objmeta1 = std.make_templates(nmodel=nobj, seed=seed, **obj_kwargs)
-            #- Loop options for forwards/backwards compatibility
-            for name in ['STD_FAINT', 'STD_FSTAR', 'STD']:
-                if name in desi_mask.names():
-                    fibermap['DESI_TARGET'][ii] |= desi_mask[name]
-                    break
-
-        elif objtype == 'MWS_STAR':
-            from desisim.templates import MWS_STAR
-            mwsstar = MWS_STAR(wave=wave)
-            # TODO: mag ranges for different programs of STAR targets should be in desimodel
-            if 'magrange' not in obj_kwargs.keys():
-                obj_kwargs['magrange'] = (15.0,20.0)
-            simflux, wave1, meta1, objmeta1 = mwsstar.make_templates(nmodel=nobj, seed=seed, **obj_kwargs)
-            fibermap['DESI_TARGET'][ii] |= desi_mask.MWS_ANY
-            #- MWS bit names changed after desitarget 0.6.0 so use number
-            #- instead of name for now (bit 0 = mask 1 = MWS_MAIN currently)
-            fibermap['MWS_TARGET'][ii] = 1
-
-        else:
-            raise ValueError('Unable to simulate OBJTYPE={}'.format(objtype))
 
-        # Assign targetid
-        meta1['TARGETID'] = targetid[ii]
-        if hasattr(objmeta1, 'data'): # simqso.sqgrids.QsoSimPoints object
-            objmeta1.data['TARGETID'] = targetid[ii]
-        else:
-            if len(objmeta1) > 0:
-                objmeta1['TARGETID'] = targetid[ii]
-                # We want the dict key tied to the "true" object type (e.g., STAR),
-                # not, e.g., QSO_BAD.
-                objmeta[meta1['OBJTYPE'][0]] = objmeta1
-
-        flux[ii] = simflux
-        meta[ii] = meta1
-
-        for band in ['G', 'R', 'Z', 'W1', 'W2']:
-            key = 'FLUX_'+band
-            fibermap[key][ii] = meta[key][ii]
-            #- TODO: FLUX_IVAR
-
-    #- Load fiber -> positioner mapping and tile information
-    fiberpos = desimodel.io.load_fiberpos()
-
-    #- Where are these targets?  Centered on positioners for now.
-    x = fiberpos['X'][specmin:specmin+nspec]
-    y = fiberpos['Y'][specmin:specmin+nspec]
-    fp = FocalPlane(tile_ra, tile_dec)
-    ra = np.zeros(nspec)
-    dec = np.zeros(nspec)
-    for i in range(nspec):
-        ra[i], dec[i] = fp.xy2radec(x[i], y[i])
-
-    #- Fill in the rest of the fibermap structure
-    fibermap['FIBER'] = np.arange(nspec, dtype='i4')
-    fibermap['POSITIONER'] = fiberpos['POSITIONER'][specmin:specmin+nspec]
-    fibermap['SPECTROID'] = fiberpos['SPECTROGRAPH'][specmin:specmin+nspec]
-    fibermap['TARGETCAT'] = np.zeros(nspec, dtype=(str, 20))
-    fibermap['LAMBDA_REF'] = np.ones(nspec, dtype=np.float32)*5400
-    fibermap['TARGET_RA'] = ra
-    fibermap['TARGET_DEC'] = dec
-    fibermap['FIBERASSIGN_X'] = x
-    fibermap['FIBERASSIGN_Y'] = y
-    fibermap['FIBER_RA'] = fibermap['TARGET_RA']
-    fibermap['FIBER_DEC'] = fibermap['TARGET_DEC']
-    fibermap['BRICKNAME'] = brick.brickname(ra, dec)
+    try:
+        for objtype in sorted(set(true_objtype)):
+            if objtype == 'SKY':
+                continue
+
+            ii = np.where(true_objtype == objtype)[0]
+            obj_kwargs = specify_targets.get(objtype, dict())
+            results = _simulate_objtype(objtype, len(ii), wave, seed=seed,
+                                        obj_kwargs=obj_kwargs)
+            _insert_targets(ii, results, fibermap, flux, meta, objmeta)
+    finally:
+        _template_makers.clear()
+
+    _finish_targets(fibermap, flux, wave, meta)
 
     return fibermap, (flux, wave, meta, objmeta)
 
@@ -14,6 +14,7 @@ import multiprocessing
 from copy import copy
 from desiutil.log import get_logger, DEBUG
 from desisim.io import empty_metatable
+from desisim.rng import random_state
 
 try:
     from scipy import constants
@@ -211,7 +212,7 @@ class EMSpectrum(object):
         """
         from astropy.table import Table
 
-        rand = np.random.RandomState(seed)
+        rand = random_state(seed)
 
         line = self.line.copy()
         nline = len(line)
@@ -494,7 +495,7 @@ class GALAXY(object):
             raise NotImplementedError('AGNLIKE option not yet implemented')
 
         if rand is None:
-            rand = np.random.RandomState()
+            rand = random_state()
 
         if oiidoublet_meansig[1] > 0:
             oiidoublet = rand.normal(oiidoublet_meansig[0], oiidoublet_meansig[1], nobj)
@@ -646,7 +647,7 @@ class GALAXY(object):
                 vdisp = input_objmeta['VDISP']
 
             templateseed = input_meta['SEED'].data
-            rand = np.random.RandomState(templateseed[0])
+            rand = random_state(templateseed[0])
 
             use_redshift = input_meta['REDSHIFT'].data
             use_mag = input_meta['MAG'].data
@@ -656,7 +657,7 @@ class GALAXY(object):
             nmodel = len(input_meta)
         else:
             # Initialize the random seed. If nmodel=1, use the input seed itself.
-            rand = np.random.RandomState(seed)
+            rand = random_state(seed)
             if nmodel == 1 and seed is not None:
                 templateseed = np.atleast_1d(seed)
             else:
@@ -731,6 +732,16 @@ class GALAXY(object):
             objmeta['TRANSIENT_EPOCH'][:] = trans_epoch
             objmeta['TRANSIENT_RFLUXRATIO'][:] = trans_rfluxratio
 
+            # Evaluate the flux for all epochs at once where the model has
+            # defined wavelengths.  Zero-pad all other wavelength values.
+            trans_restflux_all = np.zeros([nmodel, len(self.basewave)])
+            minw = self.transient.minwave().to('Angstrom').value
+            maxw = self.transient.maxwave().to('Angstrom').value
+            j = np.argwhere(self.basewave >= minw)[0,0]
+            k = np.argwhere(self.basewave <= maxw)[-1,0]
+
+            trans_restflux_all[:, j:k] = self.transient.fluxes(trans_epoch, self.basewave[j:k] * u.Angstrom)
+
         # Populate some of the metadata table.
         for key, value in zip(('MAGFILTER', 'SEED'),(magfilter, templateseed)):
             meta[key][:] = value
@@ -754,7 +765,7 @@ class GALAXY(object):
         fiberflux_fraction = self.fiberflux_fraction[self.objtype]
 
         for ii in range(nmodel):
-            templaterand = np.random.RandomState(templateseed[ii])
+            templaterand = random_state(templateseed[ii])
 
             # Shuffle the templates in order to add some variety to the selection.
             if input_meta is None:
@@ -834,15 +845,7 @@ class GALAXY(object):
     
                 # Optionally get the transient spectrum and normalization factor.
                 if self.transient is not None:
-                    # Evaluate the flux where the model has defined wavelengths.
-                    # Zero-pad all other wavelength values.
-                    trans_restflux = np.zeros_like(self.basewave, dtype=float)
-                    minw = self.transient.minwave().to('Angstrom').value
-                    maxw = self.transient.maxwave().to('Angstrom').value
-                    j = np.argwhere(self.basewave >= minw)[0,0]
-                    k = np.argwhere(self.basewave <= maxw)[-1,0]
-    
-                    trans_restflux[j:k] = self.transient.flux(trans_epoch[ii], self.basewave[j:k] * u.Angstrom) 
+                    trans_restflux = trans_restflux_all[ii]
                     trans_norm = normfilt[magfilter[ii]].get_ab_maggies(trans_restflux, zwave)
     
                 # Assign the emission-line spectrum to chunks of continuum spectra
@@ -1436,7 +1439,7 @@ class SUPERSTAR(object):
                 if 'SEED' in star_properties.keys():
                     templateseed = star_properties['SEED'].data
                 else:
-                    rand = np.random.RandomState(seed)
+                    rand = random_state(seed)
                     if nmodel == 1 and seed is not None:
                         templateseed = np.atleast_1d(seed)
                     else:
@@ -1454,7 +1457,7 @@ class SUPERSTAR(object):
                 nchunk = 1
             else:
                 # Initialize the random seed.
-                rand = np.random.RandomState(seed)
+                rand = random_state(seed)
                 if nmodel == 1 and seed is not None:
                     templateseed = np.atleast_1d(seed)
                 else:
@@ -1518,7 +1521,7 @@ class SUPERSTAR(object):
             outflux = np.zeros([nmodel, len(self.wave)]) # [erg/s/cm2/A]
 
         for ii in range(nmodel):
-            templaterand = np.random.RandomState(templateseed[ii])
+            templaterand = random_state(templateseed[ii])
 
             # Shuffle the templates in order to add some variety to the selection.
             if input_meta is None:
@@ -1958,11 +1961,8 @@ class QSO():
             wave = np.linspace(minwave, maxwave, npix)
         self.wave = wave
 
-        try:
-            from astropy.cosmology import FlatLambdaCDM # astropy >v5.0
-        except:
-            from astropy.cosmology.core import FlatLambdaCDM
-        self.cosmo = FlatLambdaCDM(70.0, 0.3)
+        from desisim.cosmology import get_lcdm
+        self.cosmo = get_lcdm(70.0, 0.3)
 
         self.lambda_lylimit = 911.76
         self.lambda_lyalpha = 1215.67
@@ -2131,7 +2131,7 @@ class QSO():
             _check_input_meta(input_meta, ignore_templateid=True)
 
             templateseed = input_meta['SEED'].data
-            rand = np.random.RandomState(templateseed[0])
+            rand = random_state(templateseed[0])
 
             use_redshift = input_meta['REDSHIFT'].data
             use_mag = input_meta['MAG'].data
@@ -2146,7 +2146,7 @@ class QSO():
                 balmeta = vstack([self.balmeta for ii in range(nmodel)])
 
             # Initialize the random seed.
-            rand = np.random.RandomState(seed)
+            rand = random_state(seed)
             if nmodel == 1 and seed is not None:
                 templateseed = np.atleast_1d(seed)
             else:
@@ -2225,7 +2225,7 @@ class QSO():
             if ii % 100 == 0 and ii > 0:
                 log.debug('Simulating {} template {}/{}.'.format(self.objtype, ii, nmodel))
 
-            templaterand = np.random.RandomState(templateseed[ii])
+            templaterand = random_state(templateseed[ii])
 
             # Assign redshift and magnitude priors.
             if use_redshift is None:
@@ -2511,11 +2511,8 @@ class SIMQSO():
         else:
             self.basewave = fixed_R_dispersion(basewave_min, basewave_max, basewave_R)
             
-        try:
-            from astropy.cosmology import FlatLambdaCDM # astropy >v5.0
-        except:
-            from astropy.cosmology.core import FlatLambdaCDM
-        self.cosmo = FlatLambdaCDM(70.0, 0.3)
+        from desisim.cosmology import get_lcdm
+        self.cosmo = get_lcdm(70.0, 0.3)
 
         self.lambda_lylimit = 911.76
         self.lambda_lyalpha = 1215.67
@@ -2818,7 +2815,7 @@ class SIMQSO():
                 raise ValueError
 
             # Initialize the random seed and assign redshift priors.
-            rand = np.random.RandomState(seed)
+            rand = random_state(seed)
 
             if redshift is not None:
                 if len(redshift) != nmodel:
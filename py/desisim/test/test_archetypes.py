@@ -0,0 +1,109 @@
+import unittest, os, shutil, tempfile
+import numpy as np
+
+from desisim.archetypes import compute_chi2, compute_adjacency, ArcheTypes
+
+class TestArchetypes(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        rand = np.random.RandomState(1)
+        cls.flux = rand.uniform(0.5, 2.0, size=(23, 40))
+        cls.ferr = rand.uniform(0.05, 0.2, size=cls.flux.shape)
+        cls.testdir = tempfile.mkdtemp()
+
+    @classmethod
+    def tearDownClass(cls):
+        if os.path.exists(cls.testdir):
+            shutil.rmtree(cls.testdir)
+
+    def test_chi2(self):
+        nspec, npix = self.flux.shape
+        norm = self.flux * np.sqrt(npix/np.sum(self.flux**2, axis=1))[:, None]
+        amp1 = norm.dot(norm.T) / npix
+        chi2, amp = compute_chi2(self.flux, blocksize=5)
+        self.assertEqual(chi2.shape, (nspec, nspec))
+        self.assertTrue(np.allclose(chi2, npix*(1-amp1**2) * (1-np.eye(nspec)), atol=1e-4))
+        self.assertTrue(np.allclose(chi2, chi2.T))
+        #- amp scales spectrum j onto spectrum i
+        ii = np.arange(nspec)
+        self.assertTrue(np.allclose(amp[ii, 3], amp1[ii, 3]*np.sqrt(
+            np.sum(self.flux[3]**2)/np.sum(self.flux**2, axis=1)), rtol=1e-5))
+
+        #- memory-mapped output and a single thread give the same answer
+        chi2b, ampb = compute_chi2(self.flux, blocksize=7, outdir=self.testdir, nthreads=1)
+        self.assertTrue(np.all(chi2b == chi2))
+        self.assertTrue(np.all(ampb == amp))
+        self.assertTrue(np.all(np.load(os.path.join(self.testdir, 'chi2.npy')) == chi2))
+
+    def test_weighted_chi2(self):
+        nspec, npix = self.flux.shape
+        rescale = np.sqrt(npix/np.sum(self.flux**2, axis=1))
+        flux = self.flux * rescale[:, None]
+        ferr = self.ferr * rescale[:, None]
+        chi2, amp = compute_chi2(self.flux, self.ferr, blocksize=5)
+        for i in (0, 11):
+            #- quick_amplitude(x, y, xerr, yerr, niter=1) for row i
+            weight = 1/(ferr**2 + ferr[i]**2)
+            xy = np.clip(flux[i]*flux, 1e-10, None)
+            a = np.sum(xy*weight, axis=1) / np.sum(flux[i]**2*weight, axis=1)
+            c = np.sum((a[:, None]*flux[i] - flux)**2 * weight, axis=1)
+            c[i] = 0.0
+            self.assertTrue(np.allclose(chi2[i], c, rtol=1e-4, atol=1e-3))
+            a *= rescale[i] / rescale
+            a[i] = 1.0
+            self.assertTrue(np.allclose(amp[i], a, rtol=1e-5))
+
+        #- tiling over spectra and pixels doesn't change the result
+        from desisim.archetypes import _chi2_block
+        chi2a, ampa = _chi2_block(flux, ferr, 2, 9, 4, 17)
+        for maxsize in (1, 30, 200, 1000):
+            chi2b, ampb = _chi2_block(flux, ferr, 2, 9, 4, 17, maxsize=maxsize)
+            self.assertTrue(np.allclose(chi2b, chi2a))
+            self.assertTrue(np.allclose(ampb, ampa))
+
+    def test_adjacency(self):
+        for ferr, thresh in ((None, 8.0), (self.ferr, 480.0)):
+            chi2, amp = compute_chi2(self.flux, ferr, blocksize=5)
+            adjacency = compute_adjacency(self.flux, ferr, chi2_thresh=thresh, blocksize=5)
+            dense = chi2 <= thresh
+            self.assertTrue(np.all(adjacency.toarray() == dense))
+            self.assertTrue(np.all(ArcheTypes(chi2).get_adjacency(thresh, blocksize=4).toarray() == dense))
+
+            #- responsibility from the sparse matrix matches the dense version
+            archetypes = ArcheTypes(adjacency=adjacency)
+            iarch, resp, respindx = archetypes.get_archetypes(responsibility=True, solver='greedy')
+            self.assertTrue(np.all(np.any(dense[:, iarch], axis=1)))
+            resp2, respindx2 = archetypes.responsibility(iarch, dense*1)
+            self.assertTrue(np.all(resp == resp2))
+            for x, y in zip(respindx, respindx2):
+                self.assertTrue(np.all(x == y))
+
+        #- rows that no column covers can't be solved
+        from scipy import sparse
+        with self.assertRaises(ValueError):
+            ArcheTypes(adjacency=sparse.csc_matrix([[1,0],[0,0]])).get_archetypes(solver='greedy')
+
+    def test_setcover_nspec(self):
+        #- the dense setcover solver refuses large samples before densifying
+        import desisim.archetypes
+        from scipy import sparse
+        archetypes = ArcheTypes(adjacency=sparse.identity(5, dtype=bool, format='csc'))
+        nmax = desisim.archetypes.max_setcover_nspec
+        try:
+            desisim.archetypes.max_setcover_nspec = 4
+            with self.assertRaises(ValueError):
+                archetypes.get_archetypes(solver='setcover')
+        finally:
+            desisim.archetypes.max_setcover_nspec = nmax
+        self.assertTrue(np.all(archetypes.get_archetypes(solver='greedy') == np.arange(5)))
+
+if __name__ == '__main__':
+    unittest.main()
+
+def test_suite():
+    """Allows testing of only this module with the command::
+
+        python setup.py test -m desisim.test.test_archetypes
+    """
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
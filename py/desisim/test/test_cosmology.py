@@ -0,0 +1,21 @@
+import unittest
+
+from desisim import cosmology
+
+class TestCosmology(unittest.TestCase):
+
+    def test_get_lcdm(self):
+        cosmo = cosmology.get_lcdm()
+        self.assertIs(cosmo, cosmology.get_lcdm(70, 0.3))
+        self.assertEqual(cosmo.H0.value, 70)
+        self.assertIsNot(cosmo, cosmology.get_lcdm(H0=100))
+
+if __name__ == '__main__':
+    unittest.main()
+
+def test_suite():
+    """Allows testing of only this module with the command::
+
+        python setup.py test -m desisim.test.test_cosmology
+    """
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -0,0 +1,95 @@
+import unittest, os, shutil, tempfile
+import numpy as np
+
+from desisim import fiberloss
+
+class TestFiberloss(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.testdir = tempfile.mkdtemp()
+        cls.gridfile = os.path.join(cls.testdir, 'fiberloss-grid.fits')
+
+        #- Grids linear in every axis so that interpolation is exact
+        cls.axes = dict(HLR=np.array([0.1, 1.0, 3.0]),
+                        AXISRATIO=np.array([0.5, 1.0]),
+                        SEEING=np.array([0.5, 1.0, 2.0, 3.0]),
+                        RADIUS=np.array([0.0, 200.0, 420.0]),
+                        WAVE=np.array([3500.0, 6000.0, 10000.0]))
+        grid = np.meshgrid(*[cls.axes[x] for x in fiberloss._axes], indexing='ij')
+        hlr, q, seeing, r, wave = grid
+        cls.point = 0.9 - 0.1*seeing[0,0] - 1e-4*r[0,0] + 1e-6*wave[0,0]
+        cls.disk = cls.point - 0.05*hlr + 0.02*q
+        cls.bulge = cls.point - 0.03*hlr + 0.01*q
+        fiberloss.FiberlossGrid(cls.axes, cls.point, cls.disk, cls.bulge).write(cls.gridfile)
+
+    @classmethod
+    def tearDownClass(cls):
+        if os.path.exists(cls.testdir):
+            shutil.rmtree(cls.testdir)
+
+    def test_read_write(self):
+        grid = fiberloss.FiberlossGrid.read(self.gridfile)
+        for name in fiberloss._axes:
+            self.assertTrue(np.all(grid.axes[name] == self.axes[name]))
+        self.assertTrue(np.allclose(grid.disk, self.disk))
+        self.assertIs(fiberloss.get_fiberloss_grid(self.gridfile),
+                      fiberloss.get_fiberloss_grid(self.gridfile))
+        with self.assertRaises(IOError):
+            fiberloss.get_fiberloss_grid(self.gridfile+'.missing')
+
+        #- No grid is shipped; the default comes from $DESISIM_FIBERLOSS_GRID
+        origgrid = os.environ.pop('DESISIM_FIBERLOSS_GRID', None)
+        try:
+            with self.assertRaises(KeyError):
+                fiberloss.get_fiberloss_grid()
+            os.environ['DESISIM_FIBERLOSS_GRID'] = self.gridfile
+            self.assertIs(fiberloss.get_fiberloss_grid(),
+                          fiberloss.get_fiberloss_grid(self.gridfile))
+        finally:
+            if origgrid is None:
+                os.environ.pop('DESISIM_FIBERLOSS_GRID', None)
+            else:
+                os.environ['DESISIM_FIBERLOSS_GRID'] = origgrid
+
+    def test_acceptance(self):
+        grid = fiberloss.get_fiberloss_grid(self.gridfile)
+        wave = np.linspace(3600, 9800, 7)
+        seeing = np.linspace(1.2, 0.9, 7)
+        r = np.array([10.0, 150.0, 400.0])
+        point = 0.9 - 0.1*seeing - 1e-4*r[:, None] + 1e-6*wave
+
+        #- Default point sources
+        x = grid.acceptance(seeing, r, wave)
+        self.assertEqual(x.shape, (3, 7))
+        self.assertTrue(np.allclose(x, point))
+
+        #- Mixtures are weighted sums of the profiles
+        fraction = np.array([[0.0, 0.0], [1.0, 0.0], [0.52, 0.48]])
+        hlr = np.array([[0.0, 0.0], [0.45, 0.0], [2.0, 1.3]])
+        q = np.array([[1.0, 1.0], [0.7, 1.0], [1.0, 0.7]])
+        x = grid.acceptance(seeing, r, wave, fraction, hlr, q)
+        disk = point - 0.05*hlr[:, 0:1] + 0.02*q[:, 0:1]
+        bulge = point - 0.03*hlr[:, 1:2] + 0.01*q[:, 1:2]
+        point_fraction = 1 - fraction.sum(axis=1)
+        expected = (point_fraction[:, None]*point + fraction[:, 0:1]*disk +
+                    fraction[:, 1:2]*bulge)
+        self.assertTrue(np.allclose(x, expected))
+
+        #- Inputs outside of the grid are clipped to its edges
+        x = grid.acceptance(np.full(7, 5.0), [500.0], wave)
+        y = grid.acceptance(np.full(7, 3.0), [420.0], wave)
+        self.assertTrue(np.allclose(x, y))
+
+        with self.assertRaises(ValueError):
+            grid.acceptance(seeing[1:], r, wave)
+
+if __name__ == '__main__':
+    unittest.main()
+
+def test_suite():
+    """Allows testing of only this module with the command::
+
+        python setup.py test -m desisim.test.test_fiberloss
+    """
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
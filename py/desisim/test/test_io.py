@@ -83,6 +83,74 @@ class TestIO(unittest.TestCase):
         for key in meta:
             self.assertTrue(meta[key] == header[key])
 
+    def test_shared_resolution(self):
+        from astropy.table import Table
+        from desispec.spectra import Spectra
+        import desispec.io
+        nspec, nwave = 3, 20
+        outfile = os.path.join(io.simdir(), 'spectra-shared-resolution.fits')
+        wave = {'b': np.linspace(3600, 3700, nwave)}
+        flux = {'b': np.random.uniform(size=(nspec, nwave))}
+        ivar = {'b': np.ones((nspec, nwave))}
+        fibermap = Table()
+        fibermap['TARGETID'] = np.arange(nspec)
+        sp = Spectra(['b',], wave, flux, ivar, fibermap=fibermap, single=True)
+        desispec.io.write_spectra(outfile, sp)
+
+        rdata = np.random.uniform(size=(11, nwave)).astype(np.float32)
+        io.write_shared_resolution(outfile, dict(b=rdata))
+        sp = io.read_spectra(outfile)
+        self.assertEqual(sp.resolution_data['b'].shape, (nspec, 11, nwave))
+        for i in range(nspec):
+            self.assertTrue(np.all(sp.resolution_data['b'][i] == rdata))
+        self.assertEqual(len(sp.R['b']), nspec)
+
+    def test_simspec_layouts(self):
+        '''Per-camera photons read back from every write_simspec layout'''
+        import astropy.units as u
+        from astropy.table import Table
+        import specsim.simulator
+        nspec = 4
+        sim = specsim.simulator.Simulator('test', num_fibers=nspec,
+                                          camera_output=False)
+        nwave = len(sim.simulated)
+        fluxunit = 1e-17 * u.erg / (u.Angstrom * u.s * u.cm**2)
+        flux = np.outer(np.random.uniform(1, 2, nspec), np.linspace(1, 2, nwave))
+        xy = np.random.uniform(-200, 200, size=(nspec, 2)) * u.mm
+        sim.simulate(source_fluxes=flux*fluxunit, focal_positions=xy,
+                     source_types=np.array(['qso',]*nspec))
+        fibermap = Table(dict(FIBER=np.arange(nspec), TARGETID=np.arange(nspec)))
+        header = dict(FLAVOR='flat')
+        phot = sim.simulated['num_source_electrons_r'].T
+        skyphot = sim.simulated['num_sky_electrons_r'].T
+
+        os.makedirs(self.testDir, exist_ok=True)
+        sizes = dict()
+        for layout in ('full', 'compress', 'none'):
+            filename = os.path.join(self.testDir, 'simspec-{}.fits'.format(layout))
+            io.write_simspec(sim, None, fibermap, None, 1, '20200101',
+                             filename=filename, header=header, phot=layout)
+            sizes[layout] = os.path.getsize(filename)
+            simspec = io.read_simspec(filename, cameras='r0')
+            self.assertEqual(simspec.flux.shape, (nspec, nwave))
+            wave = simspec.cameras['r0'].wave
+            ii = (wave[0] <= simspec.wave) & (simspec.wave <= wave[-1])
+            rtol = 1e-2 if layout == 'compress' else 1e-5
+            self.assertTrue(np.allclose(simspec.cameras['r0'].phot, phot[:, ii], rtol=rtol))
+            self.assertTrue(np.allclose(simspec.cameras['r0'].skyphot, skyphot[:, ii], rtol=rtol))
+
+        self.assertLess(sizes['compress'], sizes['full'])
+        with fits.open(filename) as fx:
+            self.assertNotIn('PHOT_R', fx)
+            self.assertIn('PHOTCAL_R', fx)
+        with self.assertRaises(IOError):
+            io.write_simspec(sim, None, fibermap, None, 1, '20200101',
+                             filename=filename, header=header)
+        with self.assertRaises(ValueError):
+            io.write_simspec(sim, None, fibermap, None, 1, '20200101',
+                             filename=filename, header=header, phot='blat',
+                             overwrite=True)
+
     @unittest.skipUnless(desimodel_data_available, 'The desimodel data/ directory was not detected.')
     def test_get_tile_radec(self):
         ra, dec = io.get_tile_radec(0)
@@ -207,6 +207,108 @@ class TestObs(unittest.TestCase):
         self.assertEqual(len(truth2), len(targetids))
         self.assertTrue(np.all(truth2['TARGETID'] == targetids))
 
+        #- Only the requested rows are read, in the requested order
+        import fitsio
+        allflux = fitsio.read(truthfile, 'FLUX')
+        rows = np.array([5, 0, 17, 3, 4])
+        rows = rows[rows < len(truth)]
+        flux, wave, truth2, objtruth = \
+                desisim.simexp.read_mock_spectra(truthfile, truth['TARGETID'][rows])
+        self.assertTrue(np.all(truth2['TARGETID'] == truth['TARGETID'][rows]))
+        self.assertTrue(np.allclose(flux, allflux[rows]))
+        for objtype in objtruth:
+            self.assertTrue(np.all(np.in1d(objtruth[objtype]['TARGETID'], truth2['TARGETID'])))
+
+        with self.assertRaises(ValueError):
+            desisim.simexp.read_mock_spectra(truthfile, [-1,])
+
+    def test_get_mock_spectra(self):
+        import healpy
+        import fitsio
+        from desitarget.io import find_target_files
+        from desitarget.targetmask import desi_mask
+
+        mockdir = os.path.join(self.testDir, 'mocks')
+        nside, nwave = 2, 10
+        wave = np.linspace(3600, 9800, nwave)
+        pixels = [5, 20, 33]
+
+        #- Truth files of several healpix pixels, each with targets that
+        #- are not assigned to a fiber
+        rows = list()
+        for i, ipix in enumerate(pixels):
+            theta, phi = healpy.pix2ang(nside, ipix, nest=True)
+            truth = np.zeros(6, dtype=[('TARGETID', 'i8'), ('TEMPLATETYPE', 'U10'),
+                                       ('RA', 'f8'), ('DEC', 'f8')])
+            truth['TARGETID'] = 100*(i+1) + np.arange(6)
+            truth['TEMPLATETYPE'] = ['ELG', 'QSO', 'ELG', 'QSO', 'ELG', 'ELG']
+            truth['RA'] = np.degrees(phi) + 0.01*np.arange(6)
+            truth['DEC'] = 90 - np.degrees(theta)
+            flux = truth['TARGETID'][:, None] + wave / 1e4
+            isELG = truth['TEMPLATETYPE'] == 'ELG'
+            truth_elg = np.zeros(isELG.sum(), dtype=[('TARGETID', 'i8'), ('OIIFLUX', 'f4')])
+            truth_elg['TARGETID'] = truth['TARGETID'][isELG]
+            truth_elg['OIIFLUX'] = truth_elg['TARGETID']
+            truthfile = find_target_files(mockdir, flavor='truth', obscon='dark',
+                                          hp=ipix, nside=nside, mock=True)
+            os.makedirs(os.path.dirname(truthfile))
+            with fitsio.FITS(truthfile, 'rw', clobber=True) as fx:
+                fx.write(truth, extname='TRUTH')
+                fx.write(flux.astype('f4'), extname='FLUX')
+                fx.write(wave, extname='WAVE')
+                fx.write(truth_elg, extname='TRUTH_ELG')
+            rows.append(truth[:4])
+
+        #- Fibers assigned to targets in every file, to sky, or unassigned,
+        #- in an order unrelated to the truth files
+        truth = np.concatenate(rows)
+        nspec = len(truth) + 4
+        fiberassign = Table()
+        fiberassign['TARGETID'] = np.full(nspec, -1, dtype='i8')
+        fiberassign['TARGET_RA'] = np.full(nspec, np.nan)
+        fiberassign['TARGET_DEC'] = np.full(nspec, np.nan)
+        fiberassign['DESI_TARGET'] = np.zeros(nspec, dtype='i8')
+        fibers = np.random.RandomState(1).permutation(nspec)
+        ii = fibers[:len(truth)]
+        fiberassign['TARGETID'][ii] = truth['TARGETID']
+        fiberassign['TARGET_RA'][ii] = truth['RA']
+        fiberassign['TARGET_DEC'][ii] = truth['DEC']
+        fiberassign['DESI_TARGET'][ii] = [desi_mask[x] for x in truth['TEMPLATETYPE']]
+        sky = fibers[len(truth):len(truth)+2]
+        fiberassign['TARGETID'][sky] = [900, 901]
+        fiberassign['TARGET_RA'][sky] = truth['RA'][0]
+        fiberassign['TARGET_DEC'][sky] = truth['DEC'][0]
+        fiberassign['DESI_TARGET'][sky] = desi_mask.SKY
+        unassigned = fibers[len(truth)+2:]
+
+        for nproc in (1, 2):
+            flux, wave2, meta, objmeta = desisim.simexp.get_mock_spectra(
+                fiberassign, mockdir=mockdir, nside=nside, obscon='dark', nproc=nproc)
+            self.assertTrue(np.allclose(wave2, wave))
+            self.assertTrue(np.all(meta['TARGETID'] == fiberassign['TARGETID']))
+            self.assertTrue(np.allclose(flux[ii], truth['TARGETID'][:, None] + wave / 1e4))
+            self.assertTrue(np.all(meta['TEMPLATETYPE'][ii] == truth['TEMPLATETYPE']))
+            self.assertTrue(np.all(flux[sky] == 0))
+            self.assertTrue(np.all(flux[unassigned] == 0))
+            self.assertTrue(np.all(meta['TARGETID'][unassigned] == -1))
+
+            #- Per-objtype truth stacked over all files
+            elgids = truth['TARGETID'][truth['TEMPLATETYPE'] == 'ELG']
+            self.assertEqual(sorted(objmeta['ELG']['TARGETID']), sorted(elgids))
+            self.assertTrue(np.all(objmeta['ELG']['OIIFLUX'] == objmeta['ELG']['TARGETID']))
+
+        #- The cached truth file indices are bounded
+        max_truth_index = desisim.simexp.max_truth_index
+        try:
+            desisim.simexp.max_truth_index = 2
+            desisim.simexp._truth_index.clear()
+            flux2, wave2, meta2, objmeta2 = desisim.simexp.get_mock_spectra(
+                fiberassign, mockdir=mockdir, nside=nside, obscon='dark', nproc=1)
+            self.assertEqual(len(desisim.simexp._truth_index), 2)
+            self.assertTrue(np.all(flux2 == flux))
+        finally:
+            desisim.simexp.max_truth_index = max_truth_index
+
     
 
 #- This runs all test* functions in any TestCase class in this file
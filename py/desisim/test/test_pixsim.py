@@ -162,6 +162,81 @@ class TestPixsim(unittest.TestCase):
         self.assertEqual(image.pix.shape[0], rawpix.shape[0])
         self.assertLess(image.pix.shape[1], rawpix.shape[1])  #- raw has overscan
 
+    def test_camera_writer(self):
+        rawfile = os.path.join(self.testdir, 'raw-writer.fits')
+        simpixfile = os.path.join(self.testdir, 'simpix-writer.fits')
+        header = {'DOSVER':'SIM', 'FEEVER':'SIM', 'DETECTOR':'SIM',
+                  'FLAVOR':'arc', 'EXPTIME':1.0,
+                  'DATE-OBS':'2020-01-01T00:00:00'}
+        for amp in 'ABCD':
+            for prefix in ['CCDSEC', 'BIASSEC', 'DATASEC']:
+                header[prefix+amp] = '[1:10,1:10]'
+
+        cameras = ['b0', 'r0', 'z0']
+        for threaded in (True, False):
+            writer = pixsim.CameraWriter(rawfile+'.tmp', simpixfile=simpixfile,
+                percamera=True, threaded=threaded)
+            for i, camera in enumerate(cameras):
+                rawpix = np.full((20, 20), i, dtype=np.int32)
+                writer.put(camera, rawpix, header, rawpix.astype(float))
+            writer.close()
+
+            for camera in cameras:
+                self.assertTrue(os.path.exists(
+                    pixsim.camera_tmpfile(rawfile+'.tmp', camera)))
+
+            pixsim.merge_camera_files(
+                [pixsim.camera_tmpfile(rawfile+'.tmp', c) for c in cameras],
+                rawfile, filename=rawfile)
+            pixsim.merge_camera_files(
+                [pixsim.camera_tmpfile(simpixfile, c) for c in cameras],
+                simpixfile)
+
+            with fits.open(rawfile) as fx:
+                for i, camera in enumerate(cameras):
+                    self.assertTrue(np.all(fx[camera.upper()].data == i))
+                    self.assertEqual(fx[camera.upper()].header['FILENAME'], rawfile)
+            with fits.open(simpixfile) as fx:
+                for i, camera in enumerate(cameras):
+                    self.assertTrue(np.all(fx[camera.upper()].data == i))
+            for camera in cameras:
+                self.assertFalse(os.path.exists(
+                    pixsim.camera_tmpfile(rawfile+'.tmp', camera)))
+
+            #- merging cameras that are already in the output is an error
+            writer = pixsim.CameraWriter(rawfile+'.tmp', percamera=True)
+            writer.put('b0', np.zeros((20, 20), dtype=np.int32), header)
+            writer.close()
+            with self.assertRaises(ValueError):
+                pixsim.merge_camera_files(
+                    [pixsim.camera_tmpfile(rawfile+'.tmp', 'b0')], rawfile)
+
+            os.remove(pixsim.camera_tmpfile(rawfile+'.tmp', 'b0'))
+            os.remove(rawfile)
+            os.remove(simpixfile)
+
+    def test_close_writer_abort(self):
+        class FailingWriter(object):
+            def close(self):
+                raise IOError('disk full')
+        class FakeComm(object):
+            aborted = None
+            def Abort(self, errorcode=0):
+                self.aborted = errorcode
+
+        #- Failed writes abort all ranks instead of leaving them at a barrier
+        comm = FakeComm()
+        with self.assertRaises(IOError):
+            pixsim._close_writer(FailingWriter(), comm)
+        self.assertEqual(comm.aborted, 1)
+        with self.assertRaises(IOError):
+            pixsim._close_writer(FailingWriter())
+
+    def test_task_counter(self):
+        queue = pixsim.TaskCounter()
+        self.assertEqual([queue.next() for i in range(5)], list(range(5)))
+        queue.free()
+
     def test_get_nodes_per_exp(self):
         # nodes_per_comm_exp = get_nodes_per_exp(nnodes, nexposures, ncameras)
 
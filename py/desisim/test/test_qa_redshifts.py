@@ -0,0 +1,156 @@
+import unittest, os, shutil, tempfile
+import numpy as np
+import fitsio
+from desitarget.targetmask import desi_mask
+
+from desisim.spec_qa import redshifts
+
+class TestQARedshifts(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.testdir = tempfile.mkdtemp()
+        rand = np.random.RandomState(0)
+
+        #- Per-target truth, so that targets in several files agree
+        ntarg = 1000
+        cls.templatetype = rand.choice(['ELG', 'LRG', 'QSO'], ntarg)
+        cls.truez = rand.uniform(0, 3, ntarg).astype('f4')
+        cls.oiiflux = rand.uniform(0, 5e-16, ntarg).astype('f4')
+
+        #- Overlapping simspec files; the third has no TRUTH_ELG
+        cls.fibermap_files = list()
+        for i in range(3):
+            targetid = np.arange(200) + 150*i
+            fibermap = np.zeros(200, dtype=[('TARGETID', 'i8'), ('DESI_TARGET', 'i8'),
+                                            ('FLUX_R', 'f4')])
+            fibermap['TARGETID'] = targetid
+            fibermap['DESI_TARGET'] = [desi_mask[x] for x in cls.templatetype[targetid]]
+            fibermap['FLUX_R'] = targetid / 100.
+            truth = np.zeros(200, dtype=[('TARGETID', 'i8'),
+                                         ('TEMPLATETYPE', 'U{}'.format(5+i)),
+                                         ('TRUEZ', 'f4'), ('FLUX_R', 'f4')])
+            truth['TARGETID'] = targetid
+            truth['TEMPLATETYPE'] = cls.templatetype[targetid]
+            truth['TRUEZ'] = cls.truez[targetid]
+            truth['FLUX_R'] = fibermap['FLUX_R']
+            filename = os.path.join(cls.testdir, 'fibermap-{}.fits'.format(i))
+            cls.fibermap_files.append(filename)
+            with fitsio.FITS(filename.replace('fibermap', 'simspec'), 'rw', clobber=True) as fx:
+                fx.write(None, header=dict(DEPNAM00='desisim', DEPVER00='1.0'))
+                fx.write(fibermap, extname='FIBERMAP')
+                fx.write(truth, extname='TRUTH')
+                if i < 2:
+                    elg = targetid[truth['TEMPLATETYPE'] == 'ELG'][::-1]
+                    truth_elg = np.zeros(len(elg), dtype=[('TARGETID', 'i8'), ('OIIFLUX', 'f4')])
+                    truth_elg['TARGETID'] = elg
+                    truth_elg['OIIFLUX'] = cls.oiiflux[elg]
+                    fx.write(truth_elg, extname='TRUTH_ELG')
+
+        #- zbest files covering a random subset of targets, plus a missing one
+        cls.zbest_files = list()
+        for i in range(2):
+            targetid = rand.choice(ntarg, 300, replace=False)
+            zbest = np.zeros(300, dtype=[('TARGETID', 'i8'), ('Z', 'f8'), ('ZERR', 'f8'),
+                                         ('ZWARN', 'i8'), ('SPECTYPE', 'U6'), ('CHI2', 'f8')])
+            zbest['TARGETID'] = targetid
+            zbest['Z'] = cls.truez[targetid] + 0.001
+            zbest['ZWARN'] = targetid % 2
+            zbest['SPECTYPE'] = 'GALAXY'
+            filename = os.path.join(cls.testdir, 'zbest-{}.fits'.format(i))
+            fitsio.write(filename, zbest, clobber=True)
+            cls.zbest_files.append(filename)
+        cls.zbest_files.append(os.path.join(cls.testdir, 'zbest-missing.fits'))
+
+    @classmethod
+    def tearDownClass(cls):
+        if os.path.exists(cls.testdir):
+            shutil.rmtree(cls.testdir)
+
+    def test_concatenate(self):
+        a = np.zeros(2, dtype=[('A', 'U3'), ('B', '>f4')])
+        a['A'] = 'abc'
+        b = np.ones(3, dtype=[('A', 'U5'), ('C', 'i8')])
+        b['A'] = 'abcde'
+        x = redshifts._concatenate([a, b])
+        self.assertEqual(x.dtype.names, ('A', 'B', 'C'))
+        self.assertEqual(list(x['A']), ['abc']*2 + ['abcde']*3)
+        self.assertEqual(list(x['B']), [0, 0, 0, 0, 0])
+        self.assertEqual(list(x['C']), [0, 0, 1, 1, 1])
+
+    def test_sorted_match(self):
+        found, idx = redshifts._sorted_match(np.array([2, 5, 9]), np.array([9, 1, 5, 10]))
+        self.assertEqual(list(found), [True, False, True, False])
+        self.assertEqual(list(idx[found]), [2, 1])
+        found, idx = redshifts._sorted_match(np.array([], dtype=int), np.array([1, 2]))
+        self.assertFalse(np.any(found))
+
+    def _check_simz(self, simz_tab, zb_tab):
+        targetid = np.asarray(simz_tab['TARGETID'])
+        self.assertEqual(list(targetid), list(range(500)))
+        self.assertEqual(simz_tab.meta['DEPVER00'], '1.0')
+        self.assertTrue(np.all(simz_tab['TRUEZ'] == self.truez[targetid]))
+
+        #- [OII] fluxes are matched over all files, including for targets
+        #- also in the file without TRUTH_ELG; 0 for non-ELGs and targets
+        #- only in that file
+        elg = (self.templatetype[targetid] == 'ELG') & (targetid < 350)
+        oiiflux = np.asarray(simz_tab['OIIFLUX'])
+        self.assertTrue(np.all(oiiflux[elg] == self.oiiflux[targetid[elg]]))
+        self.assertTrue(np.all(oiiflux[~elg] == 0))
+
+        qso = self.templatetype[targetid] == 'QSO'
+        self.assertTrue(np.all(simz_tab['TEMPLATETYPE'][qso & (self.truez[targetid] >= 2.1)] == 'QSO_L'))
+        self.assertTrue(np.all(simz_tab['TEMPLATETYPE'][qso & (self.truez[targetid] < 2.1)] == 'QSO_T'))
+
+        self.assertTrue(np.all(np.diff(zb_tab['TARGETID']) > 0))
+        redshifts.match_truth_z(simz_tab, zb_tab)
+        measured = np.isin(targetid, zb_tab['TARGETID'])
+        self.assertTrue(np.all(simz_tab['Z'].mask == ~measured))
+        z = simz_tab['Z'][measured]
+        self.assertTrue(np.allclose(z, self.truez[targetid[measured]] + 0.001))
+        self.assertTrue(np.all(simz_tab['ZWARN'][measured] == targetid[measured] % 2))
+
+    def test_load_z(self):
+        for nproc in (1, 2):
+            simz_tab, zb_tab = redshifts.load_z(self.fibermap_files, self.zbest_files, nproc=nproc)
+            self.assertNotIn('CHI2', zb_tab.colnames)
+            self._check_simz(simz_tab, zb_tab)
+
+    def test_load_z_cache(self):
+        cachefile = os.path.join(self.testdir, 'load_z.npz')
+        simz1, zb1 = redshifts.load_z(self.fibermap_files, self.zbest_files,
+                                      nproc=1, cachefile=cachefile)
+        self.assertTrue(os.path.exists(cachefile))
+        self.assertIsNotNone(redshifts._read_load_z_cache(
+            cachefile, self.fibermap_files, self.zbest_files, redshifts._zbest_columns))
+        simz2, zb2 = redshifts.load_z(self.fibermap_files, self.zbest_files,
+                                      nproc=1, cachefile=cachefile)
+        self._check_simz(simz2, zb2)
+        for name in zb1.colnames:
+            self.assertTrue(np.all(zb1[name] == zb2[name]))
+
+        #- Different inputs or zbest columns are not read from the cache
+        self.assertIsNone(redshifts._read_load_z_cache(
+            cachefile, self.fibermap_files[1:], self.zbest_files, redshifts._zbest_columns))
+        self.assertIsNone(redshifts._read_load_z_cache(
+            cachefile, self.fibermap_files, self.zbest_files, None))
+        simz3, zb3 = redshifts.load_z(self.fibermap_files, self.zbest_files, nproc=1,
+                                      zbest_columns=None, cachefile=cachefile)
+        self.assertIn('CHI2', zb3.colnames)
+
+        #- Modified inputs invalidate the cache
+        mtime = os.path.getmtime(self.zbest_files[0])
+        os.utime(self.zbest_files[0], (mtime+10, mtime+10))
+        self.assertIsNone(redshifts._read_load_z_cache(
+            cachefile, self.fibermap_files, self.zbest_files, None))
+
+if __name__ == '__main__':
+    unittest.main()
+
+def test_suite():
+    """Allows testing of only this module with the command::
+
+        python setup.py test -m desisim.test.test_qa_redshifts
+    """
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -0,0 +1,75 @@
+import unittest, os, shutil, tempfile
+import numpy as np
+import fitsio
+
+from desisim.spec_qa import s2n
+
+class TestQAS2N(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.testdir = tempfile.mkdtemp()
+
+    @classmethod
+    def tearDownClass(cls):
+        if os.path.exists(cls.testdir):
+            shutil.rmtree(cls.testdir)
+
+    def test_bin_s2n(self):
+        rand = np.random.RandomState(0)
+        wave = np.linspace(7400, 9900, 500)
+        wv_bins = np.arange(7500., 9800., 20.)
+        mag_bins = np.linspace(19., 24., 6)
+        s2n_sum = np.zeros((wv_bins.size-1, mag_bins.size-1))
+        s2n_N = np.zeros(s2n_sum.shape, dtype=int)
+        expected_sum = np.zeros(s2n_sum.shape)
+        expected_N = np.zeros(s2n_sum.shape, dtype=int)
+        for i in range(3):
+            values = rand.uniform(0, 10, (40, wave.size))
+            mag = rand.uniform(18, 25, 40)
+            s2n.bin_s2n(s2n_sum, s2n_N, values, wave, wv_bins, mag, mag_bins)
+
+            #- Brute force sum over every pixel of every spectrum
+            w_i = np.digitize(wave, wv_bins) - 1
+            m_i = np.digitize(mag, mag_bins) - 1
+            for j in range(values.shape[0]):
+                for k in range(wave.size):
+                    if 0 <= w_i[k] < wv_bins.size-1 and 0 <= m_i[j] < mag_bins.size-1:
+                        expected_sum[w_i[k], m_i[j]] += values[j, k]
+                        expected_N[w_i[k], m_i[j]] += 1
+
+        self.assertTrue(np.allclose(s2n_sum, expected_sum))
+        self.assertTrue(np.all(s2n_N == expected_N))
+
+        #- Nothing within the bins is a no-op
+        s2n.bin_s2n(s2n_sum, s2n_N, values, wave, wv_bins, mag + 100, mag_bins)
+        self.assertTrue(np.all(s2n_N == expected_N))
+
+    def test_read_s2n_truth(self):
+        truth = np.zeros(6, dtype=[('TARGETID', 'i8'), ('TEMPLATETYPE', 'U6'), ('MAG', 'f4')])
+        truth['TARGETID'] = [30, 10, 50, 20, 40, 60]
+        truth['TEMPLATETYPE'] = ['ELG', 'LRG', 'ELG', 'QSO', 'ELG', 'SKY']
+        truth['MAG'] = np.arange(6) + 20
+        #- TRUTH_ELG in a different order than TRUTH, with a target not in TRUTH
+        truth_elg = np.zeros(4, dtype=[('TARGETID', 'i8'), ('OIIFLUX', 'f4')])
+        truth_elg['TARGETID'] = [50, 40, 30, 70]
+        truth_elg['OIIFLUX'] = [5e-17, 4e-17, 3e-17, 7e-17]
+        simspec_file = os.path.join(self.testdir, 'simspec.fits')
+        with fitsio.FITS(simspec_file, 'rw', clobber=True) as fx:
+            fx.write(truth, extname='TRUTH')
+            fx.write(truth_elg, extname='TRUTH_ELG')
+
+        templatetype, mag, oiiflux = s2n._read_s2n_truth(simspec_file)
+        self.assertEqual(list(templatetype), list(truth['TEMPLATETYPE']))
+        self.assertTrue(np.all(mag == truth['MAG']))
+        self.assertTrue(np.allclose(oiiflux, [3e-17, 0, 5e-17, 0, 4e-17, 0]))
+
+if __name__ == '__main__':
+    unittest.main()
+
+def test_suite():
+    """Allows testing of only this module with the command::
+
+        python setup.py test -m desisim.test.test_qa_s2n
+    """
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -1,4 +1,4 @@
-import os
+import os, shutil, tempfile
 import numpy as np
 import unittest
 from astropy.table import Table, Column
@@ -184,6 +184,84 @@ class TestQuickCat(unittest.TestCase):
         p1 = np.count_nonzero(oneobs & goodz) / np.count_nonzero(oneobs)
         p2 = np.count_nonzero(manyobs & goodz) / np.count_nonzero(manyobs)
         self.assertGreater(p2, p1)
-                
+
+
+class TestQuickCatHelpers(unittest.TestCase):
+    """Tests of quickcat helper functions that don't need desimodel data"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.testdir = tempfile.mkdtemp()
+        cls.tileids = [1005, 17, 2300]
+        cls.tilefiles = list()
+        cls.targets_in_tile = dict()
+        for i, tileid in enumerate(cls.tileids):
+            fiberassign = Table()
+            fiberassign['TARGETID'] = np.arange(10) + 100*i
+            fiberassign['TARGETID'][3] = -1     #- unassigned fiber
+            fiberassign['RA'] = np.zeros(10)
+            fiberassign.meta['EXTNAME'] = 'FIBERASSIGN'
+            fiberassign.meta['TILEID'] = tileid
+            filename = os.path.join(cls.testdir, 'tile-{:05d}.fits'.format(tileid))
+            fiberassign.write(filename)
+            cls.tilefiles.append(filename)
+            cls.targets_in_tile[tileid] = np.delete(fiberassign['TARGETID'], 3)
+
+    @classmethod
+    def tearDownClass(cls):
+        if os.path.exists(cls.testdir):
+            shutil.rmtree(cls.testdir)
+
+    def test_read_tile_targetids(self):
+        from desisim.quickcat import read_tile_targetids
+        for nproc in (1, 3):
+            tileids, targetids, offsets = read_tile_targetids(
+                self.tilefiles, nproc=nproc)
+            self.assertEqual(list(tileids), list(self.tileids))
+            self.assertEqual(len(offsets), len(self.tileids)+1)
+            for i, tileid in enumerate(tileids):
+                self.assertTrue(np.all(targetids[offsets[i]:offsets[i+1]] == \
+                    self.targets_in_tile[tileid]))
+
+    def test_match_sorted(self):
+        from desisim.quickcat import _match_sorted
+        sortedids = np.array([2, 5, 7, 11])
+        index, matched = _match_sorted(sortedids, [7, 3, 2, 12, 11])
+        self.assertEqual(list(matched), [True, False, True, False, True])
+        self.assertEqual(list(sortedids[index[matched]]), [7, 2, 11])
+        index, matched = _match_sorted(sortedids[0:0], [7, 3])
+        self.assertFalse(np.any(matched))
+
+    def test_match_targets_in_tile(self):
+        from desisim.quickcat import _match_targets_in_tile
+        targetid = np.array([11, 2, 7, 5])
+        targets_in_tile = {10: np.array([2, 5, -1]), 20: np.array([], dtype=int),
+                           30: np.array([5, 11, 3])}
+        itarget, itile = _match_targets_in_tile(targetid, targets_in_tile, [10, 20, 30])
+        self.assertEqual(list(targetid[itarget]), [2, 5, 5, 11])
+        self.assertEqual(list(itile), [0, 0, 2, 2])
+        itarget, itile = _match_targets_in_tile(targetid, targets_in_tile, [20])
+        self.assertEqual(len(itarget), 0)
+
+    def test_multiobs_efficiency(self):
+        '''Failure probabilities multiply over the tiles a target is on'''
+        from desisim.quickcat import get_redshift_efficiency
+        targets = Table()
+        targets['TARGETID'] = np.array([11, 2, 7, 5])
+        targets['FLUX_G'] = np.ones(4)
+        targets['FLUX_R'] = np.ones(4)
+        truth = Table()
+        truth['TARGETID'] = targets['TARGETID']
+        truth['TRUEZ'] = np.full(4, 0.2)
+        truth['OIIFLUX'] = np.zeros(4)
+        targets_in_tile = {10: np.array([2, 5, -1]), 20: np.array([5, 11]),
+                           30: np.array([5, 11, 3])}
+        obsconditions = dict(TILEID=np.array([10, 20, 30]), AIRMASS=np.ones(3))
+        observed, p = get_redshift_efficiency('BGS', targets, truth, targets_in_tile,
+            obsconditions, params=None, ignore_obscondition=True)
+        self.assertEqual(list(observed), [True, True, False, True])
+        nobs = np.array([2, 1, 0, 3])
+        self.assertTrue(np.allclose(p, 1 - 0.02**nobs))
+
 if __name__ == '__main__':
     unittest.main()
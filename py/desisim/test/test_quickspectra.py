@@ -109,6 +109,177 @@ class TestQuickSpectra(unittest.TestCase):
         sp2 = desispec.io.read_spectra(self.outspec2)
         self._check_spectra_match(sp1, sp2, invert=True)
 
+    def test_blocksize(self):
+        '''Simulating in blocks of fibers doesn't depend upon blocksize'''
+        cmd = 'quickspectra -i {} -o {} --seed 1 --blocksize 1'.format(self.inspec_fits, self.outspec1)
+        opts = quickspectra.parse(cmd.split()[1:])
+        quickspectra.main(opts)
+        cmd = 'quickspectra -i {} -o {} --seed 1 --blocksize 2'.format(self.inspec_fits, self.outspec2)
+        opts = quickspectra.parse(cmd.split()[1:])
+        quickspectra.main(opts)
+
+        sp1 = desispec.io.read_spectra(self.outspec1)
+        sp2 = desispec.io.read_spectra(self.outspec2)
+        self._check_spectra_match(sp1, sp2)
+
+    def test_make_spectra_fibermap(self):
+        '''Frame fibermap columns are copied, cast, or appended'''
+        nspec = 4
+        frame_fibermap = desispec.io.empty_fibermap(nspec)
+        frame_fibermap['TARGETID'] = np.arange(nspec) + 10
+        frame_fibermap['TARGET_RA'] = np.linspace(10, 11, nspec)
+        #- mismatched dtypes are cast to the standard fibermap columns
+        frame_fibermap['FLUX_R'] = np.arange(nspec, dtype='f8') + 0.5
+        frame_fibermap['FIBER'] = np.arange(nspec, dtype='i8') + 500
+        #- and extra columns are appended
+        frame_fibermap['REDSHIFT'] = np.linspace(0.5, 1.5, nspec)
+
+        standard = desispec.io.empty_fibermap(nspec)
+        fibermap = quickspectra.make_spectra_fibermap(frame_fibermap, 20201010, 12, tileid=3)
+        self.assertEqual(len(fibermap), nspec)
+        for colname in standard.colnames:
+            self.assertEqual(fibermap[colname].dtype, standard[colname].dtype)
+            self.assertTrue(np.all(fibermap[colname] == frame_fibermap[colname]))
+        self.assertEqual(fibermap['FLUX_R'].dtype, np.float32)
+        self.assertEqual(fibermap['FIBER'].dtype, standard['FIBER'].dtype)
+
+        self.assertTrue(np.all(fibermap['NIGHT'] == 20201010))
+        self.assertTrue(np.all(fibermap['EXPID'] == 12))
+        self.assertTrue(np.all(fibermap['TILEID'] == 3))
+        self.assertEqual(fibermap['NIGHT'].dtype, np.int32)
+        self.assertEqual(fibermap.colnames[-1], 'REDSHIFT')
+        self.assertTrue(np.all(fibermap['REDSHIFT'] == frame_fibermap['REDSHIFT']))
+
+    def test_simulator_resize(self):
+        '''Cached simulators are reused for a different number of fibers'''
+        import desisim.specsim
+        import specsim.simulator
+        qsim = desisim.specsim.get_simulator('test', num_fibers=3)
+        qsim.simulate()
+        qsim2 = desisim.specsim.get_simulator('test', num_fibers=5)
+        self.assertIs(qsim, qsim2)
+        self.assertEqual(qsim.num_fibers, 5)
+        qsim.simulate()
+
+        ref = specsim.simulator.Simulator('test', num_fibers=5)
+        ref.simulate()
+        for name in ref.simulated.colnames:
+            self.assertTrue(np.allclose(qsim.simulated[name], ref.simulated[name]))
+        for table, reftable in zip(qsim.camera_output, ref.camera_output):
+            self.assertEqual(table.meta['num_fibers'], 5)
+            for name in reftable.colnames:
+                self.assertTrue(np.allclose(table[name], reftable[name]))
+
+    def test_generate_fiber_noise(self):
+        '''Fiber noise doesn't depend upon how fibers are split into blocks'''
+        import desisim.specsim
+        import desisim.simexp
+        chunksize = desisim.simexp.noise_chunksize
+        nspec = 2*chunksize + 10
+        qsim = desisim.specsim.get_simulator('test', num_fibers=nspec)
+        qsim.simulate()
+        noise = dict()
+        for use_poisson in (True, False):
+            desisim.simexp.generate_fiber_noise(qsim, 1, use_poisson=use_poisson)
+            noise[use_poisson] = [np.array(table['random_noise_electrons'])
+                                  for table in qsim.camera_output]
+        self.assertFalse(np.allclose(noise[True][0], noise[False][0]))
+
+        for blocksize in (chunksize, 2*chunksize):
+            for start in range(0, nspec, blocksize):
+                stop = min(start + blocksize, nspec)
+                desisim.specsim.resize_simulator(qsim, stop - start)
+                qsim.simulate()
+                desisim.simexp.generate_fiber_noise(qsim, 1, first_fiber=start)
+                for table, ref in zip(qsim.camera_output, noise[True]):
+                    self.assertTrue(np.allclose(table['random_noise_electrons'],
+                                                ref[:, start:stop]))
+
+        with self.assertRaises(ValueError):
+            desisim.simexp.generate_fiber_noise(qsim, 1, first_fiber=1)
+
+    def test_obsproducts(self):
+        '''Simulating with cached sky products matches specsim'''
+        import astropy.units as u
+        import desisim.specsim
+        import specsim.simulator
+        nspec = 3
+        ref = specsim.simulator.Simulator('test', num_fibers=nspec)
+        qsim = specsim.simulator.Simulator('test', num_fibers=nspec)
+        nwave = len(ref.simulated)
+        fluxunit = 1e-17 * u.erg / (u.Angstrom * u.s * u.cm**2)
+        flux = np.random.uniform(1, 2, size=(nspec, nwave)) * fluxunit
+        xy = np.random.uniform(-200, 200, size=(nspec, 2)) * u.mm
+        source_types = np.array(['qso',]*nspec)
+        ref.simulate(source_fluxes=flux, focal_positions=xy,
+                     source_types=source_types)
+
+        for i in range(2):
+            #- 1st computes and writes the cache file, 2nd reads it back
+            desisim.specsim._obsproducts.clear()
+            desisim.specsim.simulate(qsim, flux, xy, source_types=source_types,
+                                     cachedir=self.testdir)
+            for name in ref.simulated.colnames:
+                self.assertTrue(np.allclose(qsim.simulated[name], ref.simulated[name]))
+            for table, reftable in zip(qsim.camera_output, ref.camera_output):
+                for name in reftable.colnames:
+                    self.assertTrue(np.allclose(table[name], reftable[name]))
+
+        key = desisim.specsim.obsproducts_key(qsim)
+        self.assertIn(key, desisim.specsim._obsproducts)
+        cachefile = os.path.join(self.testdir, 'specsim-obs-{}.npz'.format(key))
+        self.assertTrue(os.path.exists(cachefile))
+        qsim.atmosphere.airmass = 1.5
+        self.assertNotEqual(desisim.specsim.obsproducts_key(qsim), key)
+
+    def test_obsproducts_no_camera_output(self):
+        '''Cached sky products work for simulators without camera output'''
+        import astropy.units as u
+        import desisim.specsim
+        import specsim.simulator
+        nspec = 2
+        ref = specsim.simulator.Simulator('test', num_fibers=nspec, camera_output=False)
+        qsim = specsim.simulator.Simulator('test', num_fibers=nspec, camera_output=False)
+        nwave = len(ref.simulated)
+        fluxunit = 1e-17 * u.erg / (u.Angstrom * u.s * u.cm**2)
+        flux = np.random.uniform(1, 2, size=(nspec, nwave)) * fluxunit
+        xy = np.random.uniform(-200, 200, size=(nspec, 2)) * u.mm
+        source_types = np.array(['qso',]*nspec)
+        ref.simulate(source_fluxes=flux, focal_positions=xy,
+                     source_types=source_types)
+        desisim.specsim.simulate(qsim, flux, xy, source_types=source_types,
+                                 cachedir=self.testdir)
+        for name in ref.simulated.colnames:
+            self.assertTrue(np.allclose(qsim.simulated[name], ref.simulated[name]))
+
+        #- Keys differ with camera output or with different model data
+        #- for the same configuration name
+        key = desisim.specsim.obsproducts_key(qsim)
+        convolved = specsim.simulator.Simulator('test', num_fibers=nspec)
+        self.assertNotEqual(desisim.specsim.obsproducts_key(convolved), key)
+        modified = specsim.simulator.Simulator('test', num_fibers=nspec, camera_output=False)
+        modified.instrument.cameras[0].throughput *= 0.5
+        self.assertNotEqual(desisim.specsim.obsproducts_key(modified), key)
+
+        #- or with a different specsim version
+        version = specsim.__version__
+        try:
+            specsim.__version__ = version + '.test'
+            self.assertNotEqual(desisim.specsim.obsproducts_key(qsim), key)
+        finally:
+            specsim.__version__ = version
+        self.assertEqual(desisim.specsim.obsproducts_key(qsim), key)
+
+    def test_psfconvolve_false(self):
+        '''simulate_spectra runs without PSF convolution'''
+        from desisim.simexp import simulate_spectra
+        wave = np.arange(3600, 9800, 1.0)
+        flux = np.random.uniform(1, 2, size=(2, len(wave)))
+        sim = simulate_spectra(wave, 1e-17*flux, seed=1, psfconvolve=False,
+                               obscache=True, cachedir=self.testdir)
+        self.assertEqual(sim.camera_output, [])
+        self.assertTrue(np.all(sim.simulated['num_source_electrons_b'] > 0))
+
 if __name__ == '__main__':
     unittest.main()
 
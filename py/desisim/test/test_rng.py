@@ -0,0 +1,48 @@
+import unittest
+import numpy as np
+
+from desisim import rng
+
+class TestRNG(unittest.TestCase):
+
+    def tearDown(self):
+        rng.set_engine(None)
+
+    def test_legacy(self):
+        rng.set_engine('legacy')
+        self.assertEqual(rng.get_engine(), 'legacy')
+        x = rng.random_state(10).uniform(size=5)
+        y = np.random.RandomState(10).uniform(size=5)
+        self.assertTrue(np.all(x == y))
+        seeds = rng.spawn_seeds(10, 5)
+        self.assertTrue(np.all(seeds == np.random.RandomState(10).randint(2**32, size=5)))
+
+    def test_engines(self):
+        for engine in ('philox', 'sfc64', 'pcg64'):
+            rng.set_engine(engine)
+            #- same (seed, key) give the same stream regardless of order
+            a = [rng.generator(1, key=i).normal(size=3) for i in range(4)]
+            b = [rng.generator(1, key=i).normal(size=3) for i in range(4)[::-1]]
+            for i in range(4):
+                self.assertTrue(np.all(a[i] == b[3-i]))
+            self.assertFalse(np.all(a[0] == a[1]))
+            self.assertTrue(np.all(rng.random_state(2, key=(3, 4)).uniform(size=3) ==
+                                   rng.random_state(2, key=(3, 4)).uniform(size=3)))
+
+            #- seeds don't depend upon how many were requested
+            seeds = rng.spawn_seeds(3, 10)
+            self.assertTrue(np.all(seeds[0:4] == rng.spawn_seeds(3, 4)))
+            self.assertTrue(np.all((0 <= seeds) & (seeds < 2**32)))
+
+        with self.assertRaises(ValueError):
+            rng.set_engine('blat')
+
+if __name__ == '__main__':
+    unittest.main()
+
+def test_suite():
+    """Allows testing of only this module with the command::
+
+        python setup.py test -m desisim.test.test_rng
+    """
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -38,6 +38,58 @@ class TestObs(unittest.TestCase):
             self.assertEqual(flux.shape[1], wave.shape[0])
             self.assertEqual(len(meta), n)
 
+    def test_parallel_chunks(self):
+        '''Splitting objtypes into chunks matches the serial targets'''
+        nspec = 50
+        fibermap1, (flux1, wave1, meta1, objmeta1) = desisim.targets.get_targets(nspec, 'DARK', seed=2)
+        fibermap, (flux, wave, meta, objmeta) = desisim.targets.get_targets_parallel(nspec, 'DARK', seed=2, nproc=4)
+        self.assertEqual(len(desisim.targets._template_makers), 0)
+
+        #- same targets and objtype counts, with meta aligned to the fibermap
+        self.assertTrue(np.all(fibermap['TARGETID'] == fibermap1['TARGETID']))
+        self.assertTrue(np.all(meta['TARGETID'] == fibermap['TARGETID']))
+        self.assertTrue(np.all(meta['OBJTYPE'] == meta1['OBJTYPE']))
+        self.assertEqual(sorted(objmeta.keys()), sorted(objmeta1.keys()))
+        for key in objmeta:
+            ii = (meta['OBJTYPE'] == key)
+            self.assertEqual(len(objmeta[key]), len(objmeta1[key]))
+            self.assertEqual(sorted(objmeta[key]['TARGETID']), sorted(meta['TARGETID'][ii]))
+
+    def test_insert_targets(self):
+        '''Stacks results of several chunks of one objtype'''
+        from astropy.table import Table
+        from desisim.io import empty_metatable
+        nspec, nwave = 40, 7
+        true_objtype = np.array(['ELG']*25 + ['QSO_BAD']*8 + ['SKY']*7)
+        np.random.RandomState(1).shuffle(true_objtype)
+        fibermap = Table()
+        fibermap['TARGETID'] = np.arange(nspec) + 100
+
+        flux = np.zeros((nspec, nwave))
+        meta, _ = empty_metatable(nmodel=nspec, objtype='SKY')
+        meta['TARGETID'] = fibermap['TARGETID']
+        objmeta = dict()
+        for objtype, metatype in (('ELG', 'ELG'), ('QSO_BAD', 'STAR')):
+            ii = np.where(true_objtype == objtype)[0]
+            for i in range(0, len(ii), 10):
+                jj = ii[i:i+10]
+                meta1, objmeta1 = empty_metatable(nmodel=len(jj), objtype=metatype)
+                meta1['REDSHIFT'] = jj
+                simflux = np.tile(jj, (nwave, 1)).T
+                desisim.targets._insert_targets(jj, (simflux, meta1, objmeta1),
+                                                fibermap, flux, meta, objmeta)
+
+        self.assertTrue(np.all(meta['TARGETID'] == fibermap['TARGETID']))
+        notsky = (true_objtype != 'SKY')
+        self.assertTrue(np.all(meta['REDSHIFT'][notsky] == np.where(notsky)[0]))
+        self.assertTrue(np.all(flux[notsky, 0] == np.where(notsky)[0]))
+        self.assertTrue(np.all(flux[~notsky] == 0))
+        self.assertEqual(sorted(objmeta.keys()), ['ELG', 'STAR'])
+        for objtype, key in (('ELG', 'ELG'), ('QSO_BAD', 'STAR')):
+            ii = (true_objtype == objtype)
+            self.assertTrue(np.all(meta['OBJTYPE'][ii] == key))
+            self.assertTrue(np.all(objmeta[key]['TARGETID'] == fibermap['TARGETID'][ii]))
+
     def test_parallel_radec(self):
         '''Ensure that parallel generated ra,dec are unique'''
         nspec = 60
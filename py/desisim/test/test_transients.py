@@ -0,0 +1,124 @@
+import unittest, os, shutil, tempfile
+import numpy as np
+from astropy import units as u
+
+from desisim import transients
+
+class _LinearModel(transients.Transient):
+    """Toy model whose flux is linear in time, so interpolation is exact."""
+
+    def __init__(self):
+        super().__init__('linear', 'test')
+        self.ncalls = 0
+
+    def minwave(self):
+        return 3000 * u.Angstrom
+
+    def maxwave(self):
+        return 10000 * u.Angstrom
+
+    def mintime(self):
+        return -10 * u.day
+
+    def maxtime(self):
+        return 20 * u.day
+
+    def set_model_pars(self, modelpars):
+        pass
+
+    def flux(self, t, wl):
+        self.ncalls += 1
+        t = t.to('day').value if type(t) is u.quantity.Quantity else t
+        return (1.0 + 0.01*(t + 10)) * (wl / 1000.0) + 0.1*t
+
+class TestTransients(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.testdir = tempfile.mkdtemp()
+        cls.tabfile = os.path.join(cls.testdir, 'tabular.txt')
+        wave = np.linspace(3000, 10000, 50)
+        np.savetxt(cls.tabfile, np.array([wave, 1 + np.sin(wave/500.)**2]).T)
+        cls.wave = np.linspace(3600, 9800, 200)
+
+    @classmethod
+    def tearDownClass(cls):
+        if os.path.exists(cls.testdir):
+            shutil.rmtree(cls.testdir)
+
+    def test_tabular(self):
+        model = transients.TabularModel('tab', 'test', self.tabfile, 'ascii')
+        epochs = np.array([0, 0, 1, 0])
+        flux = model.fluxes(epochs, self.wave * u.Angstrom)
+        self.assertEqual(flux.shape, (len(epochs), len(self.wave)))
+        for f, t in zip(flux, epochs):
+            self.assertTrue(np.allclose(f, model.flux(t, self.wave)))
+
+    def test_fluxes(self):
+        model = _LinearModel()
+        epochs = np.array([3, -2, 3, 3, 7, -2])
+        flux = model.fluxes(epochs, self.wave)
+        self.assertEqual(model.ncalls, 3)
+        for f, t in zip(flux, epochs):
+            expected = model.flux(t, self.wave)
+            self.assertTrue(np.allclose(f, expected / expected.sum()))
+
+        #- Interpolated from a cached, tabulated flux surface
+        epochs = np.array([-10.0, -2.5, 0.3, 19.9, 20.0, 25.0])
+        ncalls = model.ncalls
+        flux = model.fluxes(epochs * u.day, self.wave, dt=2.0)
+        self.assertEqual(model.ncalls - ncalls, 16)
+        model.fluxes(epochs, self.wave, dt=2.0)
+        self.assertEqual(model.ncalls - ncalls, 16)
+        for f, t in zip(flux, np.clip(epochs, -10, 20)):
+            expected = model.flux(t, self.wave)
+            self.assertTrue(np.allclose(f, expected / expected.sum()))
+
+        times, surface = model.flux_surface(self.wave, 2.0)
+        self.assertEqual(times[0], -10)
+        self.assertEqual(times[-1], 20)
+        self.assertEqual(surface.shape, (len(times), len(self.wave)))
+
+    @unittest.skipUnless(transients.use_sncosmo, 'sncosmo not installed')
+    def test_supernova(self):
+        import sncosmo
+        phase = np.linspace(-20, 50, 36)
+        wave = np.linspace(2000, 12000, 101)
+        sed = np.exp(-0.5*(phase[:, None]/15)**2) * (1 + wave/1e4) \
+            + 0.01 * (phase[:, None] + 20) * (wave/1e4)**2
+        source = sncosmo.TimeSeriesSource(phase, wave, sed, name='toy')
+
+        sn1 = transients.Supernova(source, 'Ia', dict(z=0.1, t0=5., amplitude=1.))
+        sn2 = transients.Supernova(source, 'Ia', dict(z=0.1, t0=5., amplitude=1.))
+        self.assertEqual(sn1.t0.value, 5)
+        self.assertIsNot(sn1.snmodel, sn2.snmodel)
+
+        #- All epochs at once, or interpolated from a flux surface
+        epochs = np.array([-3.0, 0.0, 12.5, 0.0])
+        flux = sn1.fluxes(epochs, self.wave)
+        for f, t in zip(flux, epochs):
+            self.assertTrue(np.allclose(f, sn1.flux(t, self.wave)))
+        flux = sn1.fluxes(epochs, self.wave, dt=0.5)
+        for f, t in zip(flux, epochs):
+            self.assertTrue(np.allclose(f, sn1.flux(t, self.wave), rtol=1e-3))
+
+        #- Partial updates keep the other parameters, only for this instance,
+        #- and invalidate the cached flux surfaces
+        sn1.set_model_pars({'z': 0.3})
+        self.assertEqual(sn1.snmodel['z'], 0.3)
+        self.assertEqual(sn1.snmodel['amplitude'], 1.)
+        self.assertEqual(sn1.snmodel['t0'], 0.)
+        self.assertEqual(sn2.snmodel['z'], 0.1)
+        self.assertEqual(len(sn1._surfaces), 0)
+        self.assertFalse(np.allclose(sn1.fluxes([12.5], self.wave)[0],
+                                     sn2.fluxes([12.5], self.wave)[0]))
+
+if __name__ == '__main__':
+    unittest.main()
+
+def test_suite():
+    """Allows testing of only this module with the command::
+
+        python setup.py test -m desisim.test.test_transients
+    """
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -30,6 +30,9 @@ class Transient(ABC):
         self.hostratio = 1.
         self.phase = 0.*u.day
 
+        # Cache of tabulated flux surfaces, see flux_surface.
+        self._surfaces = dict()
+
     @abstractmethod
     def minwave(self):
         pass
@@ -54,6 +57,96 @@ class Transient(ABC):
     def flux(self, t, wl):
         pass
 
+    def _flux_grid(self, t, wave):
+        """Return unnormalized flux [len(t), len(wave)] for an array of times
+        in days and wavelengths in Angstrom.  Subclasses should override this
+        with a vectorized evaluation; the default calls flux() for each time.
+        """
+        return np.array([self.flux(tt, wave) for tt in t])
+
+    def fluxes(self, t, wl, dt=None):
+        """Return flux vs wavelength for an array of times t.
+
+        Each unique time is only evaluated once.  If dt is given, the flux is
+        instead linearly interpolated in time from a cached flux surface
+        tabulated every dt days (see flux_surface).
+
+        Parameters
+        ----------
+        t : float, ndarray or astropy.units.quantity.Quantity
+            Times of observation, with t=0 representing max light.
+        wl : list or ndarray
+            Wavelength array to compute the flux.
+        dt : float or astropy.units.quantity.Quantity, optional
+            Time sampling of the interpolated flux surface.
+
+        Returns
+        -------
+        flux : ndarray
+            Normalized flux array [len(t), len(wl)].
+        """
+        t = _to_value(np.atleast_1d(t), 'day')
+        wave_ = _to_value(np.asarray(wl), 'Angstrom')
+
+        if dt is not None:
+            times, surface = self.flux_surface(wave_, dt)
+            flux = _interp_rows(t, times, surface)
+        else:
+            tu, inverse = np.unique(t, return_inverse=True)
+            flux = self._flux_grid(tu, wave_)[inverse]
+
+        return flux / np.sum(flux, axis=1, keepdims=True)
+
+    def flux_surface(self, wl, dt=1.):
+        """Return the flux tabulated on a (time, wavelength) grid.
+
+        The surface is sampled every dt days between mintime and maxtime, and
+        is cached per wavelength grid and dt.
+
+        Parameters
+        ----------
+        wl : list or ndarray
+            Wavelength array to compute the flux.
+        dt : float or astropy.units.quantity.Quantity
+            Time sampling in days.
+
+        Returns
+        -------
+        times : ndarray
+            Time grid in days.
+        surface : ndarray
+            Flux array [len(times), len(wl)].
+        """
+        wave_ = _to_value(np.asarray(wl, dtype=float), 'Angstrom')
+        dt = float(_to_value(dt, 'day'))
+
+        key = (dt, len(wave_), hash(wave_.tobytes()))
+        if key not in self._surfaces:
+            tmin = self.mintime().to('day').value
+            tmax = self.maxtime().to('day').value
+            times = np.arange(tmin, tmax + dt, dt)
+            times[-1] = min(times[-1], tmax)
+            self._surfaces[key] = (times, self._flux_grid(times, wave_))
+
+        return self._surfaces[key]
+
+
+def _to_value(x, unit):
+    """Strip units from a Quantity, assuming unit for plain values."""
+    return x.to(unit).value if type(x) is u.quantity.Quantity else x
+
+def _interp_rows(t, times, surface):
+    """Linearly interpolate the rows of surface [len(times), nwave] to times
+    t, clipping t to the range of times.
+    """
+    t = np.clip(t, times[0], times[-1])
+    if len(times) == 1:
+        return np.tile(surface[0], (len(t), 1))
+
+    i = np.clip(np.searchsorted(times, t, side='right') - 1, 0, len(times) - 2)
+    w = ((t - times[i]) / (times[i+1] - times[i]))[:, np.newaxis]
+    return (1 - w) * surface[i] + w * surface[i+1]
+
 if use_sncosmo:
 
     class Supernova(Transient):
@@ -105,6 +198,7 @@ if use_sncosmo:
                 Parameters used to initialize the internal model.
             """
             self.snmodel.set(**modelpars)
+            self._surfaces.clear()
 
         def flux(self, t, wl):
             """Return flux vs wavelength at a given time t.
@@ -134,6 +228,10 @@ if use_sncosmo:
             flux = self.snmodel.flux(time_, wl)
             return flux / np.sum(flux)
 
+        def _flux_grid(self, t, wave):
+            """Evaluate the sncosmo model at all times at once."""
+            return self.snmodel.flux(t + self.t0.to('day').value, wave)
+
 
 class TabularModel(Transient):
 
@@ -207,6 +305,10 @@ class TabularModel(Transient):
         flux = self.fvsw_(wave_)
         return flux / np.sum(flux)
 
+    def _flux_grid(self, t, wave):
+        """The model is time-independent, so evaluate it once."""
+        return np.tile(self.fvsw_(wave), (len(t), 1))
+
 
 class ModelBuilder:
     """A class which can build a transient model. It allows the TransientModels